@@ -0,0 +1,416 @@
+# alerts.py - Пороговые алерты по тикерам
+#
+# Правила хранятся в journal.alert_rules (profitpal.db): пользователь, тикер,
+# вид и порог. Виды:
+#
+#   price_below  - цена <= порога
+#   price_above  - цена >= порога
+#   undervalued  - разрыв intrinsic value / цена (%) >= порога
+#                  (по умолчанию 20 — граница "UNDERVALUED" в анализе)
+#
+# Раз в ALERT_INTERVAL фоновый поток оценивает ВСЕ активные правила разом:
+#   - правила лежат в памяти индексом, отсортированным по (kind, symbol,
+#     threshold), каждая пара (kind, symbol) — непрерывный срез массива порогов;
+#   - цены всех тикеров — пакетные запросы quote (market_data.quote_cache),
+#     разрыв — intrinsic value из кэша анализа (market_data.analysis_cache),
+#     а для тикеров без анализа — базовый DCF по фундаменталу
+#     (dcf.fundamentals_cache; промахи догружаются через valuer, не больше
+#     ALERT_VALUATIONS_PER_CYCLE запросов в FMP за цикл), с живой ценой;
+#   - сработавшие правила в срезе находятся одним np.searchsorted по
+#     отсортированным порогам, а не перебором правил.
+#
+# Правила, для которых в последнем цикле не нашлось цены или оценки,
+# list_rules показывает со статусом pending_data.
+#
+# Индекс перестраивается из БД только после изменений правил. Сработавшее
+# правило выключается (одноразовое) и получает notify_state = 'pending' —
+# письмо шлётся только по строкам, которые UPDATE действительно выключил
+# (второй воркер или удалённое правило дадут rowcount 0).
+#
+# Уведомления — отдельный поток: захватывает ожидающие строки
+# (pending -> sending), шлёт одно письмо на пользователя через notifier
+# (main.send_alert_email) и записывает итог: sent или pending с ошибкой и
+# счётчиком попыток (после ALERT_NOTIFY_MAX_ATTEMPTS — failed). Сбой SMTP
+# или отсутствие GMAIL_PASSWORD не теряют алерты, медленный SMTP не
+# задерживает оценку правил. Захват, брошенный упавшим процессом,
+# подбирается снова через NOTIFY_CLAIM_TIMEOUT_SEC.
+
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+import metrics
+from storage import get_connection
+from dcf import dcf_value, fundamentals_cache
+from market_data import QuoteFetcher, analysis_cache, quote_cache
+from portfolio_engine import normalize_symbol
+
+ALERT_INTERVAL_SEC = float(os.getenv("ALERT_INTERVAL", "300"))
+MAX_RULES_PER_USER = int(os.getenv("ALERT_MAX_RULES_PER_USER", "500"))
+ALERT_VALUATIONS_PER_CYCLE = int(os.getenv("ALERT_VALUATIONS_PER_CYCLE", "10"))
+ALERT_NOTIFY_RETRY_SEC = float(os.getenv("ALERT_NOTIFY_RETRY", "300"))
+ALERT_NOTIFY_MAX_ATTEMPTS = int(os.getenv("ALERT_NOTIFY_MAX_ATTEMPTS", "5"))
+NOTIFY_CLAIM_TIMEOUT_SEC = 600
+
+ALERT_KINDS = ("price_below", "price_above", "undervalued")
+DEFAULT_UNDERVALUED_GAP = 20.0
+
+Notifier = Callable[[str, List[Dict[str, Any]]], None]
+Valuer = Callable[[str], Optional[Dict[str, Any]]]   # тикер -> входы DCF (analyzer.get_dcf_inputs)
+
+
+class RuleIndex:
+    """Активные правила, отсортированные по (kind, symbol, threshold)."""
+
+    def __init__(self, rows: List[Tuple]):
+        # rows: (id, user_id, kind, symbol, threshold) в порядке kind, symbol, threshold
+        self.size = len(rows)
+        self.ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=self.size)
+        self.user_ids = [r[1] for r in rows]
+        self.thresholds = np.fromiter((r[4] for r in rows), dtype=np.float64, count=self.size)
+        self.groups: Dict[Tuple[str, str], Tuple[int, int]] = {}
+
+        if self.size:
+            kinds = np.array([r[2] for r in rows], dtype=object)
+            symbols = np.array([r[3] for r in rows], dtype=object)
+            changed = (kinds[1:] != kinds[:-1]) | (symbols[1:] != symbols[:-1])
+            starts = np.concatenate([[0], np.flatnonzero(changed) + 1])
+            ends = np.append(starts[1:], self.size)
+            for start, end in zip(starts.tolist(), ends.tolist()):
+                self.groups[(kinds[start], symbols[start])] = (start, end)
+
+        self.symbols = sorted({symbol for _, symbol in self.groups})
+
+    def match(self, prices: Dict[str, float], gaps: Dict[str, float]) -> List[Tuple[int, str, str, float]]:
+        """[(позиция в индексе, kind, symbol, значение)] для сработавших правил."""
+        hits = []
+        for (kind, symbol), (start, end) in self.groups.items():
+            value = gaps.get(symbol) if kind == "undervalued" else prices.get(symbol)
+            if value is None:
+                continue
+            thresholds = self.thresholds[start:end]
+            if kind == "price_below":
+                # цена <= порога -> все пороги справа от позиции цены
+                first, last = start + int(np.searchsorted(thresholds, value, side="left")), end
+            else:
+                # значение >= порога -> все пороги слева
+                first, last = start, start + int(np.searchsorted(thresholds, value, side="right"))
+            hits.extend((i, kind, symbol, value) for i in range(first, last))
+        return hits
+
+
+class AlertEngine:
+    """Периодическая пакетная оценка правил + очередь уведомлений."""
+
+    def __init__(self, interval: float = ALERT_INTERVAL_SEC):
+        self.interval = interval
+        self.fetch: Optional[QuoteFetcher] = None
+        self.notify: Optional[Notifier] = None
+        self.valuer: Optional[Valuer] = None
+        self._index: Optional[RuleIndex] = None
+        self._dirty = True
+        self._lock = threading.Lock()
+        self._thread = None
+        self._notifier_thread = None
+        self._stopped = threading.Event()
+        self._wake = threading.Event()
+        # (kind, symbol), для которых в последнем цикле было значение
+        self._covered: set = set()
+
+        self.cycles = 0
+        self.triggered = 0
+        self.notifications = 0
+        self.notify_failures = 0
+        self.valuations = 0
+        self.last_cycle_ms = None
+
+    def set_fetcher(self, fetch: QuoteFetcher):
+        self.fetch = fetch
+
+    def set_notifier(self, notify: Notifier):
+        self.notify = notify
+
+    def set_valuer(self, valuer: Valuer):
+        self.valuer = valuer
+
+    def invalidate(self):
+        """Правила изменились — перестроить индекс на следующем цикле."""
+        self._dirty = True
+
+    # ---------- фоновый поток ----------
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="alert-engine", daemon=True)
+        self._thread.start()
+        self._notifier_thread = threading.Thread(target=self._run_notifier, name="alert-notifier", daemon=True)
+        self._notifier_thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+        for thread in (self._thread, self._notifier_thread):
+            if thread is not None:
+                thread.join(timeout=5)
+        self._thread = self._notifier_thread = None
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.evaluate_once()
+            except Exception as e:
+                print(f"❌ Alert evaluation failed: {e}")
+
+    def _run_notifier(self):
+        # первый проход сразу: письма, не отправленные до перезапуска
+        while not self._stopped.is_set():
+            try:
+                self.deliver_pending()
+            except Exception as e:
+                print(f"❌ Alert delivery failed: {e}")
+            self._wake.wait(ALERT_NOTIFY_RETRY_SEC)
+            self._wake.clear()
+
+    # ---------- оценка ----------
+
+    def _load_index(self) -> RuleIndex:
+        with self._lock:
+            if self._dirty or self._index is None:
+                # сбрасываем флаг до чтения: изменение во время загрузки снова его выставит
+                self._dirty = False
+                with get_connection() as con:
+                    rows = con.execute(
+                        "SELECT id, user_id, kind, symbol, threshold FROM journal.alert_rules "
+                        "WHERE is_active = 1 ORDER BY kind, symbol, threshold"
+                    ).fetchall()
+                self._index = RuleIndex(rows)
+            return self._index
+
+    def evaluate_once(self) -> int:
+        """Один цикл: цены пачкой, поиск по отсортированным порогам. Возвращает число сработавших правил."""
+        started = time.perf_counter()
+        index = self._load_index()
+        self.cycles += 1
+        if not index.size:
+            return 0
+
+        quotes = quote_cache.get_quotes(index.symbols, self.fetch) if self.fetch else {}
+        prices = {s: float(q["price"]) for s, q in quotes.items() if q.get("price")}
+        gaps = {}
+        budget = ALERT_VALUATIONS_PER_CYCLE
+        for kind, symbol in index.groups:
+            if kind != "undervalued" or symbol not in prices:
+                continue
+            value, fetched = self._intrinsic_value(symbol, budget > 0)
+            budget -= fetched
+            if value:
+                gaps[symbol] = (value - prices[symbol]) / prices[symbol] * 100
+        self._covered = {
+            (kind, symbol) for kind, symbol in index.groups
+            if symbol in (gaps if kind == "undervalued" else prices)
+        }
+
+        hits = index.match(prices, gaps)
+        fired = self._fire(index, hits) if hits else 0
+        self.last_cycle_ms = round((time.perf_counter() - started) * 1000, 1)
+        metrics.inc("alerts.cycles")
+        return fired
+
+    def _intrinsic_value(self, symbol: str, allow_fetch: bool) -> Tuple[Optional[float], bool]:
+        """
+        Intrinsic value: из кэша анализа, иначе базовый DCF по фундаменталу.
+        Второе значение — был ли запрос фундаментала в FMP.
+        """
+        analysis = analysis_cache.get(symbol)
+        if analysis and analysis.get("intrinsic_value"):
+            return analysis["intrinsic_value"], False
+
+        fetched = False
+        inputs = fundamentals_cache.get(symbol)
+        if inputs is None:
+            # неприменимость DCF кэширует сам fundamentals_cache (см. dcf.py)
+            if self.valuer is None or not allow_fetch or fundamentals_cache.is_not_applicable(symbol):
+                return None, False
+            inputs, fetched = self.valuer(symbol), True
+            self.valuations += 1
+            if inputs is None:
+                return None, True
+        value = float(dcf_value(inputs, inputs["growth"], inputs["discount_rate"]))
+        return (value if value > 0 else None), fetched
+
+    def is_covered(self, kind: str, symbol: str) -> bool:
+        """Было ли в последнем цикле значение для пары (kind, symbol)."""
+        return (kind, symbol) in self._covered
+
+    def _fire(self, index: RuleIndex, hits: List[Tuple[int, str, str, float]]) -> int:
+        """Выключить сработавшие правила и поставить их в очередь уведомлений."""
+        now = datetime.now().isoformat(sep=" ", timespec="seconds")
+        fired = 0
+        with get_connection() as con:
+            for i, _, _, value in hits:
+                fired += con.execute(
+                    "UPDATE journal.alert_rules SET is_active = 0, triggered_at = ?, triggered_value = ?, "
+                    "notify_state = 'pending' WHERE id = ? AND is_active = 1",
+                    (now, value, int(index.ids[i])),
+                ).rowcount
+        self.invalidate()
+        if not fired:
+            return 0
+        self.triggered += fired
+        metrics.inc("alerts.triggered", fired)
+        print(f"🔔 Alerts triggered: {fired} rules")
+        self._wake.set()
+        return fired
+
+    def deliver_pending(self) -> int:
+        """Разослать ожидающие уведомления, одно письмо на пользователя. Возвращает число писем."""
+        if self.notify is None:
+            return 0
+        now = datetime.now()
+        claimed_at = now.isoformat(sep=" ", timespec="seconds")
+        stale = (now - timedelta(seconds=NOTIFY_CLAIM_TIMEOUT_SEC)).isoformat(sep=" ", timespec="seconds")
+        with get_connection() as con:
+            # отложенная транзакция: первая команда пишет в journal — блокируется только он
+            con.execute("BEGIN")
+            rows = con.execute(
+                "UPDATE journal.alert_rules SET notify_state = 'sending', notified_at = ? "
+                "WHERE notify_state IN ('pending', 'sending') "
+                "AND (notify_state = 'pending' OR notified_at < ?) "
+                "RETURNING id, user_id, symbol, kind, threshold, triggered_value",
+                (claimed_at, stale),
+            ).fetchall()
+
+        by_user: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+        for rule_id, user_id, symbol, kind, threshold, value in sorted(rows):
+            by_user[user_id].append({
+                "id": rule_id,
+                "symbol": symbol,
+                "kind": kind,
+                "threshold": threshold,
+                "value": round(value, 2),
+            })
+
+        sent = 0
+        for user_id, alerts in by_user.items():
+            ids = [a["id"] for a in alerts]
+            placeholders = ",".join("?" * len(ids))
+            try:
+                self.notify(user_id, alerts)
+            except Exception as e:
+                self.notify_failures += 1
+                metrics.inc("alerts.notify_failures")
+                print(f"❌ Alert notification for {user_id} failed: {e}")
+                with get_connection() as con:
+                    con.execute(
+                        "UPDATE journal.alert_rules SET notify_attempts = notify_attempts + 1, notify_error = ?, "
+                        "notify_state = CASE WHEN notify_attempts + 1 >= ? THEN 'failed' ELSE 'pending' END "
+                        f"WHERE id IN ({placeholders}) AND notify_state = 'sending'",
+                        (str(e)[:500], ALERT_NOTIFY_MAX_ATTEMPTS, *ids),
+                    )
+                continue
+            with get_connection() as con:
+                con.execute(
+                    "UPDATE journal.alert_rules SET notify_state = 'sent', notified_at = ?, "
+                    "notify_attempts = notify_attempts + 1, notify_error = NULL "
+                    f"WHERE id IN ({placeholders})",
+                    (datetime.now().isoformat(sep=" ", timespec="seconds"), *ids),
+                )
+            sent += 1
+            self.notifications += 1
+        return sent
+
+    def get_stats(self) -> Dict[str, Any]:
+        index = self._index
+        return {
+            "rules": index.size if index else None,
+            "symbols": len(index.symbols) if index else None,
+            "interval_sec": self.interval,
+            "cycles": self.cycles,
+            "triggered": self.triggered,
+            "notifications": self.notifications,
+            "notify_failures": self.notify_failures,
+            "valuations": self.valuations,
+            "last_cycle_ms": self.last_cycle_ms,
+        }
+
+
+# ==========================================
+# ПРАВИЛА ПОЛЬЗОВАТЕЛЯ
+# ==========================================
+
+def add_rule(user_id, symbol: str, kind: str, threshold: Optional[float] = None) -> int:
+    """Создать правило. ValueError — неверные параметры или лимит правил."""
+    symbol = normalize_symbol(symbol)
+    if not symbol:
+        raise ValueError("symbol is required")
+    if kind not in ALERT_KINDS:
+        raise ValueError(f"kind must be one of {', '.join(ALERT_KINDS)}")
+    if threshold is None:
+        if kind != "undervalued":
+            raise ValueError("threshold is required")
+        threshold = DEFAULT_UNDERVALUED_GAP
+    threshold = float(threshold)
+
+    with get_connection() as con:
+        # сначала запись (блокировка только journal, не всех хранилищ), потом
+        # проверка лимита под ней; сверх лимита — исключение и откат
+        con.execute("BEGIN")
+        rule_id = con.execute(
+            "INSERT INTO journal.alert_rules (user_id, symbol, kind, threshold) VALUES (?, ?, ?, ?)",
+            (user_id, symbol, kind, threshold),
+        ).lastrowid
+        count = con.execute(
+            "SELECT COUNT(*) FROM journal.alert_rules WHERE user_id = ? AND is_active = 1", (user_id,)
+        ).fetchone()[0]
+        if count > MAX_RULES_PER_USER:
+            raise ValueError(f"Alert limit reached ({MAX_RULES_PER_USER} active rules)")
+    alert_engine.invalidate()
+    return rule_id
+
+
+def list_rules(user_id) -> List[Dict[str, Any]]:
+    """
+    Правила пользователя. status: triggered — сработало; pending_data — в
+    последнем цикле не было цены или оценки (правило пока не проверяется);
+    watching — проверяется. notify_state — доставка письма по сработавшему.
+    """
+    with get_connection() as con:
+        rows = con.execute(
+            "SELECT id, symbol, kind, threshold, is_active, triggered_at, triggered_value, created_at, "
+            "notify_state, notified_at, notify_error "
+            "FROM journal.alert_rules WHERE user_id = ? ORDER BY is_active DESC, symbol, id",
+            (user_id,),
+        ).fetchall()
+    columns = ("id", "symbol", "kind", "threshold", "is_active", "triggered_at",
+               "triggered_value", "created_at", "notify_state", "notified_at", "notify_error")
+    rules = [dict(zip(columns, row)) for row in rows]
+    for rule in rules:
+        if not rule["is_active"]:
+            rule["status"] = "triggered"
+        elif alert_engine.is_covered(rule["kind"], rule["symbol"]):
+            rule["status"] = "watching"
+        else:
+            rule["status"] = "pending_data"
+    return rules
+
+
+def delete_rule(user_id, rule_id: int) -> bool:
+    with get_connection() as con:
+        deleted = con.execute(
+            "DELETE FROM journal.alert_rules WHERE user_id = ? AND id = ?", (user_id, rule_id)
+        ).rowcount
+    if deleted:
+        alert_engine.invalidate()
+    return bool(deleted)
+
+
+# Глобальный экземпляр (fetcher и notifier подключает main.py)
+alert_engine = AlertEngine()
+metrics.register_gauge("alerts", alert_engine.get_stats)
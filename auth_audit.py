@@ -0,0 +1,185 @@
+# auth_audit.py - Write-behind журнал событий аутентификации
+#
+# Попытки входа (login_attempts) и обновление last_login/login_count
+# раньше писались синхронно, отдельным соединением на каждое событие, и
+# при всплесках логинов упирались в write-lock SQLite. Теперь события
+# кладутся в ограниченный буфер, а фоновый поток раз в FLUSH_INTERVAL
+# пишет их пачкой (executemany) в одной транзакции.
+#
+# Неудачный сброс (например, "database is locked") не теряет пачку: она
+# остаётся в очереди повтора с экспоненциальной паузой, и только после
+# FLUSH_MAX_RETRIES неудач подряд события считаются потерянными.
+#
+# attempt_time пишется в UTC в формате CURRENT_TIMESTAMP ("YYYY-MM-DD HH:MM:SS"),
+# как у строк со значением по умолчанию: иначе сравнения и дневные счётчики
+# (substr(attempt_time, 1, 10)) расходятся.
+
+import os
+import atexit
+import queue
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Tuple
+
+import metrics
+from storage import get_connection
+
+FLUSH_INTERVAL_SEC = float(os.getenv("AUTH_AUDIT_FLUSH_INTERVAL", "0.25"))
+BUFFER_SIZE = int(os.getenv("AUTH_AUDIT_BUFFER", "10000"))
+# сколько ждём места в переполненном буфере, прежде чем выбросить событие
+ENQUEUE_TIMEOUT_SEC = 0.05
+FLUSH_MAX_RETRIES = int(os.getenv("AUTH_AUDIT_FLUSH_RETRIES", "5"))
+FLUSH_BACKOFF_MAX_SEC = 30.0
+
+_INSERT_ATTEMPT = '''
+    INSERT INTO login_attempts
+    (email, license_key, success, ip_address, user_agent, attempt_time)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+_UPDATE_LAST_LOGIN = '''
+    UPDATE users
+    SET last_login = ?, login_count = login_count + 1
+    WHERE id = ?
+'''
+
+
+class AuthAuditWriter:
+    """Буфер событий аутентификации с фоновым пакетным сбросом в SQLite."""
+
+    def __init__(self, flush_interval: float = FLUSH_INTERVAL_SEC,
+                 buffer_size: int = BUFFER_SIZE):
+        self.flush_interval = flush_interval
+        self._queue: "queue.Queue[Tuple[str, tuple]]" = queue.Queue(maxsize=buffer_size)
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        # пачка, которую не удалось записать, и когда пробовать снова
+        self._retry: List[Tuple[str, tuple]] = []
+        self._retry_at = 0.0
+        self._failures = 0
+
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.retries = 0
+
+    # ---------- запись событий ----------
+
+    def log_attempt(self, email: str, license_key: str, success: bool,
+                    ip_address: str = None, user_agent: str = None):
+        masked_key = (license_key or "")[:8] + "..."
+        attempt_time = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+        self._enqueue("attempt", (email, masked_key, bool(success), ip_address,
+                                  user_agent, attempt_time))
+
+    def record_login(self, user_id: int):
+        self._enqueue("login", (datetime.now().isoformat(), user_id))
+
+    def _enqueue(self, kind: str, params: tuple):
+        self._ensure_started()
+        item = (kind, params)
+        try:
+            self._queue.put_nowait(item)
+            return
+        except queue.Full:
+            # буфер полон — будим писателя и даём ему немного времени
+            self._wakeup.set()
+        try:
+            self._queue.put(item, timeout=ENQUEUE_TIMEOUT_SEC)
+        except queue.Full:
+            self.dropped += 1
+            print(f"⚠️ Auth audit buffer full, event dropped ({kind})")
+
+    # ---------- фоновый сброс ----------
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="auth-audit-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def _drain(self) -> List[Tuple[str, tuple]]:
+        items = []
+        while True:
+            try:
+                items.append(self._queue.get_nowait())
+            except queue.Empty:
+                return items
+
+    def flush(self, force: bool = False) -> int:
+        """
+        Записать всё накопленное (и пачку на повтор) одной транзакцией.
+        force — не ждать паузы после неудачи (shutdown). Возвращает число событий.
+        """
+        with self._flush_lock:
+            if self._retry and not force and time.monotonic() < self._retry_at:
+                return 0
+            items = self._retry + self._drain()
+            self._retry = []
+            if not items:
+                return 0
+
+            attempts = [p for kind, p in items if kind == "attempt"]
+            logins = [p for kind, p in items if kind == "login"]
+            try:
+                with get_connection() as con:
+                    if attempts:
+                        con.executemany(_INSERT_ATTEMPT, attempts)
+                    if logins:
+                        con.executemany(_UPDATE_LAST_LOGIN, logins)
+            except Exception as e:
+                self._failures += 1
+                if self._failures > FLUSH_MAX_RETRIES:
+                    self._failures = 0
+                    self.dropped += len(items)
+                    print(f"❌ Auth audit flush failed ({len(items)} events lost): {e}")
+                    return 0
+                self._retry = items
+                delay = min(self.flush_interval * 2 ** self._failures, FLUSH_BACKOFF_MAX_SEC)
+                self._retry_at = time.monotonic() + delay
+                self.retries += 1
+                print(f"⚠️ Auth audit flush failed, retry in {delay:.1f}s ({len(items)} events): {e}")
+                return 0
+
+            self._failures = 0
+            self.written += len(items)
+            self.flushes += 1
+            return len(items)
+
+    def shutdown(self):
+        """Остановить поток и сбросить остаток буфера (shutdown / atexit)."""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self.flush(force=True)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "pending": self._queue.qsize(),
+            "retry_pending": len(self._retry),
+            "written": self.written,
+            "dropped": self.dropped,
+            "flushes": self.flushes,
+            "retries": self.retries,
+            "flush_interval_sec": self.flush_interval,
+        }
+
+
+# Глобальный экземпляр
+auth_audit = AuthAuditWriter()
+atexit.register(auth_audit.shutdown)
+metrics.register_gauge("auth_audit", auth_audit.get_stats)
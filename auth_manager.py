@@ -2,6 +2,7 @@
 
 import sqlite3
 import hashlib
+import hmac
 import secrets
 import os
 import re
@@ -9,6 +10,10 @@ from datetime import datetime, timedelta
 from typing import Dict, Any, List, Optional, Tuple
 from cryptography.fernet import Fernet
 import base64
+from storage import get_connection, init_storage, register_function, fetch_auth_stats
+from auth_audit import auth_audit
+from pii_cache import DecryptedFieldCache
+import metrics
 
 # --- Admin config (from ENV) ---
 ADMIN_EMAIL = (os.getenv("ADMIN_EMAIL", "").strip().lower() or "")
@@ -24,62 +29,22 @@ class AuthManager:
         self.key = hashlib.sha256(secret.encode()).digest()
         self.fernet = Fernet(base64.urlsafe_b64encode(self.key))
 
-        self.db_path = 'profitpal_auth.db'
-        self.init_database()
-        print("✅ Auth Manager initialized")
+        # Отдельный ключ для blind index email (детерминированный HMAC)
+        index_secret = os.getenv('EMAIL_INDEX_KEY', '')
+        if index_secret:
+            self.index_key = hashlib.sha256(index_secret.encode()).digest()
+        else:
+            self.index_key = hmac.new(self.key, b'profitpal-email-blind-index', hashlib.sha256).digest()
 
-    def init_database(self):
-        """Инициализация базы данных аутентификации"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
-        # Таблица пользователей с зашифрованными данными
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                encrypted_email TEXT UNIQUE NOT NULL,
-                encrypted_full_name TEXT NOT NULL,
-                license_key TEXT UNIQUE NOT NULL,
-                stripe_customer_id TEXT,
-                payment_status TEXT DEFAULT 'completed',
-                card_last4 TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_login TIMESTAMP,
-                login_count INTEGER DEFAULT 0,
-                is_active BOOLEAN DEFAULT 1
-            )
-        ''')
-
-        # Таблица сессий для безопасности
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_sessions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                session_token TEXT UNIQUE NOT NULL,
-                expires_at TIMESTAMP NOT NULL,
-                ip_address TEXT,
-                user_agent TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (id)
-            )
-        ''')
-
-        # Таблица попыток входа (для безопасности)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS login_attempts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                email TEXT,
-                license_key TEXT,
-                success BOOLEAN,
-                ip_address TEXT,
-                user_agent TEXT,
-                attempt_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        # Расшифрованные email/имя по (user_id, поле), см. pii_cache.py
+        self.pii_cache = DecryptedFieldCache()
 
-        conn.commit()
-        conn.close()
-        print("✅ Auth database initialized")
+        # Схемы живут в storage.py; здесь только регистрируем расшифровку email
+        # для кросс-хранилищных запросов (users.encrypted_email -> referrals.user_email)
+        init_storage()
+        register_function("pp_user_email", 1, self.decrypt_data)
+        self.backfill_email_index()
+        print("✅ Auth Manager initialized")
 
     def encrypt_data(self, data: str) -> str:
         """Шифрование чувствительных данных"""
@@ -96,6 +61,55 @@ class AuthManager:
         except:
             return None
 
+    def decrypt_user_field(self, user_id: int, field: str, encrypted_data: str) -> Optional[str]:
+        """Расшифровка поля пользователя через кэш (ключ — user_id + хэш шифротекста)"""
+        return self.pii_cache.get_or_decrypt(user_id, field, encrypted_data, self.decrypt_data)
+
+    def email_index(self, email: str) -> str:
+        """Blind index: HMAC-SHA256 от нормализованного email (для поиска по равенству)"""
+        normalized = (email or "").strip().lower()
+        return hmac.new(self.index_key, normalized.encode(), hashlib.sha256).hexdigest()
+
+    def backfill_email_index(self, batch_size: int = 500) -> int:
+        """Заполнить users.email_bidx для старых строк (пачками, идемпотентно)"""
+        total = 0
+        last_id = 0
+        while True:
+            with get_connection() as conn:
+                rows = conn.execute(
+                    "SELECT id, encrypted_email FROM users "
+                    "WHERE email_bidx IS NULL AND id > ? ORDER BY id LIMIT ?",
+                    (last_id, batch_size),
+                ).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+
+            updates = []
+            for user_id, encrypted_email in rows:
+                email = self.decrypt_data(encrypted_email)
+                if email:
+                    updates.append((self.email_index(email), user_id))
+
+            try:
+                with get_connection() as conn:
+                    conn.executemany("UPDATE users SET email_bidx = ? WHERE id = ?", updates)
+                total += len(updates)
+            except sqlite3.IntegrityError:
+                # дубликаты email (Fernet не детерминирован, UNIQUE их не ловил):
+                # индексируем первую запись, остальные оставляем NULL
+                for params in updates:
+                    try:
+                        with get_connection() as conn:
+                            conn.execute("UPDATE users SET email_bidx = ? WHERE id = ?", params)
+                        total += 1
+                    except sqlite3.IntegrityError:
+                        print(f"⚠️ Duplicate email for user {params[1]}, blind index skipped")
+
+        if total:
+            print(f"🔎 Email blind index backfilled for {total} users")
+        return total
+
     def generate_license_key(self, email: str, full_name: str) -> str:
         """Генерация уникального лицензионного ключа"""
 
@@ -119,7 +133,7 @@ class AuthManager:
                    card_last4: str = None) -> Dict[str, Any]:
         """Создание нового пользователя после успешной оплаты"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = get_connection()
             cursor = conn.cursor()
 
             # Проверяем, не существует ли уже пользователь с таким email
@@ -141,15 +155,16 @@ class AuthManager:
             # Сохраняем пользователя
             cursor.execute('''
                 INSERT INTO users 
-                (encrypted_email, encrypted_full_name, license_key, stripe_customer_id, 
+                (encrypted_email, email_bidx, encrypted_full_name, license_key, stripe_customer_id, 
                  card_last4, payment_status, created_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (encrypted_email, encrypted_name, license_key, stripe_customer_id,
-                  card_last4, 'completed', datetime.now().isoformat()))
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (encrypted_email, self.email_index(email), encrypted_name, license_key,
+                  stripe_customer_id, card_last4, 'completed', datetime.now().isoformat()))
 
             user_id = cursor.lastrowid
             conn.commit()
             conn.close()
+            self.pii_cache.invalidate_user(user_id)
 
             print(f"✅ User created: {email} → {license_key}")
 
@@ -170,91 +185,120 @@ class AuthManager:
             }
 
     def get_user_by_email(self, email: str):
-        """Возвращает dict с id/email/... или None. Никаких NameError."""
+        """Возвращает dict с id/email/... или None. Один индексный поиск по email_bidx."""
         try:
-            enc = self.encrypt(email)
-            with sqlite3.connect(self.db_path) as conn:
+            with get_connection() as conn:
                 conn.row_factory = sqlite3.Row
-                cur = conn.cursor()
-                row = cur.execute(
-                    "SELECT id, license_key, is_active, payment_status FROM users WHERE encrypted_email = ? LIMIT 1",
-                    (enc,),
+                row = conn.execute(
+                    '''
+                    SELECT id, encrypted_full_name, license_key, stripe_customer_id,
+                           is_active, payment_status, last_login, login_count
+                    FROM users WHERE email_bidx = ? LIMIT 1
+                    ''',
+                    (self.email_index(email),),
                 ).fetchone()
-                if not row:
-                    return None
-                # Расшифровку full_name можешь добавить, если нужно
-                return {
-                    "id": row["id"],
-                    "email": email,
-                    "license_key": row["license_key"],
-                    "is_active": row["is_active"],
-                    "payment_status": (row["payment_status"] if "payment_status" in row.keys() else None),
-                }
+            if not row:
+                return None
+            return {
+                "id": row["id"],
+                "email": (email or "").strip().lower(),
+                "full_name": self.decrypt_user_field(row["id"], "full_name", row["encrypted_full_name"]),
+                "license_key": row["license_key"],
+                "stripe_customer_id": row["stripe_customer_id"],
+                "is_active": row["is_active"],
+                "payment_status": row["payment_status"],
+                "last_login": row["last_login"],
+                "login_count": row["login_count"],
+            }
         except Exception as e:
             print(f"[auth_manager.get_user_by_email] error: {e}")
             return None
 
+    def get_user_contact(self, user_id) -> Optional[Dict[str, str]]:
+        """{'email', 'full_name'} по id пользователя (для уведомлений) или None."""
+        try:
+            user_id = int(user_id)
+        except (TypeError, ValueError):
+            return None
+        try:
+            with get_connection() as conn:
+                row = conn.execute(
+                    "SELECT encrypted_email, encrypted_full_name FROM users WHERE id = ? AND is_active = 1",
+                    (user_id,),
+                ).fetchone()
+            if not row:
+                return None
+            return {
+                "email": self.decrypt_user_field(user_id, "email", row[0]),
+                "full_name": self.decrypt_user_field(user_id, "full_name", row[1]),
+            }
+        except Exception as e:
+            print(f"[auth_manager.get_user_contact] error: {e}")
+            return None
 
-    def validate_credentials(self, email: str, license_key: str) -> Dict[str, Any]:
+    def validate_credentials(self, email: str, license_key: str,
+                             ip_address: str = None, user_agent: str = None) -> Dict[str, Any]:
         """🎯 ГЛАВНАЯ ФУНКЦИЯ: Проверка email + license и возврат имени для подсветки"""
         try:
-            # Логируем попытку входа
-            self.log_login_attempt(email, license_key, False)
-
-            # Получаем пользователя по email
-            user = self.get_user_by_email(email)
-
-            if not user:
-                return {
-                    "valid": False,
-                    "error": "User not found",
-                    "show_name": False
-                }
+            result = self._check_credentials(email, license_key)
+        except Exception as e:
+            print(f"❌ Error validating credentials: {e}")
+            result = {
+                "valid": False,
+                "error": "Validation failed",
+                "show_name": False
+            }
 
-            # Проверяем license key
-            if user['license_key'] != license_key.strip().upper():
-                return {
-                    "valid": False,
-                    "error": "Invalid license key",
-                    "show_name": False
-                }
+        # Одна запись на попытку, уже с итогом (write-behind, см. auth_audit.py)
+        self.log_login_attempt(email, license_key, result["valid"], ip_address, user_agent)
+        return result
 
-            # Проверяем статус оплаты
-            if user['payment_status'] != 'completed':
-                return {
-                    "valid": False,
-                    "error": "Payment not completed",
-                    "show_name": False
-                }
+    def _check_credentials(self, email: str, license_key: str) -> Dict[str, Any]:
+        """Сама проверка email + license (без логирования)"""
+        # Получаем пользователя по email
+        user = self.get_user_by_email(email)
 
-            # ✅ ВСЕ ПРОВЕРКИ ПРОЙДЕНЫ - ВОЗВРАЩАЕМ ИМЯ ДЛЯ ПОДСВЕТКИ
-            self.log_login_attempt(email, license_key, True)
+        if not user:
+            return {
+                "valid": False,
+                "error": "User not found",
+                "show_name": False
+            }
 
+        # Проверяем license key
+        if user['license_key'] != license_key.strip().upper():
             return {
-                "valid": True,
-                "show_name": True,
-                "full_name": user['full_name'],
-                "email": user['email'],
-                "license_key": user['license_key'],
-                "user_id": user['id'],
-                "last_login": user['last_login'],
-                "login_count": user['login_count']
+                "valid": False,
+                "error": "Invalid license key",
+                "show_name": False
             }
 
-        except Exception as e:
-            print(f"❌ Error validating credentials: {e}")
+        # Проверяем статус оплаты
+        if user['payment_status'] != 'completed':
             return {
                 "valid": False,
-                "error": "Validation failed",
+                "error": "Payment not completed",
                 "show_name": False
             }
 
+        # ✅ ВСЕ ПРОВЕРКИ ПРОЙДЕНЫ - ВОЗВРАЩАЕМ ИМЯ ДЛЯ ПОДСВЕТКИ
+        return {
+            "valid": True,
+            "show_name": True,
+            "full_name": user['full_name'],
+            "email": user['email'],
+            "license_key": user['license_key'],
+            "user_id": user['id'],
+            "last_login": user['last_login'],
+            "login_count": user['login_count']
+        }
+
     def authenticate_user(self, email: str, license_key: str, full_name: str = None, 
                          ip_address: str = None, user_agent: str = None) -> Dict[str, Any]:
         """Полная аутентификация пользователя с созданием сессии"""
         try:
             # Сначала валидируем credentials
-            validation = self.validate_credentials(email, license_key)
+            validation = self.validate_credentials(email, license_key, ip_address, user_agent)
 
             if not validation['valid']:
                 return validation
@@ -295,7 +339,7 @@ class AuthManager:
                       user_agent: str = None) -> str:
         """Создание пользовательской сессии"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = get_connection()
             cursor = conn.cursor()
 
             # Генерируем уникальный токен сессии
@@ -322,11 +366,12 @@ class AuthManager:
     def validate_session(self, session_token: str) -> Optional[Dict[str, Any]]:
         """Проверка валидности сессии"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = get_connection()
             cursor = conn.cursor()
 
             cursor.execute('''
-                SELECT s.*, u.encrypted_email, u.encrypted_full_name, u.license_key
+                SELECT s.id, s.user_id, s.expires_at,
+                       u.encrypted_email, u.encrypted_full_name, u.license_key
                 FROM user_sessions s
                 JOIN users u ON s.user_id = u.id
                 WHERE s.session_token = ? AND s.expires_at > ? AND u.is_active = 1
@@ -339,10 +384,10 @@ class AuthManager:
                 return {
                     'session_id': row[0],
                     'user_id': row[1],
-                    'email': self.decrypt_data(row[6]),
-                    'full_name': self.decrypt_data(row[7]),
-                    'license_key': row[8],
-                    'expires_at': row[3]
+                    'email': self.decrypt_user_field(row[1], 'email', row[3]),
+                    'full_name': self.decrypt_user_field(row[1], 'full_name', row[4]),
+                    'license_key': row[5],
+                    'expires_at': row[2]
                 }
 
             return None
@@ -352,73 +397,18 @@ class AuthManager:
             return None
 
     def update_last_login(self, user_id: int):
-        """Обновление времени последнего входа"""
-        try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-
-            cursor.execute('''
-                UPDATE users 
-                SET last_login = ?, login_count = login_count + 1
-                WHERE id = ?
-            ''', (datetime.now().isoformat(), user_id))
-
-            conn.commit()
-            conn.close()
-
-        except Exception as e:
-            print(f"❌ Error updating last login: {e}")
+        """Обновление времени последнего входа (пакетно, через auth_audit)"""
+        auth_audit.record_login(user_id)
 
     def log_login_attempt(self, email: str, license_key: str, success: bool, 
                          ip_address: str = None, user_agent: str = None):
-        """Логирование попыток входа для безопасности"""
-        try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-
-            cursor.execute('''
-                INSERT INTO login_attempts 
-                (email, license_key, success, ip_address, user_agent)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (email, license_key[:8] + "...", success, ip_address, user_agent))
-
-            conn.commit()
-            conn.close()
-
-        except Exception as e:
-            print(f"❌ Error logging attempt: {e}")
+        """Логирование попыток входа для безопасности (пакетно, через auth_audit)"""
+        auth_audit.log_attempt(email, license_key, success, ip_address, user_agent)
 
     def get_user_stats(self) -> Dict[str, Any]:
-        """Получение статистики пользователей"""
+        """Получение статистики пользователей (из счётчиков stat_counters)"""
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-
-            # Общая статистика
-            cursor.execute('SELECT COUNT(*) FROM users WHERE is_active = 1')
-            active_users = cursor.fetchone()[0]
-
-            cursor.execute('SELECT COUNT(*) FROM users')
-            total_users = cursor.fetchone()[0]
-
-            cursor.execute('SELECT COUNT(*) FROM user_sessions WHERE expires_at > ?', 
-                          (datetime.now().isoformat(),))
-            active_sessions = cursor.fetchone()[0]
-
-            cursor.execute('SELECT COUNT(*) FROM login_attempts WHERE success = 1 AND attempt_time > ?',
-                          (datetime.now().replace(hour=0, minute=0, second=0).isoformat(),))
-            today_logins = cursor.fetchone()[0]
-
-            conn.close()
-
-            return {
-                "active_users": active_users,
-                "total_users": total_users,
-                "active_sessions": active_sessions,
-                "today_logins": today_logins,
-                "generated_at": datetime.now().isoformat()
-            }
-
+            return fetch_auth_stats()
         except Exception as e:
             print(f"❌ Error getting stats: {e}")
             return {}
@@ -430,12 +420,13 @@ class AuthManager:
             if not user:
                 return False
 
-            conn = sqlite3.connect(self.db_path)
+            conn = get_connection()
             cursor = conn.cursor()
 
             cursor.execute('UPDATE users SET is_active = 0 WHERE id = ?', (user['id'],))
             conn.commit()
             conn.close()
+            self.pii_cache.invalidate_user(user['id'])
 
             print(f"✅ User deactivated: {email}")
             return True
@@ -446,6 +437,7 @@ class AuthManager:
 
 # Глобальный экземпляр менеджера аутентификации
 auth_manager = AuthManager()
+metrics.register_gauge("pii_cache", auth_manager.pii_cache.get_stats)
 
 # ==========================================
 # ПРОСТЫЕ ФУНКЦИИ ДЛЯ ИСПОЛЬЗОВАНИЯ В MAIN.PY
@@ -6,73 +6,68 @@ import hashlib
 from cryptography.fernet import Fernet
 from datetime import datetime
 import sqlite3
-import smtplib
-from email.mime.text import MimeText
-from email.mime.multipart import MimeMultipart
 import os
 import asyncio
+import threading
+from concurrent.futures import ProcessPoolExecutor
 from typing import Optional, List, Dict
+from storage import get_connection, init_storage, ATTACHED_STORES
+import metrics
+
+# Массовая расшифровка: меньше этого числа строк — в текущем процессе
+# (запуск пула дороже), больше — пачками по DECRYPT_CHUNK_SIZE на пуле процессов
+PARALLEL_DECRYPT_MIN_ROWS = int(os.getenv("PARALLEL_DECRYPT_MIN_ROWS", "2000"))
+DECRYPT_CHUNK_SIZE = int(os.getenv("DECRYPT_CHUNK_SIZE", "500"))
+DECRYPT_WORKERS = int(os.getenv("DECRYPT_WORKERS", str(os.cpu_count() or 1)))
+
+# Fernet воркера создаётся один раз на процесс (ключ приходит с задачей)
+_worker_fernet = None
+_worker_key = None
+
+
+def _decrypt_chunk(fernet_key: bytes, tokens: List[Optional[str]]) -> List[Optional[str]]:
+    """Расшифровать пачку токенов в процессе пула. Битые/пустые -> None."""
+    global _worker_fernet, _worker_key
+    if _worker_fernet is None or _worker_key != fernet_key:
+        _worker_fernet = Fernet(fernet_key)
+        _worker_key = fernet_key
+
+    result = []
+    for token in tokens:
+        if not token:
+            result.append(None)
+            continue
+        try:
+            result.append(_worker_fernet.decrypt(token.encode()).decode())
+        except Exception:
+            result.append(None)
+    return result
+
 
 class CustomerManager:
     def __init__(self):
         # Генерируем ключ шифрования из environment variable
         secret = os.getenv('CUSTOMER_DB_SECRET', 'profitpal_denava_secret_key_2025')
         self.key = hashlib.sha256(secret.encode()).digest()
-        self.fernet = Fernet(base64.urlsafe_b64encode(self.key))
-
-        self.db_path = 'customers.db'
-        self.init_database()
-
-    def init_database(self):
-        """Инициализация базы данных клиентов"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
-        # Таблица клиентов
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS customers (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                encrypted_email TEXT UNIQUE NOT NULL,
-                encrypted_card_last4 TEXT,
-                stripe_customer_id TEXT,
-                signup_date TEXT,
-                plan_type TEXT,
-                original_setup_price REAL,
-                current_monthly_price REAL,
-                status TEXT DEFAULT 'active',
-                last_notification TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-        # Таблица уведомлений о ценах
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS price_notifications (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                notification_date TEXT,
-                old_price REAL,
-                new_price REAL,
-                customers_notified INTEGER,
-                effective_date TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-        # Таблица статистики
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS email_stats (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                email_type TEXT,
-                total_sent INTEGER,
-                successful INTEGER,
-                failed INTEGER,
-                sent_date TEXT
-            )
-        ''')
-
-        conn.commit()
-        conn.close()
-        print("✅ Customer database initialized")
+        self.fernet_key = base64.urlsafe_b64encode(self.key)
+        self.fernet = Fernet(self.fernet_key)
+
+        # Расшифрованная проекция email -> customer id (только active),
+        # строится лениво и сбрасывается при любой записи в customers.
+        # _generation растёт при каждом сбросе: перестроение, начатое до
+        # сброса, не перезапишет его своим устаревшим результатом.
+        # _index_version — PRAGMA data_version файла crm на момент построения:
+        # запись из другого воркера uvicorn меняет её, и проекция перестраивается.
+        self._email_index: Optional[Dict[str, int]] = None
+        self._index_version: Optional[int] = None
+        self._generation = 0
+        self._index_lock = threading.Lock()
+        self._version_conn: Optional[sqlite3.Connection] = None
+        self._version_lock = threading.Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+
+        init_storage()
 
     def encrypt_data(self, data: str) -> str:
         """Шифрование данных"""
@@ -86,11 +81,123 @@ class CustomerManager:
             return None
         return self.fernet.decrypt(encrypted_data.encode()).decode()
 
+    # ---------- массовая расшифровка ----------
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(max_workers=DECRYPT_WORKERS)
+        return self._executor
+
+    def bulk_decrypt(self, tokens: List[Optional[str]]) -> List[Optional[str]]:
+        """
+        Расшифровать список токенов с сохранением порядка. Пустые и битые
+        значения -> None. Большие списки режутся на пачки и уходят в пул
+        процессов, так что полный проход по таблице масштабируется по ядрам.
+        """
+        if len(tokens) < PARALLEL_DECRYPT_MIN_ROWS or DECRYPT_WORKERS < 2:
+            return _decrypt_chunk(self.fernet_key, tokens)
+
+        chunks = [tokens[i:i + DECRYPT_CHUNK_SIZE]
+                  for i in range(0, len(tokens), DECRYPT_CHUNK_SIZE)]
+        try:
+            executor = self._get_executor()
+            results = executor.map(_decrypt_chunk, [self.fernet_key] * len(chunks), chunks)
+            return [value for chunk in results for value in chunk]
+        except Exception as e:
+            print(f"⚠️  Parallel decrypt failed, falling back to single process: {e}")
+            return _decrypt_chunk(self.fernet_key, tokens)
+
+    def shutdown(self):
+        """Остановить пул процессов расшифровки"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        with self._version_lock:
+            if self._version_conn is not None:
+                self._version_conn.close()
+                self._version_conn = None
+
+    # ---------- проекция email -> id ----------
+
+    def invalidate_cache(self):
+        """Сбросить расшифрованную проекцию (после любой записи в customers)"""
+        with self._index_lock:
+            self._generation += 1
+            self._email_index = None
+
+    def _data_version(self) -> int:
+        """
+        PRAGMA data_version файла customers.db на отдельном соединении:
+        меняется после коммита любого другого соединения, в том числе из
+        другого процесса. Дёшево — без чтения таблиц.
+        """
+        with self._version_lock:
+            if self._version_conn is None:
+                self._version_conn = sqlite3.connect(ATTACHED_STORES["crm"], check_same_thread=False)
+            return self._version_conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def _install_index(self, index: Dict[str, int], generation: int, version: int):
+        """Поставить проекцию, только если с начала построения не было сброса (под _index_lock)."""
+        if generation == self._generation:
+            self._email_index = index
+            self._index_version = version
+
+    def _get_email_index(self) -> Dict[str, int]:
+        version = self._data_version()
+        index = self._email_index
+        if index is not None and self._index_version == version:
+            metrics.inc("customers.index_hit")
+            return index
+
+        with self._index_lock:
+            if self._email_index is not None and self._index_version == version:
+                return self._email_index
+            metrics.inc("customers.index_rebuild")
+            # версию берём ДО чтения: запись между ними даст лишнее перестроение, а не устаревший индекс
+            version = self._data_version()
+            conn = get_connection()
+            try:
+                rows = conn.execute(
+                    'SELECT id, encrypted_email FROM customers WHERE status = "active"'
+                ).fetchall()
+            finally:
+                conn.close()
+            emails = self.bulk_decrypt([row[1] for row in rows])
+            index = {email: row[0] for row, email in zip(rows, emails) if email is not None}
+            self._install_index(index, self._generation, version)
+            return index
+
+    def _row_to_customer(self, row, email: str, card_last4: Optional[str]) -> Dict:
+        return {
+            'id': row[0],
+            'email': email,
+            'card_last4': card_last4,
+            'stripe_customer_id': row[3],
+            'signup_date': row[4],
+            'plan_type': row[5],
+            'original_setup_price': row[6],
+            'current_monthly_price': row[7],
+            'status': row[8],
+            'last_notification': row[9]
+        }
+
+    def get_index_stats(self) -> Dict:
+        index = self._email_index
+        return {
+            'cached_emails': len(index) if index is not None else None,
+            'generation': self._generation,
+            'parallel_min_rows': PARALLEL_DECRYPT_MIN_ROWS,
+            'chunk_size': DECRYPT_CHUNK_SIZE,
+            'workers': DECRYPT_WORKERS,
+        }
+
     def add_customer(self, email: str, stripe_customer_id: str = None, 
                     card_last4: str = None, plan_type: str = "lifetime", 
                     setup_price: float = 24.99, monthly_price: float = 4.99):
         """Добавление нового клиента"""
-        conn = sqlite3.connect(self.db_path)
+        conn = get_connection()
         cursor = conn.cursor()
 
         encrypted_email = self.encrypt_data(email)
@@ -106,6 +213,7 @@ class CustomerManager:
                   datetime.now().isoformat(), plan_type, setup_price, monthly_price, 'active'))
 
             conn.commit()
+            self.invalidate_cache()
             print(f"✅ Customer added: {email}")
             return True
 
@@ -117,69 +225,60 @@ class CustomerManager:
 
     def get_customer_by_email(self, email: str) -> Optional[Dict]:
         """Получение клиента по email"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
-        # Нужно проверить все записи, так как email зашифрован
-        cursor.execute('SELECT * FROM customers WHERE status = "active"')
+        # email зашифрован — ищем id в расшифрованной проекции, строку берём по PK
+        customer_id = self._get_email_index().get(email)
+        if customer_id is None:
+            return None
 
-        for row in cursor.fetchall():
-            try:
-                decrypted_email = self.decrypt_data(row[1])
-                if decrypted_email == email:
-                    customer = {
-                        'id': row[0],
-                        'email': decrypted_email,
-                        'card_last4': self.decrypt_data(row[2]) if row[2] else None,
-                        'stripe_customer_id': row[3],
-                        'signup_date': row[4],
-                        'plan_type': row[5], 
-                        'original_setup_price': row[6],
-                        'current_monthly_price': row[7],
-                        'status': row[8],
-                        'last_notification': row[9]
-                    }
-                    conn.close()
-                    return customer
-            except:
-                continue
+        conn = get_connection()
+        try:
+            row = conn.execute(
+                'SELECT * FROM customers WHERE id = ? AND status = "active"', (customer_id,)
+            ).fetchone()
+        finally:
+            conn.close()
 
-        conn.close()
-        return None
+        if not row:
+            # строку изменили в обход менеджера — перечитаем проекцию в следующий раз
+            self.invalidate_cache()
+            return None
+        try:
+            card_last4 = self.decrypt_data(row[2]) if row[2] else None
+        except Exception:
+            card_last4 = None
+        return self._row_to_customer(row, email, card_last4)
 
     def get_all_active_customers(self) -> List[Dict]:
         """Получение всех активных клиентов"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+        with self._index_lock:
+            generation = self._generation
+        version = self._data_version()
+        conn = get_connection()
+        try:
+            rows = conn.execute('SELECT * FROM customers WHERE status = "active"').fetchall()
+        finally:
+            conn.close()
 
-        cursor.execute('SELECT * FROM customers WHERE status = "active"')
-        customers = []
+        # email и карты — одним списком, чтобы пул получил полные пачки
+        decrypted = self.bulk_decrypt([row[1] for row in rows] + [row[2] for row in rows])
+        emails, cards = decrypted[:len(rows)], decrypted[len(rows):]
 
-        for row in cursor.fetchall():
-            try:
-                customer = {
-                    'id': row[0],
-                    'email': self.decrypt_data(row[1]),
-                    'card_last4': self.decrypt_data(row[2]) if row[2] else None,
-                    'stripe_customer_id': row[3],
-                    'signup_date': row[4],
-                    'plan_type': row[5],
-                    'original_setup_price': row[6],
-                    'current_monthly_price': row[7],
-                    'status': row[8],
-                    'last_notification': row[9]
-                }
-                customers.append(customer)
-            except Exception as e:
-                print(f"⚠️  Error decrypting customer data: {e}")
+        customers = []
+        for row, email, card_last4 in zip(rows, emails, cards):
+            if email is None:
+                print(f"⚠️  Error decrypting customer data: id={row[0]}")
                 continue
+            customers.append(self._row_to_customer(row, email, card_last4))
 
-        conn.close()
+        # полный проход уже расшифровал всё — заодно обновим проекцию
+        # (если за время прохода проекцию сбросили — не перезаписываем сброс)
+        with self._index_lock:
+            self._install_index({c['email']: c['id'] for c in customers}, generation, version)
         return customers
 
     def get_customer_stats(self) -> Dict:
         """Получение статистики клиентов"""
-        conn = sqlite3.connect(self.db_path)
+        conn = get_connection()
         cursor = conn.cursor()
 
         # Общая статистика
@@ -203,6 +302,7 @@ class CustomerManager:
 
 # Глобальный экземпляр менеджера клиентов
 customer_manager = CustomerManager()
+metrics.register_gauge("customer_index", customer_manager.get_index_stats)
 
 # Функции для простого использования в main.py
 def add_new_customer(email: str, stripe_customer_id: str = None, card_last4: str = None):
@@ -211,7 +311,11 @@ def add_new_customer(email: str, stripe_customer_id: str = None, card_last4: str
 
 def get_customer_count() -> int:
     """Получение количества активных клиентов"""
-    return len(customer_manager.get_all_active_customers())
+    conn = get_connection()
+    try:
+        return conn.execute('SELECT COUNT(*) FROM customers WHERE status = "active"').fetchone()[0]
+    finally:
+        conn.close()
 
 def customer_exists(email: str) -> bool:
     """Проверка существования клиента"""
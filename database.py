@@ -1,63 +1,94 @@
 import sqlite3
 from datetime import datetime
 import json
+from storage import get_connection, init_storage
+from portfolio_engine import apply_transaction, refresh_position, normalize_symbol, ensure_positions
 
 def init_db():
-    conn = sqlite3.connect('profitpal.db')
-    c = conn.cursor()
-
-    # Таблица для Trading Journal
-    c.execute('''CREATE TABLE IF NOT EXISTS transactions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id TEXT NOT NULL,
-        date DATE NOT NULL,
-        type TEXT NOT NULL,
-        symbol TEXT NOT NULL,
-        action TEXT NOT NULL,
-        quantity INTEGER NOT NULL,
-        price REAL NOT NULL,
-        commission REAL DEFAULT 0,
-        notes TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )''')
-
-    # Таблица для Watchlist
-    c.execute('''CREATE TABLE IF NOT EXISTS watchlist (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id TEXT NOT NULL,
-        symbol TEXT NOT NULL,
-        added_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        UNIQUE(user_id, symbol)
-    )''')
-
-    conn.commit()
-    conn.close()
+    # Прогоняет недостающие миграции (migrations.py) для всех хранилищ,
+    # затем заполняет journal.positions, если таблица пуста при непустом журнале
+    init_storage()
+    ensure_positions()
 
 # Функции для Trading Journal
 def add_transaction(user_id, data):
-    conn = sqlite3.connect('profitpal.db')
-    c = conn.cursor()
-    c.execute('''INSERT INTO transactions 
-                 (user_id, date, type, symbol, action, quantity, price, commission, notes)
-                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-              (user_id, data['date'], data['type'], data['symbol'], 
-               data['action'], data['quantity'], data['price'], 
-               data['commission'], data.get('notes', '')))
-    conn.commit()
-    conn.close()
+    """Записать сделку и обновить journal.positions в той же транзакции."""
+    data = dict(data, symbol=normalize_symbol(data['symbol']))
+    with get_connection() as conn:
+        # отложенная транзакция: первая же запись (INSERT) блокирует только
+        # journal, а не все прикреплённые хранилища, как BEGIN IMMEDIATE
+        conn.execute('BEGIN')
+        c = conn.cursor()
+        c.execute('''INSERT INTO transactions 
+                     (user_id, date, type, symbol, action, quantity, price, commission, notes)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                  (user_id, data['date'], data['type'], data['symbol'], 
+                   data['action'], data['quantity'], data['price'], 
+                   data['commission'], data.get('notes', '')))
+        apply_transaction(conn, user_id, c.lastrowid, data)
     return c.lastrowid
 
-def get_transactions(user_id):
-    conn = sqlite3.connect('profitpal.db')
-    c = conn.cursor()
-    c.execute('SELECT * FROM transactions WHERE user_id = ? ORDER BY date DESC', (user_id,))
-    transactions = c.fetchall()
+TRANSACTION_COLUMNS = ('id', 'user_id', 'date', 'type', 'symbol', 'action',
+                       'quantity', 'price', 'commission', 'notes', 'created_at')
+
+def transaction_filters(user_id, tx_type=None, symbol=None, date_from=None, date_to=None):
+    """WHERE-условия журнала (список + параметры) — общие для страниц и экспорта."""
+    where = ['user_id = ?']
+    params = [user_id]
+    if tx_type:
+        where.append('type = ?')
+        params.append(tx_type)
+    if symbol:
+        # символы в журнале уже в верхнем регистре (normalize_symbol, миграция 9):
+        # сравнение без NOCASE идёт по индексу (user_id, symbol, date, id)
+        where.append('symbol = ?')
+        params.append(normalize_symbol(symbol))
+    if date_from:
+        where.append('date >= ?')
+        params.append(date_from)
+    if date_to:
+        where.append('date <= ?')
+        params.append(date_to)
+    return where, params
+
+def get_transactions(user_id, limit=100, cursor=None, tx_type=None, symbol=None,
+                     date_from=None, date_to=None):
+    """
+    Страница журнала, новые сверху. Keyset-пагинация по (date, id) через
+    индекс (user_id, date, id): cursor — это "date|id" последней строки
+    предыдущей страницы, поэтому цена страницы не зависит от её номера.
+    Возвращает {"transactions": [dict, ...], "next_cursor": str | None}.
+    """
+    limit = max(1, min(int(limit or 100), 500))
+    where, params = transaction_filters(user_id, tx_type, symbol, date_from, date_to)
+    if cursor:
+        cursor_date, _, cursor_id = cursor.rpartition('|')
+        where.append('(date, id) < (?, ?)')
+        params.extend([cursor_date, int(cursor_id)])
+
+    conn = get_connection()
+    conn.row_factory = sqlite3.Row
+    rows = conn.execute(
+        f"SELECT {', '.join(TRANSACTION_COLUMNS)} FROM transactions "
+        f"WHERE {' AND '.join(where)} ORDER BY date DESC, id DESC LIMIT ?",
+        (*params, limit + 1),
+    ).fetchall()
     conn.close()
-    return transactions
+
+    transactions = [dict(row) for row in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        last = transactions[-1]
+        next_cursor = f"{last['date']}|{last['id']}"
+    return {"transactions": transactions, "next_cursor": next_cursor}
 
 def delete_transaction(user_id, transaction_id):
-    conn = sqlite3.connect('profitpal.db')
-    c = conn.cursor()
-    c.execute('DELETE FROM transactions WHERE user_id = ? AND id = ?', (user_id, transaction_id))
-    conn.commit()
-    conn.close()
\ No newline at end of file
+    """Удалить сделку и пересчитать её позицию в той же транзакции."""
+    with get_connection() as conn:
+        # первая команда — запись в journal (см. add_transaction)
+        conn.execute('BEGIN')
+        row = conn.execute('DELETE FROM transactions WHERE user_id = ? AND id = ? RETURNING type, symbol',
+                           (user_id, transaction_id)).fetchone()
+        if row is None:
+            return
+        refresh_position(conn, user_id, row[0], row[1])
\ No newline at end of file
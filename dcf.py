@@ -0,0 +1,255 @@
+# dcf.py - DCF на акцию + Монте-Карло по допущениям
+#
+# Модель (на акцию):
+#
+#   FCF_t  = FCF_0 * (1 + g)^t,  t = 1..DCF_YEARS
+#   EV     = sum FCF_t / (1 + r)^t  +  FCF_N * M / (1 + r)^N   (выход по мультипликатору M к FCF)
+#   value  = (EV + чистые деньги) / акции (diluted)
+#
+# FCF_0 — последний годовой free cash flow, g — CAGR FCF за историю отчётов
+# (если FCF на концах не положительный — CAGR выручки, иначе DEFAULT_GROWTH),
+# обрезанный в разумные пределы. Сумма по годам — в замкнутом виде
+# (геометрическая прогрессия по q = (1+g)/(1+r)), поэтому dcf_value
+# принимает массивы g / r / M любой совместимой формы: одна точка,
+# MC_DRAWS сценариев Монте-Карло или сетка ставка x рост (broadcasting).
+#
+# Монте-Карло: g ~ N(g0, GROWTH_SIGMA), r ~ N(r0, DISCOUNT_SIGMA),
+# M ~ lognormal вокруг M0; перцентили стоимости и доля сценариев выше цены.
+# 100k сценариев — несколько миллисекунд, считается прямо в /analyze.
+#
+# Сетка сценариев (scenario_grid) — та же dcf_value по осям ставка x рост
+# через broadcasting, плюс ставка безубыточности (стоимость = цена) для
+# каждого темпа роста.
+#
+# Входы (fundamentals) кэшируются по тикеру: сетка сценариев и повторный
+# анализ не ходят в FMP. Тикеры, для которых DCF неприменим (нет
+# положительного FCF / числа акций), тоже запоминаются — на
+# FUNDAMENTALS_NA_TTL_SEC, короче обычного: пустой ответ мог быть и сбоем FMP.
+
+import os
+import time
+import zlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+import metrics
+
+DCF_YEARS = int(os.getenv("DCF_YEARS", "5"))
+DISCOUNT_RATE = float(os.getenv("DCF_DISCOUNT_RATE", "0.09"))
+TERMINAL_MULTIPLE = float(os.getenv("DCF_TERMINAL_MULTIPLE", "15"))
+DEFAULT_GROWTH = 0.05
+GROWTH_BOUNDS = (-0.10, 0.25)
+
+MC_DRAWS = int(os.getenv("DCF_MC_DRAWS", "100000"))
+GROWTH_SIGMA = 0.04
+DISCOUNT_SIGMA = 0.015
+MULTIPLE_SIGMA = 0.25          # лог-стандартное отклонение мультипликатора
+DISCOUNT_BOUNDS = (0.04, 0.20)
+PERCENTILES = (5, 10, 25, 50, 75, 90, 95)
+
+# пределы осей сетки из запроса: за ними стоимость уходит в inf/nan (не JSON)
+GRID_GROWTH_BOUNDS = (-0.5, 1.0)
+GRID_DISCOUNT_BOUNDS = (0.001, 1.0)
+GRID_MAX_MULTIPLE = 100.0
+
+FUNDAMENTALS_TTL_SEC = int(os.getenv("DCF_FUNDAMENTALS_TTL", str(6 * 3600)))
+FUNDAMENTALS_NA_TTL_SEC = int(os.getenv("DCF_FUNDAMENTALS_NA_TTL", "3600"))
+FUNDAMENTALS_MAX_ENTRIES = 2048
+
+
+def _value(data: Optional[Dict], field: str) -> Optional[float]:
+    if not data or data.get(field) is None:
+        return None
+    try:
+        return float(data[field])
+    except (TypeError, ValueError):
+        return None
+
+
+def _cagr(values: List[Optional[float]]) -> Optional[float]:
+    """CAGR от самого старого к самому свежему (values — от новых к старым)."""
+    values = [v for v in values if v is not None]
+    if len(values) < 2 or values[0] <= 0 or values[-1] <= 0:
+        return None
+    return (values[0] / values[-1]) ** (1.0 / (len(values) - 1)) - 1.0
+
+
+def build_inputs(cash_flows: List[Dict], incomes: List[Dict],
+                 balance_sheet: Optional[Dict]) -> Optional[Dict[str, Any]]:
+    """
+    Входы DCF из годовых отчётов FMP (списки от свежих к старым).
+    None — нет положительного FCF или числа акций (DCF неприменим).
+    """
+    if not cash_flows or not incomes:
+        return None
+    fcf = _value(cash_flows[0], "freeCashFlow")
+    shares = _value(incomes[0], "weightedAverageShsOutDil") or _value(incomes[0], "weightedAverageShsOut")
+    if not fcf or fcf <= 0 or not shares or shares <= 0:
+        return None
+
+    growth, source = _cagr([_value(cf, "freeCashFlow") for cf in cash_flows]), "fcf_cagr"
+    if growth is None:
+        growth, source = _cagr([_value(i, "revenue") for i in incomes]), "revenue_cagr"
+    if growth is None:
+        growth, source = DEFAULT_GROWTH, "default"
+
+    cash = _value(balance_sheet, "cashAndShortTermInvestments") or _value(balance_sheet, "cashAndCashEquivalents") or 0.0
+    debt = _value(balance_sheet, "totalDebt") or 0.0
+    return {
+        "fcf": fcf,
+        "shares": shares,
+        "net_cash": cash - debt,
+        "growth": float(np.clip(growth, *GROWTH_BOUNDS)),
+        "growth_source": source,
+        "history_years": len(cash_flows),
+        "discount_rate": DISCOUNT_RATE,
+        "terminal_multiple": TERMINAL_MULTIPLE,
+        "years": DCF_YEARS,
+        "fiscal_date": cash_flows[0].get("date"),
+    }
+
+
+def dcf_value(inputs: Dict[str, Any], growth, discount, multiple=None) -> np.ndarray:
+    """Стоимость на акцию; growth / discount / multiple — числа или массивы совместимой формы."""
+    n = inputs["years"]
+    growth = np.asarray(growth, dtype=np.float64)
+    discount = np.asarray(discount, dtype=np.float64)
+    multiple = np.asarray(inputs["terminal_multiple"] if multiple is None else multiple, dtype=np.float64)
+
+    q = (1.0 + growth) / (1.0 + discount)
+    qn = q ** n
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # sum_{t=1..n} q^t; при q ~ 1 — просто n
+        annuity = np.where(np.abs(1.0 - q) < 1e-12, float(n), q * (1.0 - qn) / (1.0 - q))
+    terminal = qn * multiple
+    return (inputs["fcf"] * (annuity + terminal) + inputs["net_cash"]) / inputs["shares"]
+
+
+def monte_carlo(inputs: Dict[str, Any], price: Optional[float] = None,
+                draws: int = MC_DRAWS, seed: Optional[int] = None) -> Dict[str, Any]:
+    """Перцентили стоимости на акцию по draws сценариям (все сразу, без цикла)."""
+    started = time.perf_counter()
+    # фиксированный seed на тикер/отчёт: одинаковые входы -> одинаковые полосы
+    if seed is None:
+        seed = zlib.crc32(f"{inputs['fcf']}:{inputs['shares']}:{inputs['fiscal_date']}".encode())
+    rng = np.random.default_rng(seed)
+
+    growth = np.clip(rng.normal(inputs["growth"], GROWTH_SIGMA, draws), -0.5, 0.6)
+    discount = np.clip(rng.normal(inputs["discount_rate"], DISCOUNT_SIGMA, draws), *DISCOUNT_BOUNDS)
+    multiple = inputs["terminal_multiple"] * rng.lognormal(-MULTIPLE_SIGMA ** 2 / 2, MULTIPLE_SIGMA, draws)
+
+    values = dcf_value(inputs, growth, discount, multiple)
+    bands = np.percentile(values, PERCENTILES)
+    result = {
+        "draws": draws,
+        "percentiles": {f"p{p}": round(float(v), 2) for p, v in zip(PERCENTILES, bands)},
+        "mean": round(float(values.mean()), 2),
+        "prob_above_price": round(float((values > price).mean()), 4) if price else None,
+        "assumptions": {
+            "growth": {"mean": round(inputs["growth"], 4), "sigma": GROWTH_SIGMA},
+            "discount_rate": {"mean": inputs["discount_rate"], "sigma": DISCOUNT_SIGMA},
+            "terminal_multiple": {"median": inputs["terminal_multiple"], "log_sigma": MULTIPLE_SIGMA},
+        },
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 2),
+    }
+    metrics.inc("dcf.simulations")
+    return result
+
+
+def scenario_grid(inputs: Dict[str, Any], discount_range: Tuple[float, float],
+                  growth_range: Tuple[float, float], steps: int = 25,
+                  price: Optional[float] = None, multiple: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Стоимость на акцию по сетке steps x steps (строки — ставки дисконтирования,
+    столбцы — темпы роста) одним broadcast-вычислением + линия безубыточности:
+    для каждого темпа роста — ставка, при которой стоимость равна цене
+    (линейная интерполяция между узлами сетки; стоимость убывает по ставке).
+    """
+    started = time.perf_counter()
+    discount_rates = np.linspace(*discount_range, steps)
+    growth_rates = np.linspace(*growth_range, steps)
+    values = dcf_value(inputs, growth_rates[None, :], discount_rates[:, None], multiple)
+
+    break_even = []
+    if price:
+        diff = values - price                                    # (ставки x рост)
+        crossing = (diff[:-1] >= 0) & (diff[1:] < 0)             # стоимость опустилась ниже цены
+        has = crossing.any(axis=0)
+        i = np.argmax(crossing, axis=0)                          # первое пересечение по столбцу
+        cols = np.arange(len(growth_rates))
+        d0, d1 = diff[i, cols], diff[i + 1, cols]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            rate = discount_rates[i] + d0 / (d0 - d1) * (discount_rates[i + 1] - discount_rates[i])
+        break_even = [
+            {"growth": round(float(g), 4), "discount_rate": round(float(r), 4) if ok else None}
+            for g, r, ok in zip(growth_rates, rate, has)
+        ]
+
+    metrics.inc("dcf.grids")
+    return {
+        "discount_rates": [round(float(r), 4) for r in discount_rates],
+        "growth_rates": [round(float(g), 4) for g in growth_rates],
+        "values": np.round(values, 2).tolist(),
+        "break_even": break_even,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 3),
+    }
+
+
+class FundamentalsCache:
+    """ticker -> входы DCF (LRU + TTL) + тикеры, где DCF неприменим."""
+
+    def __init__(self, ttl_sec: int = FUNDAMENTALS_TTL_SEC, max_entries: int = FUNDAMENTALS_MAX_ENTRIES,
+                 na_ttl_sec: int = FUNDAMENTALS_NA_TTL_SEC):
+        self.ttl_sec = ttl_sec
+        self.na_ttl_sec = na_ttl_sec
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        # ticker -> когда отчёты не дали входов DCF
+        self._not_applicable: "OrderedDict[str, float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, ticker: str, inputs: Dict[str, Any]):
+        with self._lock:
+            self._entries[ticker.upper()] = (time.time(), inputs)
+            self._entries.move_to_end(ticker.upper())
+            self._not_applicable.pop(ticker.upper(), None)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def mark_not_applicable(self, ticker: str):
+        with self._lock:
+            self._not_applicable[ticker.upper()] = time.time()
+            self._not_applicable.move_to_end(ticker.upper())
+            while len(self._not_applicable) > self.max_entries:
+                self._not_applicable.popitem(last=False)
+
+    def is_not_applicable(self, ticker: str) -> bool:
+        """Недавно выяснилось, что DCF для тикера неприменим — не ходить в FMP повторно."""
+        with self._lock:
+            marked = self._not_applicable.get(ticker.upper())
+            return marked is not None and time.time() - marked <= self.na_ttl_sec
+
+    def get(self, ticker: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(ticker.upper())
+            if entry is None or time.time() - entry[0] > self.ttl_sec:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(ticker.upper())
+            self.hits += 1
+            return entry[1]
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {"entries": len(self._entries), "ttl_sec": self.ttl_sec,
+                "not_applicable": len(self._not_applicable), "na_ttl_sec": self.na_ttl_sec,
+                "hits": self.hits, "misses": self.misses}
+
+
+# Глобальный экземпляр (заполняет FMPStockAnalyzer.calculate_intrinsic_value)
+fundamentals_cache = FundamentalsCache()
+metrics.register_gauge("dcf_fundamentals", fundamentals_cache.get_stats)
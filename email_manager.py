@@ -7,6 +7,7 @@ from email.mime.multipart import MimeMultipart
 from datetime import datetime, timedelta
 from typing import List, Dict
 from customer_manager import customer_manager
+from storage import get_connection
 
 class EmailManager:
     def __init__(self):
@@ -165,9 +166,7 @@ class EmailManager:
 
     def update_customer_notification(self, customer_id: int):
         """Обновление даты последнего уведомления клиента"""
-        import sqlite3
-
-        conn = sqlite3.connect(customer_manager.db_path)
+        conn = get_connection()
         cursor = conn.cursor()
 
         cursor.execute('''
@@ -182,9 +181,7 @@ class EmailManager:
     def save_notification_stats(self, old_price: float, new_price: float, 
                               customers_notified: int, effective_date: str):
         """Сохранение статистики уведомлений"""
-        import sqlite3
-
-        conn = sqlite3.connect(customer_manager.db_path)
+        conn = get_connection()
         cursor = conn.cursor()
 
         cursor.execute('''
@@ -0,0 +1,212 @@
+# free_trial_quota.py - Лимит бесплатных анализов в памяти
+#
+# /api/check-free-trial и /api/record-free-trial раньше делали
+# read-then-write по free_trials на каждый клик: параллельные запросы
+# читали одно и то же analyses_used и пропускали пользователя сверх
+# max_analyses. Теперь счётчики живут в памяти процесса, проверка и
+# увеличение — одна операция под локом (try_consume), а в SQLite изменения
+# уходят пачкой UPSERT'ов из фонового потока раз в FLUSH_INTERVAL.
+#
+# Состояние прогревается из trials.free_trials на старте приложения
+# (или при первом обращении).
+# UPSERT берёт MAX(analyses_used), так что несколько воркеров не
+# откатывают счётчики друг друга назад.
+#
+# Ключ — не сам fingerprint, а его 16-байтный BLAKE2b (migrations.
+# fingerprint_digest): и в памяти, и в trials.free_trials (WITHOUT ROWID).
+# Триалы, не использовавшиеся FREE_TRIAL_TTL_DAYS дней, удаляются.
+
+import os
+import atexit
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Any, Tuple
+
+import metrics
+from storage import get_connection
+from migrations import fingerprint_digest
+
+FLUSH_INTERVAL_SEC = float(os.getenv("FREE_TRIAL_FLUSH_INTERVAL", "2"))
+DEFAULT_MAX_ANALYSES = int(os.getenv("FREE_TRIAL_MAX_ANALYSES", "5"))
+TTL_DAYS = int(os.getenv("FREE_TRIAL_TTL_DAYS", "180"))
+EXPIRE_INTERVAL_SEC = float(os.getenv("FREE_TRIAL_EXPIRE_INTERVAL", "3600"))
+
+_UPSERT_TRIAL = '''
+    INSERT INTO trials.free_trials (fingerprint, analyses_used, max_analyses, last_used)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(fingerprint) DO UPDATE SET
+        analyses_used = MAX(analyses_used, excluded.analyses_used),
+        last_used = excluded.last_used
+'''
+
+
+class FreeTrialQuota:
+    """Счётчики бесплатных анализов по fingerprint с пакетным сбросом в SQLite."""
+
+    def __init__(self, flush_interval: float = FLUSH_INTERVAL_SEC,
+                 default_max: int = DEFAULT_MAX_ANALYSES):
+        self.flush_interval = flush_interval
+        self.default_max = default_max
+        # digest(fingerprint) -> [analyses_used, max_analyses, last_used]
+        self._trials: Dict[bytes, list] = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._warm = False
+        self._thread = None
+        self._stopped = threading.Event()
+
+        self.flushes = 0
+        self.rows_written = 0
+        self.denied = 0
+        self.expired = 0
+
+    # ---------- прогрев и фоновый сброс ----------
+
+    def start(self):
+        """Прогреть состояние из SQLite и запустить фоновый сброс (идемпотентно)."""
+        if self._warm:
+            return
+        with self._lock:
+            if self._warm:
+                return
+            self._load()
+            self._warm = True
+        self._thread = threading.Thread(
+            target=self._run, name="free-trial-flusher", daemon=True)
+        self._thread.start()
+
+    def _load(self):
+        with get_connection() as con:
+            rows = con.execute(
+                "SELECT fingerprint, analyses_used, max_analyses, last_used FROM trials.free_trials"
+            ).fetchall()
+        for digest, used, max_analyses, last_used in rows:
+            self._trials[digest] = [used or 0, max_analyses or self.default_max, last_used]
+        print(f"🎟️ Free trial quota warmed: {len(rows)} fingerprints")
+
+    def _run(self):
+        next_expire = 0.0
+        elapsed = 0.0
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+            elapsed += self.flush_interval
+            if elapsed >= next_expire:
+                self.expire()
+                next_expire = elapsed + EXPIRE_INTERVAL_SEC
+
+    def flush(self) -> int:
+        """Записать изменённые счётчики одной транзакцией. Возвращает число строк."""
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty:
+                    return 0
+                batch = [(digest, *self._trials[digest]) for digest in self._dirty]
+                self._dirty.clear()
+            try:
+                with get_connection() as con:
+                    con.executemany(_UPSERT_TRIAL, batch)
+            except Exception as e:
+                # вернём в очередь — запишем в следующий раз
+                with self._lock:
+                    self._dirty.update(digest for digest, *_ in batch)
+                print(f"❌ Free trial flush failed ({len(batch)} rows pending): {e}")
+                return 0
+
+            self.flushes += 1
+            self.rows_written += len(batch)
+            return len(batch)
+
+    def expire(self, ttl_days: int = TTL_DAYS) -> int:
+        """
+        Удалить триалы без активности дольше ttl_days (в БД и в памяти).
+        Предикат один и тот же: last_used IS NULL (ни разу не использован) или
+        старше cutoff — иначе память и БД расходятся, и рестарт воскрешает квоту.
+        """
+        cutoff = (datetime.now() - timedelta(days=ttl_days)).isoformat(sep=" ", timespec="seconds")
+        with self._lock:
+            stale = [digest for digest, trial in self._trials.items()
+                     if digest not in self._dirty and (trial[2] is None or trial[2] < cutoff)]
+            for digest in stale:
+                del self._trials[digest]
+        try:
+            with get_connection() as con:
+                removed = con.execute(
+                    "DELETE FROM trials.free_trials WHERE last_used IS NULL OR last_used < ?", (cutoff,)
+                ).rowcount
+        except Exception as e:
+            print(f"❌ Free trial expiry failed: {e}")
+            return 0
+
+        if removed:
+            self.expired += removed
+            print(f"🧹 Expired {removed} inactive free trials (>{ttl_days} days)")
+        return removed
+
+    def shutdown(self):
+        """Остановить поток и сбросить остаток (shutdown / atexit)."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self.flush()
+
+    # ---------- операции ----------
+
+    def check(self, fingerprint: str) -> Tuple[int, int]:
+        """(analyses_used, max_analyses) без изменения счётчика."""
+        self.start()
+        with self._lock:
+            trial = self._trials.get(fingerprint_digest(fingerprint))
+            if trial is None:
+                return 0, self.default_max
+            return trial[0], trial[1]
+
+    def try_consume(self, fingerprint: str) -> Tuple[bool, int, int]:
+        """
+        Атомарно: если лимит не исчерпан — засчитать анализ.
+        Возвращает (allowed, analyses_used, max_analyses).
+        """
+        digest = fingerprint_digest(fingerprint)
+        self.start()
+        with self._lock:
+            trial = self._trials.get(digest)
+            if trial is None:
+                trial = [0, self.default_max, None]
+                self._trials[digest] = trial
+            if trial[0] >= trial[1]:
+                self.denied += 1
+                return False, trial[0], trial[1]
+            trial[0] += 1
+            trial[2] = datetime.now().isoformat(sep=" ", timespec="seconds")
+            self._dirty.add(digest)
+            return True, trial[0], trial[1]
+
+    def release(self, fingerprint: str):
+        """
+        Вернуть засчитанный анализ (если он в итоге не состоялся). Если
+        счётчик уже успел уйти в БД, там останется большее значение (MAX).
+        """
+        digest = fingerprint_digest(fingerprint)
+        with self._lock:
+            trial = self._trials.get(digest)
+            if trial is not None and trial[0] > 0:
+                trial[0] -= 1
+                self._dirty.add(digest)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "fingerprints": len(self._trials),
+            "pending": len(self._dirty),
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "denied": self.denied,
+            "expired": self.expired,
+            "ttl_days": TTL_DAYS,
+            "flush_interval_sec": self.flush_interval,
+        }
+
+
+# Глобальный экземпляр
+free_trial_quota = FreeTrialQuota()
+atexit.register(free_trial_quota.shutdown)
+metrics.register_gauge("free_trial_quota", free_trial_quota.get_stats)
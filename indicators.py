@@ -0,0 +1,343 @@
+# indicators.py - Технические индикаторы по дневной истории цен
+#
+# Индикаторы по колонкам price_history (memory-mapped бары price_store):
+#
+#   sma_20 / sma_50 / sma_200   - простые скользящие средние (через cumsum)
+#   ema_12 / ema_26             - экспоненциальные средние
+#   macd / macd_signal / macd_hist  (12, 26, 9)
+#   rsi_14                      - RSI по Уайлдеру
+#   bb_upper / bb_middle / bb_lower - полосы Боллинджера (20, 2σ)
+#   atr_14                      - средний истинный диапазон по Уайлдеру
+#
+# Полный расчёт — NumPy по всему ряду сразу. Рекурсивные сглаживания
+# (EMA, Уайлдер) тоже без цикла по барам: y_t = d*y_{t-1} + a*x_t
+# раскрывается в y_t = d^t * (y_0 + cumsum(a * x_k / d^k)), блоками, чтобы
+# d^-k не переполнялся.
+#
+# Рядом с рядами хранится состояние (последние EMA, средние Уайлдера, окно
+# последних 200 закрытий). Когда в истории появляется новый дневной бар,
+# значения за него получаются одним шагом по состоянию (IndicatorState.step)
+# и дописываются к рядам — без пересчёта истории. Кэш — по тикеру и дате
+# последнего бара, т.е. фактически по тикеру и дню.
+
+import threading
+from collections import OrderedDict, deque
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+import metrics
+from price_history import price_history
+from price_store import Series
+
+SMA_PERIODS = (20, 50, 200)
+EMA_FAST, EMA_SLOW, MACD_SIGNAL = 12, 26, 9
+RSI_PERIOD = 14
+BB_PERIOD, BB_WIDTH = 20, 2.0
+ATR_PERIOD = 14
+MAX_CACHED_SYMBOLS = 512
+
+# показатель степени, при котором d^-k ещё далеко от переполнения float64
+_MAX_EXPONENT = 250.0
+
+INDICATORS = (
+    "sma_20", "sma_50", "sma_200", "ema_12", "ema_26",
+    "macd", "macd_signal", "macd_hist", "rsi_14",
+    "bb_upper", "bb_middle", "bb_lower", "atr_14",
+)
+
+
+# ==========================================
+# ВЕКТОРНЫЙ РАСЧЁТ ПО ВСЕМУ РЯДУ
+# ==========================================
+
+def ewm(x: np.ndarray, alpha: float, seed: float) -> np.ndarray:
+    """y_t = (1 - alpha) * y_{t-1} + alpha * x_t, y_{-1} = seed — без цикла по барам."""
+    d = 1.0 - alpha
+    out = np.empty(len(x))
+    block = max(1, int(_MAX_EXPONENT / -np.log10(d)))
+    prev = seed
+    for start in range(0, len(x), block):
+        chunk = x[start:start + block]
+        powers = d ** np.arange(1, len(chunk) + 1)
+        y = powers * (prev + np.cumsum(alpha * chunk / powers))
+        out[start:start + len(chunk)] = y
+        prev = y[-1]
+    return out
+
+
+def sma(x: np.ndarray, period: int) -> np.ndarray:
+    out = np.full(len(x), np.nan)
+    if len(x) >= period:
+        csum = np.cumsum(np.concatenate([[0.0], x]))
+        out[period - 1:] = (csum[period:] - csum[:-period]) / period
+    return out
+
+
+def ema(x: np.ndarray, period: int) -> np.ndarray:
+    """EMA с затравкой первым значением (как adjust=False в pandas)."""
+    if not len(x):
+        return np.empty(0)
+    alpha = 2.0 / (period + 1)
+    out = np.empty(len(x))
+    out[0] = x[0]
+    out[1:] = ewm(x[1:], alpha, x[0])
+    return out
+
+
+def wilder(x: np.ndarray, period: int, first: int = 0) -> np.ndarray:
+    """Сглаживание Уайлдера: затравка — среднее x[first:first+period], дальше alpha = 1/period."""
+    out = np.full(len(x), np.nan)
+    seed_at = first + period - 1
+    if len(x) > seed_at:
+        out[seed_at] = x[first:seed_at + 1].mean()
+        out[seed_at + 1:] = ewm(x[seed_at + 1:], 1.0 / period, out[seed_at])
+    return out
+
+
+def _rsi(avg_gain, avg_loss):
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(avg_loss == 0, 100.0, 100.0 - 100.0 / (1.0 + avg_gain / avg_loss))
+
+
+def _true_range(high, low, close, prev_close):
+    # пропуски high/low (FMP иногда не отдаёт) — берём close
+    high = np.where(np.isnan(high), close, high)
+    low = np.where(np.isnan(low), close, low)
+    return np.fmax(high - low, np.fmax(np.abs(high - prev_close), np.abs(low - prev_close)))
+
+
+def compute_indicators(series: Series) -> Dict[str, np.ndarray]:
+    """Все индикаторы по колонкам close/high/low — массивы той же длины, что ряд (NaN до прогрева)."""
+    close = np.asarray(series["close"], dtype=np.float64)
+    n = len(close)
+    result = {f"sma_{p}": sma(close, p) for p in SMA_PERIODS}
+
+    result["ema_12"] = ema(close, EMA_FAST)
+    result["ema_26"] = ema(close, EMA_SLOW)
+    result["macd"] = result["ema_12"] - result["ema_26"]
+    result["macd_signal"] = ema(result["macd"], MACD_SIGNAL)
+    result["macd_hist"] = result["macd"] - result["macd_signal"]
+
+    delta = np.diff(close, prepend=np.nan)
+    gains, losses = np.clip(delta, 0, None), np.clip(-delta, 0, None)
+    result["rsi_14"] = _rsi(wilder(gains, RSI_PERIOD, first=1), wilder(losses, RSI_PERIOD, first=1))
+
+    mid = result[f"sma_{BB_PERIOD}"]
+    std = np.full(n, np.nan)
+    if n >= BB_PERIOD:
+        std[BB_PERIOD - 1:] = sliding_window_view(close, BB_PERIOD).std(axis=1)
+    result["bb_middle"] = mid
+    result["bb_upper"] = mid + BB_WIDTH * std
+    result["bb_lower"] = mid - BB_WIDTH * std
+
+    prev_close = np.concatenate([[close[0]], close[:-1]]) if n else close
+    tr = _true_range(np.asarray(series["high"], dtype=np.float64),
+                     np.asarray(series["low"], dtype=np.float64), close, prev_close)
+    result["atr_14"] = wilder(tr, ATR_PERIOD)
+    return result
+
+
+# ==========================================
+# ИНКРЕМЕНТАЛЬНОЕ ОБНОВЛЕНИЕ
+# ==========================================
+
+class IndicatorState:
+    """Состояние на последнем баре: хватает, чтобы посчитать следующий бар за O(1)."""
+
+    def __init__(self, series: Series, values: Dict[str, np.ndarray]):
+        close = series["close"]
+        self.closes = deque((float(c) for c in close[-max(SMA_PERIODS):]), maxlen=max(SMA_PERIODS))
+        self.count = len(close)
+        last = {name: float(v[-1]) for name, v in values.items()}
+        self.ema_12, self.ema_26, self.macd_signal = last["ema_12"], last["ema_26"], last["macd_signal"]
+        self.atr = last["atr_14"]
+        self.avg_gain, self.avg_loss = self._wilder_averages(close)
+        # пока сглаживание не прогрелось — копим сырые значения для затравки
+        self.gains: List[float] = []
+        self.losses: List[float] = []
+        self.ranges: List[float] = []
+        if np.isnan(self.avg_gain):
+            delta = np.diff(close)
+            self.gains = list(np.clip(delta, 0, None))
+            self.losses = list(np.clip(-delta, 0, None))
+        if np.isnan(self.atr):
+            prev_close = np.concatenate([[close[0]], close[:-1]])
+            self.ranges = list(_true_range(np.asarray(series["high"]), np.asarray(series["low"]),
+                                           np.asarray(close), prev_close))
+
+    @staticmethod
+    def _wilder_averages(close):
+        delta = np.diff(close, prepend=np.nan)
+        gain = wilder(np.clip(delta, 0, None), RSI_PERIOD, first=1)
+        loss = wilder(np.clip(-delta, 0, None), RSI_PERIOD, first=1)
+        return float(gain[-1]), float(loss[-1])
+
+    def step(self, high: float, low: float, close: float) -> Dict[str, float]:
+        """Значения индикаторов на новом баре."""
+        prev_close = self.closes[-1]
+        self.closes.append(close)
+        self.count += 1
+        window = np.fromiter(self.closes, dtype=np.float64)
+        out = {f"sma_{p}": float(window[-p:].mean()) if len(window) >= p else np.nan for p in SMA_PERIODS}
+
+        self.ema_12 += 2.0 / (EMA_FAST + 1) * (close - self.ema_12)
+        self.ema_26 += 2.0 / (EMA_SLOW + 1) * (close - self.ema_26)
+        macd = self.ema_12 - self.ema_26
+        self.macd_signal += 2.0 / (MACD_SIGNAL + 1) * (macd - self.macd_signal)
+        out.update(ema_12=self.ema_12, ema_26=self.ema_26, macd=macd,
+                   macd_signal=self.macd_signal, macd_hist=macd - self.macd_signal)
+
+        gain, loss = max(close - prev_close, 0.0), max(prev_close - close, 0.0)
+        if np.isnan(self.avg_gain):
+            self.gains.append(gain)
+            self.losses.append(loss)
+            if len(self.gains) == RSI_PERIOD:
+                self.avg_gain, self.avg_loss = float(np.mean(self.gains)), float(np.mean(self.losses))
+        else:
+            self.avg_gain += (gain - self.avg_gain) / RSI_PERIOD
+            self.avg_loss += (loss - self.avg_loss) / RSI_PERIOD
+        out["rsi_14"] = float(_rsi(self.avg_gain, self.avg_loss)) if not np.isnan(self.avg_gain) else np.nan
+
+        if len(window) >= BB_PERIOD:
+            last = window[-BB_PERIOD:]
+            mid, std = float(last.mean()), float(last.std())
+            out.update(bb_middle=mid, bb_upper=mid + BB_WIDTH * std, bb_lower=mid - BB_WIDTH * std)
+        else:
+            out.update(bb_middle=np.nan, bb_upper=np.nan, bb_lower=np.nan)
+
+        tr = float(_true_range(np.float64(high), np.float64(low), np.float64(close), prev_close))
+        if np.isnan(self.atr):
+            self.ranges.append(tr)
+            if len(self.ranges) == ATR_PERIOD:
+                self.atr = float(np.mean(self.ranges))
+        else:
+            self.atr += (tr - self.atr) / ATR_PERIOD
+        out["atr_14"] = self.atr
+        return out
+
+
+# ==========================================
+# КЭШ ПО ТИКЕРУ И ДНЮ
+# ==========================================
+
+class _Entry:
+    __slots__ = ("last_date", "dates", "close", "values", "state")
+
+    def __init__(self, series: Series):
+        self.dates = np.array(series["date"])
+        self.close = np.array(series["close"], dtype=np.float64)
+        self.values = compute_indicators(series)
+        self.state = IndicatorState(series, self.values)
+        self.last_date = self.dates[-1]
+
+    def extend(self, new: Series):
+        """Дописать новые бары шагами по состоянию."""
+        rows = [self.state.step(float(h), float(l), float(c))
+                for h, l, c in zip(new["high"], new["low"], new["close"])]
+        for name in INDICATORS:
+            self.values[name] = np.concatenate([self.values[name], [r[name] for r in rows]])
+        self.dates = np.concatenate([self.dates, new["date"]])
+        self.close = np.concatenate([self.close, np.asarray(new["close"], dtype=np.float64)])
+        self.last_date = self.dates[-1]
+
+
+def _value(x) -> Optional[float]:
+    return None if x is None or not np.isfinite(x) else round(float(x), 4)
+
+
+class IndicatorEngine:
+    """Индикаторы по тикерам: полный расчёт один раз, дальше — шаг на новый бар."""
+
+    def __init__(self, max_symbols: int = MAX_CACHED_SYMBOLS):
+        self.max_symbols = max_symbols
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.full_computes = 0
+        self.incremental_updates = 0
+        self.hits = 0
+
+    def _entry(self, symbol: str) -> Optional[_Entry]:
+        symbol = symbol.strip().upper()
+        series = price_history.get(symbol)
+        if series is None or not len(series["date"]):
+            return None
+        last = series["date"][-1]
+
+        with self._lock:
+            entry = self._entries.get(symbol)
+            if entry is not None:
+                self._entries.move_to_end(symbol)
+                if entry.last_date == last:
+                    self.hits += 1
+                    return entry
+                start = int(np.searchsorted(series["date"], entry.last_date, side="right"))
+                # история дописывается только в конец — иначе (перезагрузка файла) считаем заново
+                if start > 0 and series["date"][start - 1] == entry.last_date:
+                    entry.extend({k: v[start:] for k, v in series.items()})
+                    self.incremental_updates += 1
+                    metrics.inc("indicators.incremental")
+                    return entry
+
+        entry = _Entry(series)
+        with self._lock:
+            self._entries[symbol] = entry
+            while len(self._entries) > self.max_symbols:
+                self._entries.popitem(last=False)
+            self.full_computes += 1
+        metrics.inc("indicators.full")
+        return entry
+
+    def snapshot(self, symbol: str) -> Optional[Dict[str, Any]]:
+        """Последние значения + простые сигналы (для ответа анализа)."""
+        entry = self._entry(symbol)
+        if entry is None:
+            return None
+        latest = {name: _value(entry.values[name][-1]) for name in INDICATORS}
+        price = float(entry.close[-1])
+
+        signals = []
+        rsi = latest["rsi_14"]
+        if rsi is not None and rsi >= 70:
+            signals.append("🔥 RSI OVERBOUGHT")
+        elif rsi is not None and rsi <= 30:
+            signals.append("🧊 RSI OVERSOLD")
+        if latest["sma_200"] is not None:
+            signals.append("📈 ABOVE SMA 200" if price > latest["sma_200"] else "📉 BELOW SMA 200")
+        if latest["macd_hist"] is not None:
+            signals.append("🟢 MACD BULLISH" if latest["macd_hist"] > 0 else "🔴 MACD BEARISH")
+        if latest["bb_upper"] is not None and price > latest["bb_upper"]:
+            signals.append("⬆️ ABOVE UPPER BOLLINGER")
+        elif latest["bb_lower"] is not None and price < latest["bb_lower"]:
+            signals.append("⬇️ BELOW LOWER BOLLINGER")
+
+        return {"symbol": symbol.strip().upper(), "as_of": str(entry.last_date),
+                "close": round(price, 4), **latest, "signals": signals}
+
+    def series(self, symbol: str, days: int = 252) -> Optional[Dict[str, Any]]:
+        """Ряды индикаторов за последние days баров (для графиков)."""
+        entry = self._entry(symbol)
+        if entry is None:
+            return None
+        tail = slice(-max(1, int(days)), None)
+        return {
+            "symbol": symbol.strip().upper(),
+            "date": [str(d) for d in entry.dates[tail]],
+            "close": [_value(v) for v in entry.close[tail]],
+            **{name: [_value(v) for v in entry.values[name][tail]] for name in INDICATORS},
+        }
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "symbols": len(self._entries),
+            "full_computes": self.full_computes,
+            "incremental_updates": self.incremental_updates,
+            "hits": self.hits,
+        }
+
+
+# Глобальный экземпляр
+indicator_engine = IndicatorEngine()
+metrics.register_gauge("indicators", indicator_engine.get_stats)
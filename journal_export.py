@@ -0,0 +1,228 @@
+# journal_export.py - Потоковый экспорт журнала и watchlist
+#
+# exportJournal / exportWatchlist в portfolio.html собирали CSV в браузере
+# из уже скачанных данных — для этого приходилось тянуть весь журнал.
+# Здесь экспорт строится на сервере генератором: курсор SQLite читается
+# пачками по EXPORT_BATCH_SIZE (fetchmany), каждая пачка сразу
+# форматируется и отдаётся в StreamingResponse, так что память не зависит
+# от числа строк.
+#
+# Форматы: csv, jsonl, xlsx. XLSX пишется вручную (минимальный SpreadsheetML
+# через zipfile в неперематываемый поток, строки inlineStr) — без openpyxl
+# и без временного файла. gzip=True — поверх любого формата, тоже потоково.
+#
+# CSV журнала совместим с импортом (journal_import, layout generic).
+
+import io
+import os
+import csv
+import json
+import zlib
+import zipfile
+from datetime import datetime
+from typing import Any, Iterable, Iterator, List, Sequence, Tuple
+from xml.sax.saxutils import escape
+
+import metrics
+from storage import get_connection
+from database import transaction_filters
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+
+FORMATS = {
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "jsonl": ("application/x-ndjson", "jsonl"),
+    "xlsx": ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "xlsx"),
+}
+
+JOURNAL_EXPORT_COLUMNS = ("id", "date", "type", "symbol", "action", "quantity",
+                          "price", "commission", "notes", "created_at")
+WATCHLIST_EXPORT_COLUMNS = ("symbol", "added_date")
+
+
+# ==========================================
+# ЧТЕНИЕ
+# ==========================================
+
+def _iter_batches(sql: str, params: Sequence[Any]) -> Iterator[List[Tuple]]:
+    """Пачки строк с курсора; соединение возвращается в пул по окончании/обрыве."""
+    conn = get_connection()
+    try:
+        cursor = conn.execute(sql, params)
+        while True:
+            batch = cursor.fetchmany(EXPORT_BATCH_SIZE)
+            if not batch:
+                break
+            yield batch
+        cursor.close()
+    finally:
+        conn.close()
+
+
+# ==========================================
+# ФОРМАТЫ
+# ==========================================
+
+def _csv_chunks(columns: Sequence[str], batches: Iterable[List[Tuple]]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for batch in batches:
+        writer.writerows(batch)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def _jsonl_chunks(columns: Sequence[str], batches: Iterable[List[Tuple]]) -> Iterator[bytes]:
+    for batch in batches:
+        yield "".join(
+            json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n" for row in batch
+        ).encode()
+
+
+class _ChunkSink(io.RawIOBase):
+    """Неперематываемый приёмник для zipfile: накопленное забираем drain()."""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+_XLSX_STATIC = {
+    "[Content_Types].xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    "_rels/.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="xl/workbook.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+        '</Relationships>'
+    ),
+    "xl/_rels/workbook.xml.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="worksheets/sheet1.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+        '</Relationships>'
+    ),
+}
+
+_XLSX_WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets><sheet name="{name}" sheetId="1" r:id="rId1"/></sheets></workbook>'
+)
+
+# XML 1.0 не допускает управляющие символы, кроме \t \n \r
+_XML_ILLEGAL = dict.fromkeys(c for c in range(32) if c not in (9, 10, 13))
+
+
+def _xlsx_cell(value: Any) -> str:
+    if value is None:
+        return "<c/>"
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return f'<c t="n"><v>{value}</v></c>'
+    text = escape(str(value).translate(_XML_ILLEGAL))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+def _xlsx_row(values: Iterable[Any]) -> str:
+    return "<row>" + "".join(_xlsx_cell(v) for v in values) + "</row>"
+
+
+def _xlsx_chunks(columns: Sequence[str], batches: Iterable[List[Tuple]],
+                 sheet_name: str = "Export") -> Iterator[bytes]:
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for name, xml in _XLSX_STATIC.items():
+            zf.writestr(name, xml)
+        zf.writestr("xl/workbook.xml", _XLSX_WORKBOOK.format(name=escape(sheet_name)))
+        with zf.open("xl/worksheets/sheet1.xml", "w", force_zip64=True) as sheet:
+            sheet.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                        b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                        b'<sheetData>')
+            sheet.write(_xlsx_row(columns).encode())
+            for batch in batches:
+                sheet.write("".join(_xlsx_row(row) for row in batch).encode())
+                yield sink.drain()
+            sheet.write(b"</sheetData></worksheet>")
+    yield sink.drain()
+
+
+_WRITERS = {"csv": _csv_chunks, "jsonl": _jsonl_chunks, "xlsx": _xlsx_chunks}
+
+
+def _gzip_chunks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 -> gzip-обёртка
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _counted(chunks: Iterable[bytes], name: str) -> Iterator[bytes]:
+    total = 0
+    for chunk in chunks:
+        total += len(chunk)
+        yield chunk
+    metrics.inc(f"export.{name}")
+    metrics.inc("export.bytes", total)
+
+
+# ==========================================
+# API
+# ==========================================
+
+def _stream(name: str, columns: Sequence[str], sql: str, params: Sequence[Any],
+            fmt: str, gzip: bool) -> Tuple[Iterator[bytes], str, str]:
+    if fmt not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+    media_type, extension = FORMATS[fmt]
+    filename = f"profitpal_{name}_{datetime.now():%Y%m%d}.{extension}"
+
+    chunks = _WRITERS[fmt](columns, _iter_batches(sql, params))
+    if gzip:
+        chunks = _gzip_chunks(chunks)
+        media_type = "application/gzip"
+        filename += ".gz"
+    return _counted(chunks, name), media_type, filename
+
+
+def export_transactions(user_id, fmt: str = "csv", gzip: bool = False, tx_type=None,
+                        symbol=None, date_from=None, date_to=None) -> Tuple[Iterator[bytes], str, str]:
+    """(генератор байтов, media_type, имя файла) для журнала, новые сверху."""
+    where, params = transaction_filters(user_id, tx_type, symbol, date_from, date_to)
+    sql = (f"SELECT {', '.join(JOURNAL_EXPORT_COLUMNS)} FROM journal.transactions "
+           f"WHERE {' AND '.join(where)} ORDER BY date DESC, id DESC")
+    return _stream("journal", JOURNAL_EXPORT_COLUMNS, sql, params, fmt, gzip)
+
+
+def export_watchlist(user_id, fmt: str = "csv", gzip: bool = False) -> Tuple[Iterator[bytes], str, str]:
+    sql = (f"SELECT {', '.join(WATCHLIST_EXPORT_COLUMNS)} FROM journal.watchlist "
+           "WHERE user_id = ? ORDER BY symbol")
+    return _stream("watchlist", WATCHLIST_EXPORT_COLUMNS, sql, (user_id,), fmt, gzip)
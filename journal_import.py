@@ -0,0 +1,297 @@
+# journal_import.py - Пакетный импорт сделок из CSV брокера
+#
+# Раньше история заводилась по одной сделке: saveTransaction ->
+# POST /api/transactions -> connect + INSERT на каждую строку. Здесь файл
+# читается потоково (csv.reader поверх загруженного файла, построчно, без
+# чтения целиком в память), строки валидируются и пишутся пачками
+# executemany по IMPORT_CHUNK_SIZE во временную таблицу соединения
+# (temp.journal_import — своя у каждого соединения, общие хранилища не
+# блокирует). Пул прикрепляет все хранилища к одному соединению, и
+# транзакция записи на всё время разбора держала бы логины, аудит и квоты.
+# В конце — одна короткая транзакция: INSERT ... SELECT из временной
+# таблицы в journal.transactions (первая команда пишет в journal —
+# блокируется только он) и пересчёт затронутых позиций journal.positions.
+# Импорт по-прежнему всё или ничего.
+#
+# Поддерживаемые форматы (определяются по заголовку, layout="auto"):
+#   generic - date, symbol, action, quantity, price [, type, commission, notes]
+#   ibkr    - Interactive Brokers: Flex Query / секция Trades из Activity Statement
+#   schwab  - Charles Schwab: История транзакций (Date, Action, Symbol, ...)
+#
+# Ошибки возвращаются по строкам ({"line", "error"}), валидные строки импортируются.
+
+import os
+import io
+import re
+import csv
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import metrics
+from storage import get_connection
+from portfolio_engine import ACTION_SIDE, normalize_symbol, refresh_position
+
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "1000"))
+IMPORT_MAX_ROWS = int(os.getenv("IMPORT_MAX_ROWS", "200000"))
+MAX_REPORTED_ERRORS = 200
+
+TRANSACTION_TYPES = ("stock", "option", "future", "bond")
+LAYOUTS = ("auto", "generic", "ibkr", "schwab")
+
+_COLUMNS = "user_id, date, type, symbol, action, quantity, price, commission, notes"
+
+_STAGE_TABLE = f"CREATE TEMP TABLE IF NOT EXISTS journal_import ({_COLUMNS})"
+_STAGE = f"INSERT INTO temp.journal_import ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+_PUBLISH = (f"INSERT INTO journal.transactions ({_COLUMNS}) "
+            f"SELECT {_COLUMNS} FROM temp.journal_import ORDER BY rowid")
+
+_DATE_FORMATS = ("%Y-%m-%d", "%m/%d/%Y", "%Y%m%d", "%d.%m.%Y", "%m/%d/%y")
+
+# "AAPL 01/17/2025 150.00 C", "AAPL 17JAN25 150 C", OCC "AAPL  250117C00150000"
+_OPTION_SUFFIX = re.compile(r"\s([CP])$")
+_OCC_SYMBOL = re.compile(r"^[A-Z.]+\s*\d{6}([CP])\d{8}$")
+
+
+class RowError(ValueError):
+    """Строку нельзя импортировать (текст уходит в отчёт)."""
+
+
+class SkipRow(Exception):
+    """Строка не сделка (дивиденд, перевод, итоговая строка) — пропускаем молча."""
+
+
+# ==========================================
+# РАЗБОР ПОЛЕЙ
+# ==========================================
+
+def _parse_date(value: str) -> str:
+    # "2025-01-15, 10:30:00" (IBKR), "01/15/2025 as of 01/14/2025" (Schwab)
+    token = (value or "").split(",")[0].strip().split(" ")[0]
+    for fmt in _DATE_FORMATS:
+        try:
+            return datetime.strptime(token, fmt).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    raise RowError(f"invalid date: {value!r}")
+
+
+def _parse_number(value: str, field: str, default: Optional[float] = None) -> float:
+    text = (value or "").strip().replace("$", "").replace(",", "")
+    if text.startswith("(") and text.endswith(")"):
+        text = "-" + text[1:-1]
+    if not text:
+        if default is None:
+            raise RowError(f"{field} is required")
+        return default
+    try:
+        return float(text)
+    except ValueError:
+        raise RowError(f"invalid {field}: {value!r}")
+
+
+def _option_action(symbol: str, side: int) -> Tuple[str, str]:
+    """(type, action) для брокерских форматов: опцион определяется по символу."""
+    match = _OPTION_SUFFIX.search(symbol) or _OCC_SYMBOL.match(symbol)
+    verb = "buy" if side > 0 else "sell"
+    if match:
+        return "option", f"{verb}_{'call' if match.group(1) == 'C' else 'put'}"
+    return "stock", verb
+
+
+# ==========================================
+# ФОРМАТЫ
+# ==========================================
+
+def _generic_row(row: Dict[str, str]) -> Tuple:
+    tx_type = (row.get("type") or "stock").strip().lower()
+    if tx_type not in TRANSACTION_TYPES:
+        raise RowError(f"invalid type: {row.get('type')!r}")
+    action = (row.get("action") or "").strip().lower()
+    if action not in ACTION_SIDE:
+        raise RowError(f"invalid action: {row.get('action')!r}")
+    symbol = normalize_symbol(row.get("symbol"))
+    if not symbol:
+        raise RowError("symbol is required")
+    quantity = abs(_parse_number(row.get("quantity"), "quantity"))
+    if not quantity:
+        raise RowError("quantity must be non-zero")
+    return (_parse_date(row.get("date")), tx_type, symbol, action, quantity,
+            _parse_number(row.get("price"), "price"),
+            abs(_parse_number(row.get("commission"), "commission", 0.0)),
+            (row.get("notes") or "").strip())
+
+
+def _ibkr_row(row: Dict[str, str]) -> Tuple:
+    symbol = normalize_symbol(row.get("symbol"))
+    if not symbol or not (row.get("date/time") or row.get("tradedate")):
+        raise SkipRow()  # итоговые строки "Total" секции Trades
+    quantity = _parse_number(row.get("quantity"), "quantity")
+    if not quantity:
+        raise RowError("quantity must be non-zero")
+    side = 1 if quantity > 0 else -1
+    category = (row.get("asset category") or row.get("assetclass") or "").lower()
+    if "future" in category or category == "fut":
+        tx_type, action = "future", ("buy" if side > 0 else "sell")
+    else:
+        tx_type, action = _option_action(symbol, side)
+    price = row.get("t. price") or row.get("tradeprice")
+    commission = row.get("comm/fee") or row.get("ibcommission")
+    return (_parse_date(row.get("date/time") or row.get("tradedate")), tx_type, symbol,
+            action, abs(quantity), _parse_number(price, "price"),
+            abs(_parse_number(commission, "commission", 0.0)), "Imported from IBKR")
+
+
+_SCHWAB_SIDE = {
+    "buy": 1, "buy to open": 1, "buy to close": 1, "buy to cover": 1, "reinvest shares": 1,
+    "sell": -1, "sell to open": -1, "sell to close": -1, "sell short": -1,
+}
+
+
+def _schwab_row(row: Dict[str, str]) -> Tuple:
+    side = _SCHWAB_SIDE.get((row.get("action") or "").strip().lower())
+    if side is None:
+        raise SkipRow()  # дивиденды, переводы, проценты
+    symbol = normalize_symbol(row.get("symbol"))
+    if not symbol:
+        raise RowError("symbol is required")
+    quantity = abs(_parse_number(row.get("quantity"), "quantity"))
+    if not quantity:
+        raise RowError("quantity must be non-zero")
+    tx_type, action = _option_action(symbol, side)
+    return (_parse_date(row.get("date")), tx_type, symbol, action, quantity,
+            _parse_number(row.get("price"), "price"),
+            abs(_parse_number(row.get("fees & comm"), "commission", 0.0)),
+            "Imported from Schwab")
+
+
+_PARSERS = {"generic": _generic_row, "ibkr": _ibkr_row, "schwab": _schwab_row}
+
+
+def detect_layout(header: List[str]) -> str:
+    columns = set(header)
+    if "t. price" in columns or "tradeprice" in columns:
+        return "ibkr"
+    if "fees & comm" in columns:
+        return "schwab"
+    if {"date", "symbol", "action", "quantity", "price"} <= columns:
+        return "generic"
+    raise ValueError("Unrecognized CSV header; expected generic, IBKR or Schwab columns")
+
+
+def _statement_records(reader, first: List[str]) -> Iterator[Tuple[int, str, Dict[str, str]]]:
+    """
+    IBKR Activity Statement: секции идут подряд ("Trades,Header,...",
+    "Trades,Data,Order,..."), берём только сделки; заголовок секции может
+    повторяться для разных классов активов.
+    """
+    header = None
+    row, line = first, 1
+    while row is not None:
+        if len(row) > 2 and row[0] == "Trades":
+            if row[1] == "Header":
+                header = [h.strip().lower() for h in row[2:]]
+            elif row[1] == "Data" and header and row[2] in ("Order", "Trade"):
+                yield line, "ibkr", dict(zip(header, row[2:]))
+        row = next(reader, None)
+        line = reader.line_num
+
+
+def _records(text: Iterable[str], layout: str) -> Iterator[Tuple[int, str, Dict[str, str]]]:
+    """(номер строки, layout, dict) — построчно, без чтения файла целиком."""
+    reader = csv.reader(text)
+    first = next(reader, None)
+    if first is None:
+        raise ValueError("Empty file")
+    if not first:
+        raise ValueError("The first row must be a CSV header, got an empty line")
+    if first[0] in ("Statement", "Trades"):
+        yield from _statement_records(reader, first)
+        return
+
+    header = [h.strip().lower() for h in first]
+    if layout == "auto":
+        layout = detect_layout(header)
+    for values in reader:
+        if not any(v.strip() for v in values):
+            continue
+        yield reader.line_num, layout, dict(zip(header, values))
+
+
+# ==========================================
+# ИМПОРТ
+# ==========================================
+
+def import_transactions(user_id, fileobj, layout: str = "auto",
+                        chunk_size: int = IMPORT_CHUNK_SIZE) -> Dict[str, Any]:
+    """
+    Импортировать сделки из бинарного файлового объекта CSV.
+    Возвращает {"layout", "imported", "skipped", "error_count", "errors": [...]}.
+    """
+    if layout not in LAYOUTS:
+        raise ValueError(f"layout must be one of {', '.join(LAYOUTS)}")
+
+    text = io.TextIOWrapper(fileobj, encoding="utf-8-sig", errors="replace", newline="")
+    imported = skipped = error_count = 0
+    errors: List[Dict[str, Any]] = []
+    touched = set()
+    detected = layout
+    batch = []
+
+    try:
+        with get_connection() as con:
+            con.execute(_STAGE_TABLE)
+            con.execute("DELETE FROM temp.journal_import")
+            con.commit()
+            try:
+                # разбор: пачки во временную таблицу, каждая — транзакция только над temp
+                for line, detected, record in _records(text, layout):
+                    if imported + len(batch) + error_count >= IMPORT_MAX_ROWS:
+                        raise ValueError(f"Too many rows (max {IMPORT_MAX_ROWS})")
+                    try:
+                        row = _PARSERS[detected](record)
+                    except SkipRow:
+                        skipped += 1
+                        continue
+                    except RowError as e:
+                        error_count += 1
+                        if len(errors) < MAX_REPORTED_ERRORS:
+                            errors.append({"line": line, "error": str(e)})
+                        continue
+
+                    batch.append((user_id, *row))
+                    touched.add((row[1], row[2]))
+                    if len(batch) >= chunk_size:
+                        con.executemany(_STAGE, batch)
+                        con.commit()
+                        imported += len(batch)
+                        batch.clear()
+
+                if batch:
+                    con.executemany(_STAGE, batch)
+                    imported += len(batch)
+                con.commit()
+
+                # публикация: короткая транзакция, первая запись — в journal
+                con.execute("BEGIN")
+                con.execute(_PUBLISH)
+                for tx_type, symbol in touched:
+                    refresh_position(con, user_id, tx_type, symbol)
+                con.commit()
+            finally:
+                con.rollback()
+                con.execute("DELETE FROM temp.journal_import")
+                con.commit()
+    finally:
+        text.detach()
+
+    metrics.inc("journal_import.rows", imported)
+    metrics.inc("journal_import.errors", error_count)
+    print(f"📥 Journal import ({detected}) for {user_id}: {imported} rows, "
+          f"{skipped} skipped, {error_count} errors")
+    return {
+        "layout": detected,
+        "imported": imported,
+        "skipped": skipped,
+        "error_count": error_count,
+        "errors": errors,
+    }
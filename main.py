@@ -10,20 +10,38 @@ from datetime import datetime, timedelta
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from typing import Dict, Any, List, Optional, Tuple
-from fastapi import FastAPI, HTTPException, Request, Form, BackgroundTasks, Depends, Response
-from fastapi.responses import FileResponse, RedirectResponse, JSONResponse, HTMLResponse
+from fastapi import FastAPI, HTTPException, Request, Form, BackgroundTasks, Depends, Response, UploadFile, File, WebSocket
+from fastapi.responses import FileResponse, RedirectResponse, JSONResponse, HTMLResponse, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
 from database import init_db, add_transaction, get_transactions, delete_transaction
+from portfolio_engine import get_portfolio, get_holdings, METHODS as PORTFOLIO_METHODS
+from journal_import import import_transactions
+from journal_export import export_transactions, export_watchlist
+from market_data import analysis_cache, enrich_symbols, is_valid_ticker, normalize_tickers, quote_cache
+from price_stream import price_hub
+from portfolio_analysis import analyze_portfolio
+from price_history import price_history
+from risk import compute_risk, MAX_QUERY_SYMBOLS
+from indicators import indicator_engine
+from dcf import (build_inputs, dcf_value, monte_carlo, scenario_grid, fundamentals_cache,
+                 GRID_DISCOUNT_BOUNDS, GRID_GROWTH_BOUNDS, GRID_MAX_MULTIPLE)
+from alerts import alert_engine, add_rule, list_rules, delete_rule
 from pydantic import BaseModel
 from pathlib import Path
-from auth_manager import authenticate_user_login, validate_user_credentials, create_new_user, get_auth_stats, auth_manager as AUTH
-from security import set_session_cookies, create_session, require_user, require_plan, verify_csrf, SESSION_COOKIE, CSRF_COOKIE, _db, _fetch_user_by_session, is_admin_user
+from auth_manager import authenticate_user_login, validate_user_credentials, create_new_user, auth_manager as AUTH
+from security import set_session_cookies, create_session, require_user, require_plan, require_admin, verify_csrf, SESSION_COOKIE, CSRF_COOKIE, _db, _fetch_user_by_session, is_admin_user
 from referral_manager import ReferralManager
+from storage import get_connection, fetch_dashboard_summary, fetch_admin_overview, counter_reconciler
+from auth_audit import auth_audit
+from rate_limit import login_throttle, client_ip
+from free_trial_quota import free_trial_quota
+import metrics
+import math
 import re
 
 # ==========================================
-# Инициализация базы данных при старте
+# Инициализация базы данных при старте (миграции)
 # ==========================================
 
 init_db()
@@ -95,37 +113,9 @@ auth_mgr = AuthManager()
 # DATABASE CONFIGURATION
 # ==========================================
 
-DATABASE_PATH = "profitpal_database.db"
-
-
-def create_free_trial_table():
-    """Создание таблицы для free trial fingerprints"""
-    try:
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS free_trials (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                fingerprint TEXT NOT NULL,
-                analyses_used INTEGER DEFAULT 0,
-                max_analyses INTEGER DEFAULT 5,
-                last_used TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE(fingerprint)
-            )
-        ''')
-
-        conn.commit()
-        conn.close()
-        print("✅ Free trial table created successfully")
-
-    except Exception as e:
-        print(f"❌ Error creating free trial table: {e}")
-
-
-# Создаем таблицу при запуске
-create_free_trial_table()
+# Все хранилища (auth / journal / free trials / referrals / customers)
+# открываются через общий пул storage.py. Схема меняется только
+# миграциями (migrations.py), которые init_db() прогоняет один раз при старте.
 
 # ==========================================
 # ENVIRONMENT VARIABLES CONFIGURATION
@@ -167,9 +157,8 @@ def _norm_key(s: str) -> str:
     return re.sub(r'[^A-Z0-9]', '', (s or '').upper())
 
 
-# Referral manager (DB можно переопределить через ENV REFERRALS_DB)
-REFERRALS_DB = os.getenv("REFERRALS_DB", "referrals.db")
-referral_mgr = ReferralManager(db_path=REFERRALS_DB)
+# Referral manager (путь к referrals.db переопределяется через ENV REFERRALS_DB в storage.py)
+referral_mgr = ReferralManager()
 
 # ==========================================
 # PRICE IDs (ENV only — no hardcode)
@@ -283,6 +272,25 @@ app.add_middleware(
 # Templates
 templates = Jinja2Templates(directory=".")
 
+
+@app.on_event("startup")
+def start_background_jobs():
+    """Сверка счётчиков /admin/stats, прогрев лимитов free trial, проверка алертов"""
+    counter_reconciler.start()
+    free_trial_quota.start()
+    alert_engine.start()
+
+
+@app.on_event("shutdown")
+def flush_write_behind_buffers():
+    """Сбросить накопленные auth-события и счётчики free trial в БД"""
+    counter_reconciler.stop()
+    auth_audit.shutdown()
+    free_trial_quota.shutdown()
+    price_hub.stop()
+    alert_engine.stop()
+
+
 # Initialize referral manager
 referral_mgr = ReferralManager()
 
@@ -309,6 +317,7 @@ class AnalysisResponse(BaseModel):
     valuation_gap: Optional[float]
     final_verdict: str
     analysis_details: Dict[str, Any]
+    technical_indicators: Optional[Dict[str, Any]] = None
 
 
 class PaymentRequest(BaseModel):
@@ -332,6 +341,14 @@ class FreeTrialRecordRequest(BaseModel):
     ticker: str
 
 
+class FreeAnalysisRequest(BaseModel):
+    fingerprint: str
+    ticker: str
+    pe_min: Optional[float] = 5.0
+    pe_max: Optional[float] = 30.0
+    debt_max: Optional[float] = 50.0
+
+
 # ==========================================
 # FMP STOCK ANALYZER CLASS
 # ==========================================
@@ -360,6 +377,51 @@ class FMPStockAnalyzer:
             print(f"FMP API Error for {endpoint}: {e}")
             return None
 
+    def call_fmp_api_list(self, endpoint: str, limit: int = 5) -> List[Dict]:
+        """Call FMP API returning the full list (e.g. several annual statements, newest first)"""
+        try:
+            response = requests.get(f"{self.base_url}/{endpoint}",
+                                    params={"apikey": self.api_key, "limit": limit}, timeout=10)
+            response.raise_for_status()
+            data = response.json()
+        except Exception as e:
+            print(f"FMP API Error for {endpoint}: {e}")
+            return []
+        return [row for row in data if isinstance(row, dict)] if isinstance(data, list) else []
+
+    def get_batch_quotes(self, tickers: List[str]) -> Dict[str, Dict]:
+        """Quotes for many tickers in one FMP request: quote/AAPL,MSFT,..."""
+        if not tickers:
+            return {}
+        try:
+            url = f"{self.base_url}/quote/{','.join(tickers)}?apikey={self.api_key}"
+            response = requests.get(url, timeout=10)
+            response.raise_for_status()
+            data = response.json()
+        except Exception as e:
+            print(f"FMP API Error for batch quote ({len(tickers)} tickers): {e}")
+            return {}
+
+        if not isinstance(data, list):
+            return {}
+        return {q["symbol"].upper(): q for q in data
+                if isinstance(q, dict) and q.get("symbol")}
+
+    def get_price_history(self, ticker: str, date_from: Optional[str] = None) -> List[Dict]:
+        """Daily OHLCV bars from FMP historical-price-full (newest first)"""
+        params = {"apikey": self.api_key}
+        if date_from:
+            params["from"] = date_from
+        try:
+            response = requests.get(f"{self.base_url}/historical-price-full/{ticker}",
+                                    params=params, timeout=15)
+            response.raise_for_status()
+            data = response.json()
+        except Exception as e:
+            print(f"FMP API Error for price history {ticker}: {e}")
+            return []
+        return data.get("historical", []) if isinstance(data, dict) else []
+
     def extract_fmp_value(self, data: Optional[Dict],
                           field_name: str) -> Optional[float]:
         """Extract numeric value from FMP response"""
@@ -414,15 +476,24 @@ class FMPStockAnalyzer:
             "weighted_average": None
         }
 
-        # Method 1: DCF approximation
-        cash_flow = self.call_fmp_api(f"cash-flow-statement/{ticker}")
-        if cash_flow:
-            free_cash_flow = self.extract_fmp_value(cash_flow, 'freeCashFlow')
-            if free_cash_flow and free_cash_flow > 0:
-                details["dcf_method"] = free_cash_flow * 10 / 1000000
+        cash_flows = self.call_fmp_api_list(f"cash-flow-statement/{ticker}")
+        balance_sheet = self.call_fmp_api(f"balance-sheet-statement/{ticker}")
+        incomes = self.call_fmp_api_list(f"income-statement/{ticker}")
+        income_statement = incomes[0] if incomes else None
+
+        # Method 1: DCF per share (FCF projection + exit multiple) + Monte Carlo bands
+        dcf_inputs = build_inputs(cash_flows, incomes, balance_sheet)
+        if not dcf_inputs:
+            fundamentals_cache.mark_not_applicable(ticker)
+        else:
+            fundamentals_cache.put(ticker, dcf_inputs)
+            base_case = float(dcf_value(dcf_inputs, dcf_inputs["growth"], dcf_inputs["discount_rate"]))
+            if base_case > 0:
+                details["dcf_method"] = base_case
+            details["dcf_monte_carlo"] = {"base_case": round(base_case, 2),
+                                          **monte_carlo(dcf_inputs, current_price)}
 
         # Method 2: Book Value
-        balance_sheet = self.call_fmp_api(f"balance-sheet-statement/{ticker}")
         if balance_sheet:
             book_value = self.extract_fmp_value(balance_sheet,
                                                 'totalStockholdersEquity')
@@ -431,7 +502,6 @@ class FMPStockAnalyzer:
                 details["book_value_method"] = book_value / shares
 
         # Method 3: Earnings multiple
-        income_statement = self.call_fmp_api(f"income-statement/{ticker}")
         if income_statement:
             eps = self.extract_fmp_value(income_statement, 'eps')
             if eps and eps > 0:
@@ -476,6 +546,22 @@ class FMPStockAnalyzer:
 
         return None, details
 
+    def get_dcf_inputs(self, ticker: str) -> Optional[Dict[str, Any]]:
+        """
+        DCF inputs from the fundamentals cache; on a miss — one set of statement calls.
+        "Not applicable" (no positive FCF / share count) is cached too.
+        """
+        inputs = fundamentals_cache.get(ticker)
+        if inputs is None and not fundamentals_cache.is_not_applicable(ticker):
+            inputs = build_inputs(self.call_fmp_api_list(f"cash-flow-statement/{ticker}"),
+                                  self.call_fmp_api_list(f"income-statement/{ticker}"),
+                                  self.call_fmp_api(f"balance-sheet-statement/{ticker}"))
+            if inputs:
+                fundamentals_cache.put(ticker, inputs)
+            else:
+                fundamentals_cache.mark_not_applicable(ticker)
+        return inputs
+
     def get_complete_stock_data(self, ticker: str) -> Dict[str, Any]:
         """Get comprehensive stock data from multiple FMP endpoints"""
         result = {
@@ -525,6 +611,10 @@ class FMPStockAnalyzer:
 
 # Initialize analyzer
 analyzer = FMPStockAnalyzer(FMP_API_KEY)
+price_hub.set_fetcher(analyzer.get_batch_quotes)
+price_history.set_fetcher(analyzer.get_price_history)
+alert_engine.set_fetcher(analyzer.get_batch_quotes)
+alert_engine.set_valuer(analyzer.get_dcf_inputs)
 
 # ==========================================
 # EMAIL SYSTEM
@@ -711,6 +801,77 @@ def send_referral_reward_email(referrer_email: str, new_balance: int,
         print(f"❌ Error sending referral email: {e}")
 
 
+def send_alert_email(user_id, alerts: List[Dict[str, Any]]):
+    """
+    Send one email with all pending alerts for the user.
+    Raises on any failure: alert_engine keeps the alerts queued and retries.
+    """
+    if not GMAIL_PASSWORD:
+        raise RuntimeError("GMAIL_PASSWORD is not configured")
+
+    contact = AUTH.get_user_contact(user_id)
+    if not contact or not contact.get("email"):
+        raise RuntimeError(f"No email for alert recipient {user_id}")
+
+    labels = {
+        'price_below': lambda a: f"price ${a['value']:,.2f} fell below ${a['threshold']:,.2f}",
+        'price_above': lambda a: f"price ${a['value']:,.2f} rose above ${a['threshold']:,.2f}",
+        'undervalued': lambda a: f"trades {a['value']:.1f}% below intrinsic value (target {a['threshold']:.0f}%)",
+    }
+    rows = "".join(
+        f"<tr><td style=\"padding: 8px; color: #ffd700; font-weight: bold;\">{a['symbol']}</td>"
+        f"<td style=\"padding: 8px;\">{labels[a['kind']](a)}</td></tr>"
+        for a in alerts
+    )
+
+    msg = MIMEMultipart()
+    msg['From'] = GMAIL_EMAIL
+    msg['To'] = contact['email']
+    symbols = ", ".join(sorted({a['symbol'] for a in alerts}))
+    msg['Subject'] = f"🔔 ProfitPal Alert: {symbols}"
+
+    body = f"""
+<!DOCTYPE html>
+<html>
+<head>
+    <style>
+        body {{ font-family: 'Inter', Arial, sans-serif; line-height: 1.6; color: #333; }}
+        .container {{ max-width: 600px; margin: 0 auto; background: linear-gradient(135deg, #0a0e27, #1e3a5f); color: white; border-radius: 20px; padding: 40px; }}
+        .alert-box {{ background: rgba(255, 215, 0, 0.1); border: 2px solid #ffd700; border-radius: 15px; padding: 20px; margin: 20px 0; }}
+    </style>
+</head>
+<body>
+    <div class="container">
+        <h1 style="color: #ffd700; text-align: center;">🔔 Your Alerts Triggered</h1>
+        <p>Hi {contact.get('full_name') or 'there'},</p>
+
+        <div class="alert-box">
+            <table style="width: 100%; color: white; border-collapse: collapse;">{rows}</table>
+        </div>
+
+        <p style="opacity: 0.8;">Each alert fires once. Set it again in your portfolio if you want to keep watching.</p>
+
+        <div style="text-align: center; margin-top: 30px;">
+            <a href="{YOUR_DOMAIN}/portfolio" style="background: #32cd32; color: white; padding: 15px 30px; text-decoration: none; border-radius: 25px; font-weight: bold;">Open Portfolio →</a>
+        </div>
+    </div>
+</body>
+</html>
+        """
+
+    msg.attach(MIMEText(body, 'html'))
+
+    with smtplib.SMTP('smtp.gmail.com', 587) as server:
+        server.starttls()
+        server.login(GMAIL_EMAIL, GMAIL_PASSWORD)
+        server.send_message(msg)
+
+    print(f"🔔 Alert email sent to: {contact['email']} ({len(alerts)} alerts)")
+
+
+alert_engine.set_notifier(send_alert_email)
+
+
 def send_donation_thank_you_email(email: str, amount: float,
                                   donation_type: str):
     """Send personalized thank you email for donations"""
@@ -983,20 +1144,16 @@ def _resolve_user_id_or_none(email: str, license_key: str, result: dict):
         except Exception:
             pass
 
-    # 2) fallback — поиск в БД по email / license_key
-    with _db() as con:
-        row = None
-        if email:
-            row = con.execute("SELECT id FROM users WHERE email = ?",
-                              (email, )).fetchone()
-        if not row and license_key:
+    # 2) fallback — поиск по email (blind index) / license_key
+    if email:
+        u = AUTH.get_user_by_email(email)
+        if u and u.get("id"):
+            return int(u["id"])
+    row = None
+    if license_key:
+        with _db() as con:
             row = con.execute("SELECT id FROM users WHERE license_key = ?",
                               (license_key, )).fetchone()
-        if not row and email and license_key:
-            row = con.execute(
-                "SELECT id FROM users WHERE email = ? AND license_key = ?",
-                (email, license_key),
-            ).fetchone()
     return row["id"] if row else None
 
 
@@ -1355,45 +1512,22 @@ def dbg_session(request: Request):
 def referral_stats_me(user=Depends(require_user)):
     """
     Return referral stats for the currently authenticated user.
-    Safe defaults if referral tables aren't present.
+    Один кросс-хранилищный запрос: users -> referrals -> referral_uses
+    -> donations -> user_sessions (см. storage.DASHBOARD_SQL).
+    Safe defaults if nothing is found.
     """
-    from security import _db
     stats = {"email": None, "referrals": 0, "free_months": 0}
 
     try:
-        with _db() as con:
-            # 1) узнаём email текущего пользователя
-            row = con.execute("SELECT email FROM users WHERE id = ?",
-                              (user["id"], )).fetchone()
-            if row:
-                stats["email"] = row["email"]
-
-            # 2) попытка посчитать рефералы (работает, если есть такая таблица/поле)
-            # Попробуем по user_id:
-            try:
-                r = con.execute(
-                    "SELECT COUNT(*) AS c FROM referrals WHERE referrer_user_id = ?",
-                    (user["id"], )).fetchone()
-                if r and "c" in r.keys() and r["c"] is not None:
-                    stats["referrals"] = int(r["c"])
-            except Exception:
-                # Альтернатива — по email (если вдруг так хранится)
-                if stats["email"]:
-                    try:
-                        r = con.execute(
-                            "SELECT COUNT(*) AS c FROM referrals WHERE referrer_email = ?",
-                            (stats["email"], )).fetchone()
-                        if r and "c" in r.keys() and r["c"] is not None:
-                            stats["referrals"] = int(r["c"])
-                    except Exception:
-                        pass
-
-            # 3) бесплатные месяцы, если где-то считаются/копятся
-            # Если у тебя есть отдельная таблица/поле — подставь свой запрос.
-            # Иначе оставим 0.
-    except Exception:
+        summary = fetch_dashboard_summary(int(user["id"]))
+        if summary:
+            info = summary["referral_info"] or {}
+            stats.update(summary)
+            stats["referrals"] = int(info.get("total_referrals") or 0)
+            stats["free_months"] = int(info.get("free_months_balance") or 0)
+    except Exception as e:
         # тихо даём дефолт, чтобы UI не падал
-        pass
+        print(f"[referral_stats_me] dashboard query failed: {e}")
 
     return stats
 
@@ -1408,21 +1542,100 @@ async def create_transaction(transaction: dict, current_user = Depends(get_curre
     transaction_id = add_transaction(current_user['id'], transaction)
     return {"success": True, "id": transaction_id}
 
+@app.post("/api/transactions/import")
+def import_transactions_csv(file: UploadFile = File(...),
+                            layout: str = Form("auto"),
+                            current_user = Depends(require_user)):
+    """
+    Пакетный импорт CSV (generic / ibkr / schwab, по умолчанию определяется
+    по заголовку). Sync-эндпоинт: разбор и запись идут в threadpool.
+    """
+    try:
+        return import_transactions(current_user['id'], file.file, layout=layout)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def _export_response(export) -> StreamingResponse:
+    chunks, media_type, filename = export
+    return StreamingResponse(chunks, media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@app.get("/api/transactions/export")
+async def export_transactions_file(format: str = "csv",
+                                   gzip: bool = False,
+                                   type: Optional[str] = None,
+                                   symbol: Optional[str] = None,
+                                   date_from: Optional[str] = None,
+                                   date_to: Optional[str] = None,
+                                   current_user = Depends(require_user)):
+    """Потоковый экспорт журнала: csv / jsonl / xlsx, опционально gzip"""
+    try:
+        return _export_response(export_transactions(
+            current_user['id'], format, gzip, tx_type=type, symbol=symbol,
+            date_from=date_from, date_to=date_to))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.get("/api/transactions")
-async def read_transactions(current_user = Depends(get_current_user)):
-    transactions = get_transactions(current_user['id'])
-    return {"transactions": transactions}
+async def read_transactions(limit: int = 100,
+                            cursor: Optional[str] = None,
+                            type: Optional[str] = None,
+                            symbol: Optional[str] = None,
+                            date_from: Optional[str] = None,
+                            date_to: Optional[str] = None,
+                            current_user = Depends(get_current_user)):
+    """Страница журнала (keyset по date, id): next_cursor -> ?cursor= следующей страницы"""
+    try:
+        return get_transactions(current_user['id'], limit=limit, cursor=cursor,
+                                tx_type=type, symbol=symbol,
+                                date_from=date_from, date_to=date_to)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
 @app.delete("/api/transactions/{transaction_id}")
 async def remove_transaction(transaction_id: int, current_user = Depends(get_current_user)):
     delete_transaction(current_user['id'], transaction_id)
     return {"success": True}
 
+@app.get("/api/portfolio/positions")
+async def read_positions(method: str = "fifo", current_user = Depends(get_current_user)):
+    """Открытые позиции, средняя цена и реализованный P&L (fifo / lifo / average)"""
+    if method not in PORTFOLIO_METHODS:
+        raise HTTPException(status_code=400,
+                            detail=f"method must be one of {', '.join(PORTFOLIO_METHODS)}")
+    return get_portfolio(current_user['id'], method)
+
+@app.get("/api/portfolio/analysis")
+def read_portfolio_analysis(current_user = Depends(get_current_user)):
+    """
+    Портфель целиком: взвешенные P/E, долг, разрыв с intrinsic value и
+    распределение вердиктов. Sync: анализ тикеров идёт в пуле потоков.
+    """
+    return analyze_portfolio(
+        current_user['id'],
+        lambda ticker: run_stock_analysis(AnalysisRequest(ticker=ticker)).model_dump(),
+        analyzer.get_batch_quotes)
+
+@app.get("/api/portfolio/risk")
+def read_portfolio_risk(window: int = 252, current_user = Depends(require_user)):
+    """Риск по открытым длинным позициям + строка "portfolio" по весам стоимости"""
+    holdings = [h for h in get_holdings(current_user['id']) if h['type'] == 'stock' and h['quantity'] > 0]
+    quantities = {h['symbol']: h['quantity'] for h in holdings}
+    try:
+        return compute_risk(list(quantities), quantities=quantities, window=window)
+    except ValueError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+@app.get("/api/portfolio/holdings")
+async def read_holdings(current_user = Depends(get_current_user)):
+    """Текущие открытые позиции (FIFO) из материализованной journal.positions"""
+    return {"holdings": get_holdings(current_user['id'])}
+
 # API для Watchlist
 @app.post("/api/watchlist")
 async def add_to_watchlist(data: dict, current_user = Depends(get_current_user)):
     # Добавляем в watchlist
-    conn = sqlite3.connect('profitpal.db')
+    conn = get_connection()
     c = conn.cursor()
     c.execute('INSERT OR IGNORE INTO watchlist (user_id, symbol) VALUES (?, ?)',
               (current_user['id'], data['symbol']))
@@ -1430,9 +1643,158 @@ async def add_to_watchlist(data: dict, current_user = Depends(get_current_user))
     conn.close()
     return {"success": True}
 
+@app.get("/api/watchlist/export")
+async def export_watchlist_file(format: str = "csv", gzip: bool = False,
+                                current_user = Depends(require_user)):
+    """Потоковый экспорт watchlist: csv / jsonl / xlsx, опционально gzip"""
+    try:
+        return _export_response(export_watchlist(current_user['id'], format, gzip))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/api/watchlist/enriched")
+def get_watchlist_enriched(current_user = Depends(get_current_user)):
+    """
+    Watchlist одной таблицей: цены — один пакетный запрос FMP quote,
+    P/E / долг / intrinsic value / вердикт — из кэша анализа.
+    """
+    conn = get_connection()
+    try:
+        symbols = [row[0] for row in conn.execute(
+            'SELECT symbol FROM watchlist WHERE user_id = ? ORDER BY symbol', (current_user['id'],))]
+    finally:
+        conn.close()
+    return enrich_symbols(symbols, analyzer.get_batch_quotes)
+
+@app.get("/api/risk")
+def read_risk(symbols: str, window: int = 252, current_user = Depends(require_user)):
+    """Волатильность, просадка, beta к SPY, Sharpe и VaR 95% для ?symbols=AAPL,MSFT"""
+    tickers = normalize_tickers(symbols.split(","))
+    if len(tickers) > MAX_QUERY_SYMBOLS:
+        raise HTTPException(status_code=400, detail=f"Too many symbols (max {MAX_QUERY_SYMBOLS})")
+    try:
+        return compute_risk(tickers, window=window)
+    except ValueError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+@app.get("/api/indicators/{ticker}")
+def read_indicators(ticker: str, days: int = 0, current_user = Depends(require_user)):
+    """SMA/EMA/MACD/RSI/Bollinger/ATR на последний бар; days > 0 — ещё и ряды для графика"""
+    ticker = ticker.strip().upper()
+    if not is_valid_ticker(ticker):
+        raise HTTPException(status_code=400, detail="Invalid ticker")
+    snapshot = indicator_engine.snapshot(ticker)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail=f"No price history for {ticker}")
+    if days > 0:
+        snapshot["series"] = indicator_engine.series(ticker, min(days, 5 * 252))
+    return snapshot
+
+@app.get("/api/valuation/{ticker}/grid")
+def read_valuation_grid(ticker: str, steps: int = 25,
+                        discount_min: Optional[float] = None, discount_max: Optional[float] = None,
+                        growth_min: Optional[float] = None, growth_max: Optional[float] = None,
+                        terminal_multiple: Optional[float] = None,
+                        current_user = Depends(require_user)):
+    """
+    Тепловая карта DCF: стоимость на акцию по сетке ставка дисконтирования x рост
+    (по умолчанию 25x25 вокруг базовых допущений) + линия безубыточности к текущей цене.
+    Одни закэшированные фундаментальные данные, без запросов FMP на ячейку.
+    """
+    ticker = ticker.strip().upper()
+    if not is_valid_ticker(ticker):
+        raise HTTPException(status_code=400, detail="Invalid ticker")
+    overrides = (discount_min, discount_max, growth_min, growth_max, terminal_multiple)
+    if any(v is not None and not math.isfinite(v) for v in overrides):
+        raise HTTPException(status_code=400, detail="Grid parameters must be finite numbers")
+    if terminal_multiple is not None and not 0 < terminal_multiple <= GRID_MAX_MULTIPLE:
+        raise HTTPException(status_code=400,
+                            detail=f"terminal_multiple must be in (0, {GRID_MAX_MULTIPLE:g}]")
+    inputs = analyzer.get_dcf_inputs(ticker)
+    if inputs is None:
+        raise HTTPException(status_code=404,
+                            detail=f"DCF is not applicable for {ticker} (no positive free cash flow or share count)")
+
+    steps = max(2, min(int(steps), 101))
+    base_rate, base_growth = inputs["discount_rate"], inputs["growth"]
+    discount_min = max(0.01, base_rate - 0.04) if discount_min is None else discount_min
+    discount_max = base_rate + 0.06 if discount_max is None else discount_max
+    growth_min = base_growth - 0.10 if growth_min is None else growth_min
+    growth_max = base_growth + 0.10 if growth_max is None else growth_max
+    # оси обрезаются до GRID_*_BOUNDS: рост [-50%, 100%], ставка (0, 100%]
+    discount_min, discount_max = (min(max(v, GRID_DISCOUNT_BOUNDS[0]), GRID_DISCOUNT_BOUNDS[1])
+                                  for v in (discount_min, discount_max))
+    growth_min, growth_max = (min(max(v, GRID_GROWTH_BOUNDS[0]), GRID_GROWTH_BOUNDS[1])
+                              for v in (growth_min, growth_max))
+    if not (discount_min < discount_max) or not (growth_min < growth_max):
+        raise HTTPException(status_code=400, detail="Invalid discount or growth range")
+
+    quote = quote_cache.get_quotes([ticker], analyzer.get_batch_quotes).get(ticker) or {}
+    price = quote.get("price")
+    grid = scenario_grid(inputs, (discount_min, discount_max), (growth_min, growth_max),
+                         steps, price, terminal_multiple)
+    return {
+        "ticker": ticker,
+        "price": price,
+        "base_case": {
+            "discount_rate": base_rate,
+            "growth": round(base_growth, 4),
+            "growth_source": inputs["growth_source"],
+            "terminal_multiple": terminal_multiple or inputs["terminal_multiple"],
+            "value": round(float(dcf_value(inputs, base_growth, base_rate, terminal_multiple)), 2),
+        },
+        **grid,
+    }
+
+@app.get("/api/watchlist/risk")
+def read_watchlist_risk(window: int = 252, current_user = Depends(require_user)):
+    """Риск по тикерам watchlist: не больше MAX_QUERY_SYMBOLS, остальные — в skipped_symbols"""
+    conn = get_connection()
+    try:
+        symbols = normalize_tickers(row[0] for row in conn.execute(
+            'SELECT symbol FROM watchlist WHERE user_id = ? ORDER BY symbol', (current_user['id'],)))
+    finally:
+        conn.close()
+    try:
+        result = compute_risk(symbols[:MAX_QUERY_SYMBOLS], window=window)
+    except ValueError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    # результат compute_risk мемоизирован — не мутируем
+    return {**result, "skipped_symbols": symbols[MAX_QUERY_SYMBOLS:]}
+
+@app.websocket("/ws/prices")
+async def prices_websocket(websocket: WebSocket):
+    """Push цен: один общий опрос FMP на все подключения (price_stream.py)"""
+    await price_hub.serve(websocket)
+
+# ==========================================
+# PRICE ALERTS
+# ==========================================
+
+@app.post("/api/alerts")
+def create_alert(data: dict, current_user = Depends(require_user)):
+    """Правило алерта: {symbol, kind: price_below|price_above|undervalued, threshold}"""
+    try:
+        rule_id = add_rule(current_user['id'], data.get('symbol') or '', data.get('kind') or '',
+                           data.get('threshold'))
+    except (ValueError, TypeError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"success": True, "id": rule_id}
+
+@app.get("/api/alerts")
+def get_alerts(current_user = Depends(require_user)):
+    return {"alerts": list_rules(current_user['id'])}
+
+@app.delete("/api/alerts/{alert_id}")
+def remove_alert(alert_id: int, current_user = Depends(require_user)):
+    if not delete_rule(current_user['id'], alert_id):
+        raise HTTPException(status_code=404, detail="Alert not found")
+    return {"success": True}
+
+
 @app.get("/api/watchlist")
 async def get_watchlist(current_user = Depends(get_current_user)):
-    conn = sqlite3.connect('profitpal.db')
+    conn = get_connection()
     c = conn.cursor()
     c.execute('SELECT symbol FROM watchlist WHERE user_id = ?', (current_user['id'],))
     symbols = [row[0] for row in c.fetchall()]
@@ -1445,6 +1807,26 @@ async def get_watchlist(current_user = Depends(get_current_user)):
 # ==========================================
 
 
+def login_throttled(request: Request, email: str) -> Optional[JSONResponse]:
+    """
+    429, если IP или email превысили лимит попыток (rate_limit.py).
+    Вызывается ДО любых обращений к БД и Fernet.
+    """
+    ip = client_ip(request)
+    retry_after = login_throttle.check(ip, email)
+    if retry_after is None:
+        return None
+    print(f"🚦 Login throttled: ip={ip}, retry in {retry_after}s")
+    return JSONResponse(
+        {
+            "success": False,
+            "error": "Too many login attempts. Please try again later.",
+            "retry_after": retry_after
+        },
+        status_code=429,
+        headers={"Retry-After": str(retry_after)})
+
+
 @app.post("/api/logout")
 def api_logout(request: Request,
                response: Response,
@@ -1470,6 +1852,10 @@ async def check_credentials(request: Request):
         email_raw = (body.get('email') or '').strip()
         license_key_raw = (body.get('license_key') or '').strip()
 
+        throttled = login_throttled(request, email_raw)
+        if throttled:
+            return throttled
+
         if not email_raw or not license_key_raw:
             return JSONResponse(
                 {
@@ -1642,7 +2028,11 @@ async def authenticate_user_ep(request: Request, response: Response):
         if not email or not license_key:
             return JSONResponse({"success": False, "error": "Email and license key required"}, status_code=400)
 
-        ip = request.client.host if request.client else "unknown"
+        throttled = login_throttled(request, email)
+        if throttled:
+            return throttled
+
+        ip = client_ip(request)
         ua = request.headers.get("user-agent", "unknown")
 
         def _norm(s: str) -> str:
@@ -1724,7 +2114,11 @@ async def api_authenticate(request: Request, response: Response):
         license_key = (body.get("license_key") or "").strip()
         full_name = (body.get("full_name") or "").strip() or None
 
-        ip_address = request.client.host if request.client else "unknown"
+        throttled = login_throttled(request, email)
+        if throttled:
+            return throttled
+
+        ip_address = client_ip(request)
         user_agent = request.headers.get("user-agent", "unknown")
 
         result = authenticate_user_login(
@@ -2120,6 +2514,10 @@ async def api_login(request: Request):
         license_key = data.get('license_key', '').strip().upper()
         fingerprint = data.get('fingerprint', {})
 
+        throttled = login_throttled(request, email)
+        if throttled:
+            return throttled
+
         # Validate input
         if not email or not license_key:
             raise HTTPException(status_code=400,
@@ -2192,15 +2590,14 @@ def record_user_login(email: str, license_key: str, fingerprint: dict,
                       request: Request):
     """Record user login with fingerprint for tracking"""
     try:
-        client_ip = request.client.host if hasattr(request,
-                                                   'client') else 'unknown'
+        ip_address = client_ip(request)
 
         login_data = {
             'email': email,
             'license_key': license_key,
             'fingerprint': fingerprint,
             'login_time': datetime.now().isoformat(),
-            'ip_address': client_ip,
+            'ip_address': ip_address,
             'user_agent': request.headers.get('user-agent', 'unknown')
         }
 
@@ -2211,7 +2608,7 @@ def record_user_login(email: str, license_key: str, fingerprint: dict,
         print(f"   📧 Email: {email}")
         print(f"   🔑 License: {license_key}")
         print(f"   📱 Device: {fingerprint.get('platform', 'unknown')}")
-        print(f"   🌍 IP: {client_ip}")
+        print(f"   🌍 IP: {ip_address}")
 
     except Exception as e:
         print(f"❌ Error recording login: {e}")
@@ -2450,41 +2847,18 @@ async def get_upgrade_options(request: Request):
 
 @app.post("/api/check-free-trial")
 async def check_free_trial(request: FreeTrialRequest):
-    """Проверка лимита бесплатных анализов по fingerprint"""
+    """Проверка лимита бесплатных анализов по fingerprint (в памяти, см. free_trial_quota.py)"""
     try:
         print(
             f"🔍 Checking free trial for fingerprint: {request.fingerprint[:10]}..."
         )
 
-        # 🔥 ПРИНУДИТЕЛЬНО СОЗДАЕМ ТАБЛИЦУ ПЕРЕД ЗАПРОСОМ
-        create_free_trial_table()
-
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-
-        cursor.execute(
-            '''
-            SELECT analyses_used, max_analyses 
-            FROM free_trials 
-            WHERE fingerprint = ?
-        ''', (request.fingerprint, ))
-
-        result = cursor.fetchone()
-        conn.close()
-
-        if result:
-            analyses_used, max_analyses = result
-            remaining = max_analyses - analyses_used
-            allowed = remaining > 0
-            print(
-                f"📊 Existing user: {analyses_used}/{max_analyses} used, remaining: {remaining}"
-            )
-        else:
-            analyses_used = 0
-            max_analyses = 5
-            remaining = 5
-            allowed = True
-            print(f"🆕 New user: {remaining} analyses available")
+        analyses_used, max_analyses = free_trial_quota.check(request.fingerprint)
+        remaining = max(0, max_analyses - analyses_used)
+        allowed = remaining > 0
+        print(
+            f"📊 Free trial: {analyses_used}/{max_analyses} used, remaining: {remaining}"
+        )
 
         return JSONResponse(
             content={
@@ -2503,54 +2877,28 @@ async def check_free_trial(request: FreeTrialRequest):
 
 @app.post("/api/record-free-trial")
 async def record_free_trial(request: FreeTrialRecordRequest):
-    """Запись использования бесплатного анализа"""
+    """Запись использования бесплатного анализа (атомарно, сверх лимита не засчитывает)"""
     try:
         print(
             f"📝 Recording free trial usage: {request.fingerprint[:10]}... ticker: {request.ticker}"
         )
 
-        # 🔥 ПРИНУДИТЕЛЬНО СОЗДАЕМ ТАБЛИЦУ ПЕРЕД ЗАПИСЬЮ
-        create_free_trial_table()
+        allowed, new_count, max_analyses = free_trial_quota.try_consume(request.fingerprint)
+        remaining = max(0, max_analyses - new_count)
 
-        conn = sqlite3.connect(DATABASE_PATH)
-        cursor = conn.cursor()
-
-        cursor.execute(
-            '''
-            SELECT analyses_used, max_analyses 
-            FROM free_trials 
-            WHERE fingerprint = ?
-        ''', (request.fingerprint, ))
-
-        result = cursor.fetchone()
-
-        if result:
-            analyses_used, max_analyses = result
-            new_count = analyses_used + 1
-
-            cursor.execute(
-                '''
-                UPDATE free_trials 
-                SET analyses_used = ?, last_used = CURRENT_TIMESTAMP
-                WHERE fingerprint = ?
-            ''', (new_count, request.fingerprint))
-
-            print(f"📈 Updated existing user: {new_count}/{max_analyses} used")
-        else:
-            cursor.execute(
-                '''
-                INSERT INTO free_trials (fingerprint, analyses_used, max_analyses)
-                VALUES (?, 1, 5)
-            ''', (request.fingerprint, ))
-
-            new_count = 1
-            max_analyses = 5
-            print(f"🆕 Created new user: {new_count}/{max_analyses} used")
-
-        conn.commit()
-        conn.close()
+        if not allowed:
+            print(f"🚫 Free trial limit reached: {new_count}/{max_analyses}")
+            return JSONResponse(
+                content={
+                    'success': False,
+                    'error': 'Free trial limit reached',
+                    'analyses_used': new_count,
+                    'remaining': 0,
+                    'ticker': request.ticker
+                },
+                status_code=403)
 
-        remaining = max_analyses - new_count
+        print(f"📈 Free trial usage: {new_count}/{max_analyses} used")
 
         return JSONResponse(
             content={
@@ -2660,6 +3008,111 @@ def process_donation(payload: dict,
 # ==========================================
 
 
+def run_stock_analysis(request: AnalysisRequest) -> AnalysisResponse:
+    """Анализ тикера (общий для /analyze и /api/free-analysis). 404 — нет данных."""
+    print(f"📊 Fetching data for {request.ticker.upper()}")
+    stock_data = analyzer.get_complete_stock_data(request.ticker.upper())
+
+    if not stock_data["current_price"]:
+        print(f"❌ No data found for {request.ticker}")
+        raise HTTPException(
+            status_code=404,
+            detail=f"Stock data not found for {request.ticker}")
+
+    current_price = stock_data["current_price"]
+    pe_ratio = stock_data["pe_ratio"]
+    market_cap = stock_data["market_cap"]
+    debt_ratio = stock_data["debt_ratio"]
+    intrinsic_value = stock_data["intrinsic_value"]
+
+    valuation_gap = None
+    if intrinsic_value and current_price:
+        valuation_gap = (
+            (intrinsic_value - current_price) / current_price) * 100
+
+    verdict_factors = []
+
+    if pe_ratio:
+        if request.pe_min <= pe_ratio <= request.pe_max:
+            verdict_factors.append("✅ P/E PASS")
+        else:
+            verdict_factors.append("❌ P/E FAIL")
+
+    if debt_ratio:
+        if debt_ratio <= request.debt_max:
+            verdict_factors.append("✅ DEBT PASS")
+        else:
+            verdict_factors.append("❌ DEBT FAIL")
+
+    if valuation_gap:
+        if valuation_gap > 20:
+            verdict_factors.append("💎 UNDERVALUED")
+        elif valuation_gap < -20:
+            verdict_factors.append("⚠️ OVERVALUED")
+        else:
+            verdict_factors.append("📊 FAIRLY VALUED")
+
+    passed_filters = sum(1 for factor in verdict_factors if "✅" in factor)
+    total_filters = sum(1 for factor in verdict_factors
+                        if ("✅" in factor or "❌" in factor))
+
+    if passed_filters == total_filters and valuation_gap and valuation_gap > 15:
+        final_verdict = "💎 DIAMOND FOUND - Strong fundamentals + undervalued"
+    elif passed_filters == total_filters:
+        final_verdict = "⭐ QUALITY STOCK - Meets all criteria"
+    elif valuation_gap and valuation_gap < -30:
+        final_verdict = "⚠️ OVERVALUED - Price too high vs fundamentals"
+    elif passed_filters >= total_filters * 0.6:
+        final_verdict = "📊 MIXED SIGNALS - Some good, some concerns"
+    else:
+        final_verdict = "🚫 AVOID - Multiple red flags"
+
+    print(f"✅ Analysis complete for {request.ticker}: {final_verdict}")
+
+    # технические индикаторы — по кэшу истории цен; без истории анализ всё равно отдаём
+    try:
+        technical_indicators = indicator_engine.snapshot(request.ticker.upper())
+    except Exception as e:
+        print(f"⚠️ Technical indicators for {request.ticker} failed: {e}")
+        technical_indicators = None
+
+    response = AnalysisResponse(
+        ticker=request.ticker.upper(),
+        current_price=current_price,
+        pe_ratio=pe_ratio,
+        market_cap=market_cap,
+        debt_ratio=debt_ratio,
+        intrinsic_value=intrinsic_value,
+        valuation_gap=valuation_gap,
+        final_verdict=final_verdict,
+        analysis_details={
+            "verdict_factors":
+            verdict_factors,
+            "filters_passed":
+            f"{passed_filters}/{total_filters}",
+            "errors":
+            stock_data.get("errors", []),
+            "dcf":
+            (stock_data.get("intrinsic_value_details") or {}).get("dcf_monte_carlo"),
+            "license_used":
+            request.license_key,
+            "educational_note":
+            "This analysis is for educational purposes only. Not financial advice."
+        },
+        technical_indicators=technical_indicators)
+    # для /api/watchlist/enriched, анализа портфеля и алертов: метрики без повторного
+    # анализа. Вердикт зависит от порогов запроса, а кэш общий для всех — кладём
+    # только результат с порогами по умолчанию, чужие пороги не должны утекать.
+    if _uses_default_thresholds(request):
+        analysis_cache.put(response.ticker, response.model_dump())
+    return response
+
+
+def _uses_default_thresholds(request: AnalysisRequest) -> bool:
+    return all(getattr(request, field) == AnalysisRequest.model_fields[field].default
+               for field in ("pe_min", "pe_max", "debt_max"))
+
+
 @app.post("/analyze", response_model=AnalysisResponse)
 async def analyze_stock(request: AnalysisRequest):
     """Analyze stock with license validation"""
@@ -2671,94 +3124,64 @@ async def analyze_stock(request: AnalysisRequest):
         if request.license_key != "FREE" and request.license_key:
             pass
 
-        print(f"📊 Fetching data for {request.ticker.upper()}")
-        stock_data = analyzer.get_complete_stock_data(request.ticker.upper())
-
-        if not stock_data["current_price"]:
-            print(f"❌ No data found for {request.ticker}")
-            raise HTTPException(
-                status_code=404,
-                detail=f"Stock data not found for {request.ticker}")
-
-        current_price = stock_data["current_price"]
-        pe_ratio = stock_data["pe_ratio"]
-        market_cap = stock_data["market_cap"]
-        debt_ratio = stock_data["debt_ratio"]
-        intrinsic_value = stock_data["intrinsic_value"]
-
-        valuation_gap = None
-        if intrinsic_value and current_price:
-            valuation_gap = (
-                (intrinsic_value - current_price) / current_price) * 100
+        return run_stock_analysis(request)
 
-        verdict_factors = []
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"❌ Analysis failed for {request.ticker}: {str(e)}")
+        raise HTTPException(status_code=500,
+                            detail=f"Analysis failed: {str(e)}")
 
-        if pe_ratio:
-            if request.pe_min <= pe_ratio <= request.pe_max:
-                verdict_factors.append("✅ P/E PASS")
-            else:
-                verdict_factors.append("❌ P/E FAIL")
 
-        if debt_ratio:
-            if debt_ratio <= request.debt_max:
-                verdict_factors.append("✅ DEBT PASS")
-            else:
-                verdict_factors.append("❌ DEBT FAIL")
+@app.post("/api/free-analysis")
+def free_analysis(request: FreeAnalysisRequest):
+    """
+    Бесплатный анализ за один запрос: лимит -> анализ -> учёт.
+    Анализ резервируется атомарно (try_consume) и возвращается, если
+    анализ не удался, — засчитываются только успешные.
+    """
+    print(
+        f"🎟️ Free analysis: {request.fingerprint[:10]}... ticker: {request.ticker}"
+    )
 
-        if valuation_gap:
-            if valuation_gap > 20:
-                verdict_factors.append("💎 UNDERVALUED")
-            elif valuation_gap < -20:
-                verdict_factors.append("⚠️ OVERVALUED")
-            else:
-                verdict_factors.append("📊 FAIRLY VALUED")
-
-        passed_filters = sum(1 for factor in verdict_factors if "✅" in factor)
-        total_filters = sum(1 for factor in verdict_factors
-                            if ("✅" in factor or "❌" in factor))
-
-        if passed_filters == total_filters and valuation_gap and valuation_gap > 15:
-            final_verdict = "💎 DIAMOND FOUND - Strong fundamentals + undervalued"
-        elif passed_filters == total_filters:
-            final_verdict = "⭐ QUALITY STOCK - Meets all criteria"
-        elif valuation_gap and valuation_gap < -30:
-            final_verdict = "⚠️ OVERVALUED - Price too high vs fundamentals"
-        elif passed_filters >= total_filters * 0.6:
-            final_verdict = "📊 MIXED SIGNALS - Some good, some concerns"
-        else:
-            final_verdict = "🚫 AVOID - Multiple red flags"
-
-        print(f"✅ Analysis complete for {request.ticker}: {final_verdict}")
-
-        return AnalysisResponse(
-            ticker=request.ticker.upper(),
-            current_price=current_price,
-            pe_ratio=pe_ratio,
-            market_cap=market_cap,
-            debt_ratio=debt_ratio,
-            intrinsic_value=intrinsic_value,
-            valuation_gap=valuation_gap,
-            final_verdict=final_verdict,
-            analysis_details={
-                "verdict_factors":
-                verdict_factors,
-                "filters_passed":
-                f"{passed_filters}/{total_filters}",
-                "errors":
-                stock_data.get("errors", []),
-                "license_used":
-                request.license_key,
-                "educational_note":
-                "This analysis is for educational purposes only. Not financial advice."
-            })
+    allowed, used, max_analyses = free_trial_quota.try_consume(request.fingerprint)
+    if not allowed:
+        return JSONResponse(
+            content={
+                'allowed': False,
+                'used': used,
+                'remaining': 0,
+                'max_analyses': max_analyses,
+                'error': 'Free trial limit reached'
+            },
+            status_code=403)
 
+    try:
+        analysis = run_stock_analysis(
+            AnalysisRequest(ticker=request.ticker,
+                            license_key="FREE",
+                            pe_min=request.pe_min,
+                            pe_max=request.pe_max,
+                            debt_max=request.debt_max))
     except HTTPException:
+        free_trial_quota.release(request.fingerprint)
         raise
     except Exception as e:
-        print(f"❌ Analysis failed for {request.ticker}: {str(e)}")
+        free_trial_quota.release(request.fingerprint)
+        print(f"❌ Free analysis failed for {request.ticker}: {str(e)}")
         raise HTTPException(status_code=500,
                             detail=f"Analysis failed: {str(e)}")
 
+    return JSONResponse(
+        content={
+            'allowed': True,
+            'used': used,
+            'remaining': max(0, max_analyses - used),
+            'max_analyses': max_analyses,
+            'analysis': analysis.model_dump()
+        })
+
 
 # ==========================================
 # ADMIN ENDPOINTS
@@ -2769,8 +3192,10 @@ async def analyze_stock(request: AnalysisRequest):
 async def get_admin_stats():
     """Get comprehensive system statistics + REFERRAL stats"""
     try:
-        auth_stats = get_auth_stats()
-        referral_stats = referral_mgr.get_all_referral_stats()
+        # auth — из счётчиков stat_counters, referrals — одним запросом
+        overview = fetch_admin_overview()
+        auth_stats = overview["auth"]
+        referral_stats = overview["referrals"]
 
         return JSONResponse(
             content={
@@ -2802,6 +3227,12 @@ async def get_admin_stats():
                             status_code=500)
 
 
+@app.get("/admin/metrics")
+async def get_admin_metrics(admin = Depends(require_admin)):
+    """In-process метрики: счётчики логинов, throttle, write-behind буферы"""
+    return JSONResponse(content=metrics.snapshot())
+
+
 @app.get("/health")
 def health_check():
     """System health check + REFERRAL system"""
@@ -2818,7 +3249,7 @@ def health_check():
         "endpoints": [
             "/", "/analysis", "/fake-dashboard", "/validate-credentials",
             "/api/stripe-key", "/create-checkout-session",
-            "/create-subscription-checkout", "/stripe-webhook", "/analyze",
+            "/create-subscription-checkout", "/stripe-webhook", "/analyze", "/api/free-analysis",
             "/api/referral-stats/{email}", "/api/referral-link/{email}",
             "/api/process-donation", "/api/upgrade-subscription",
             "/api/get-upgrade-options", "/ref/{referral_code}"
@@ -2835,8 +3266,6 @@ def health_check():
 if __name__ == "__main__":
     import uvicorn
 
-    create_free_trial_table()
-
     print("\n" + "=" * 60)
     print("🚀🚀🚀 PROFITPAL PRO SERVER v2.0 STARTING 🚀🚀🚀")
     print("=" * 60)
@@ -0,0 +1,212 @@
+# market_data.py - Котировки пачкой и кэш результатов анализа
+#
+# GET /api/watchlist отдавал только тикеры, и чтобы увидеть цифры, по
+# каждому символу запускали /analyze (5-6 запросов к FMP на тикер).
+# Здесь:
+#
+#   QuoteCache    - цены из ОДНОГО запроса FMP quote/AAPL,MSFT,... на пачку
+#                   до QUOTE_BATCH_SIZE символов; свежие (QUOTE_TTL) котировки
+#                   не перезапрашиваются. Watchlist на 100 тикеров — один
+#                   запрос к FMP.
+#   AnalysisCache - последний результат run_stock_analysis по тикеру (P/E,
+#                   долг, intrinsic value, вердикт), LRU + TTL: фундаментальные
+#                   данные меняются редко, пересчитывать их ради таблицы не нужно.
+#                   Только анализ с порогами P/E и долга по умолчанию — вердикт
+#                   с чужими порогами другим пользователям не показывается.
+#
+# Сам HTTP-запрос к FMP делает FMPStockAnalyzer.get_batch_quotes (main.py),
+# сюда он передаётся как fetch(symbols) -> {symbol: quote}.
+#
+# Тикеры из запросов попадают в URL FMP и в имена файлов price_store,
+# поэтому normalize_tickers пропускает только TICKER_RE.
+
+import os
+import re
+import time
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import metrics
+
+QUOTE_TTL_SEC = float(os.getenv("QUOTE_TTL", "15"))
+QUOTE_BATCH_SIZE = int(os.getenv("QUOTE_BATCH_SIZE", "200"))
+QUOTE_CACHE_SIZE = 20000
+ANALYSIS_CACHE_TTL_SEC = float(os.getenv("ANALYSIS_CACHE_TTL", "21600"))
+ANALYSIS_CACHE_SIZE = int(os.getenv("ANALYSIS_CACHE_SIZE", "5000"))
+
+QuoteFetcher = Callable[[List[str]], Dict[str, Dict[str, Any]]]
+
+# AAPL, BRK.B, BF-B, ^GSPC
+TICKER_RE = re.compile(r"^[A-Z0-9.\-^]{1,15}$")
+
+
+def is_valid_ticker(symbol: str) -> bool:
+    """Уже нормализованный (верхний регистр) тикер без посторонних символов."""
+    # fullmatch: "$" в re.match пропустил бы завершающий перевод строки
+    return bool(TICKER_RE.fullmatch(symbol))
+
+
+def normalize_tickers(symbols: Iterable[str]) -> List[str]:
+    """Верхний регистр, без пустых, недопустимых и дубликатов, порядок сохраняется."""
+    return list(dict.fromkeys(
+        s for s in (s.strip().upper() for s in symbols if s) if is_valid_ticker(s)
+    ))
+
+
+class QuoteCache:
+    """Короткоживущий кэш котировок с пакетной догрузкой недостающих."""
+
+    def __init__(self, ttl_sec: float = QUOTE_TTL_SEC, batch_size: int = QUOTE_BATCH_SIZE):
+        self.ttl_sec = ttl_sec
+        self.batch_size = batch_size
+        # symbol -> (fetched_at monotonic, quote)
+        self._quotes: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.upstream_calls = 0
+
+    def get_quotes(self, symbols: Iterable[str], fetch: QuoteFetcher,
+                   max_age: Optional[float] = None) -> Dict[str, Dict[str, Any]]:
+        """{symbol: quote} — из кэша, недостающие одним запросом на пачку."""
+        max_age = self.ttl_sec if max_age is None else max_age
+        symbols = normalize_tickers(symbols)
+        now = time.monotonic()
+        result: Dict[str, Dict[str, Any]] = {}
+        missing = []
+
+        with self._lock:
+            for symbol in symbols:
+                entry = self._quotes.get(symbol)
+                if entry is not None and now - entry[0] < max_age:
+                    result[symbol] = entry[1]
+                else:
+                    missing.append(symbol)
+            self.hits += len(result)
+            self.misses += len(missing)
+
+        for i in range(0, len(missing), self.batch_size):
+            fetched = fetch(missing[i:i + self.batch_size]) or {}
+            self.upstream_calls += 1
+            metrics.inc("quotes.upstream_calls")
+            self.store(fetched)
+            result.update((s, q) for s, q in fetched.items() if s in missing)
+        return result
+
+    def store(self, quotes: Dict[str, Dict[str, Any]]):
+        now = time.monotonic()
+        with self._lock:
+            for symbol, quote in quotes.items():
+                self._quotes[symbol.upper()] = (now, quote)
+            if len(self._quotes) > QUOTE_CACHE_SIZE:
+                stale = [s for s, (t, _) in self._quotes.items() if now - t >= self.ttl_sec]
+                for symbol in stale:
+                    del self._quotes[symbol]
+
+    def get_stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "symbols": len(self._quotes),
+            "ttl_sec": self.ttl_sec,
+            "batch_size": self.batch_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "upstream_calls": self.upstream_calls,
+            "hit_rate": round(self.hits / total, 4) if total else None,
+        }
+
+
+class AnalysisCache:
+    """LRU + TTL: тикер -> последний результат анализа (dict AnalysisResponse)."""
+
+    def __init__(self, max_entries: int = ANALYSIS_CACHE_SIZE, ttl_sec: float = ANALYSIS_CACHE_TTL_SEC):
+        self.max_entries = max_entries
+        self.ttl_sec = ttl_sec
+        # ticker -> (expires_at monotonic, analysis)
+        self._entries: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, ticker: str, analysis: Dict[str, Any]):
+        ticker = ticker.upper()
+        analysis = dict(analysis, analyzed_at=datetime.now().isoformat(timespec="seconds"))
+        with self._lock:
+            self._entries.pop(ticker, None)
+            self._entries[ticker] = (time.monotonic() + self.ttl_sec, analysis)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, ticker: str) -> Optional[Dict[str, Any]]:
+        ticker = ticker.upper()
+        with self._lock:
+            entry = self._entries.get(ticker)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[ticker]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(ticker)
+            self.hits += 1
+            return entry[1]
+
+    def get_stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_sec": self.ttl_sec,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else None,
+        }
+
+
+def _number(value) -> Optional[float]:
+    try:
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+def enrich_symbols(symbols: Iterable[str], fetch: QuoteFetcher) -> Dict[str, Any]:
+    """
+    Таблица watchlist: живая цена из котировок + метрики из кэша анализа.
+    Для тикеров, которые ещё не анализировались, метрики None (P/E берётся из котировки).
+    """
+    symbols = normalize_tickers(symbols)
+    calls_before = quote_cache.upstream_calls
+    quotes = quote_cache.get_quotes(symbols, fetch)
+
+    rows = []
+    for symbol in symbols:
+        quote = quotes.get(symbol) or {}
+        analysis = analysis_cache.get(symbol) or {}
+        price = _number(quote.get("price")) or analysis.get("current_price")
+        intrinsic = analysis.get("intrinsic_value")
+        rows.append({
+            "symbol": symbol,
+            "name": quote.get("name"),
+            "price": price,
+            "change": _number(quote.get("change")),
+            "change_pct": _number(quote.get("changesPercentage")),
+            "market_cap": _number(quote.get("marketCap")) or analysis.get("market_cap"),
+            "pe_ratio": analysis.get("pe_ratio") or _number(quote.get("pe")),
+            "debt_ratio": analysis.get("debt_ratio"),
+            "intrinsic_value": intrinsic,
+            "upside_pct": round((intrinsic - price) / price * 100, 2) if intrinsic and price else None,
+            "verdict": analysis.get("final_verdict"),
+            "analyzed_at": analysis.get("analyzed_at"),
+        })
+    return {"rows": rows, "upstream_calls": quote_cache.upstream_calls - calls_before}
+
+
+# Глобальные экземпляры
+quote_cache = QuoteCache()
+analysis_cache = AnalysisCache()
+metrics.register_gauge("quote_cache", quote_cache.get_stats)
+metrics.register_gauge("analysis_cache", analysis_cache.get_stats)
@@ -0,0 +1,46 @@
+# metrics.py - Простейшие in-process метрики ProfitPal
+#
+# Счётчики (inc) и "датчики" (register_gauge: функция, которая возвращает
+# текущее значение/словарь). Всё отдаётся одним снимком через /admin/metrics.
+
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict
+
+_lock = threading.Lock()
+_counters: Dict[str, int] = defaultdict(int)
+_gauges: Dict[str, Callable[[], Any]] = {}
+_started_at = time.time()
+
+
+def inc(name: str, value: int = 1):
+    """Увеличить счётчик name на value."""
+    with _lock:
+        _counters[name] += value
+
+
+def register_gauge(name: str, func: Callable[[], Any]):
+    """Зарегистрировать датчик: func() вызывается при каждом снимке."""
+    with _lock:
+        _gauges[name] = func
+
+
+def snapshot() -> Dict[str, Any]:
+    """Текущие значения всех счётчиков и датчиков."""
+    with _lock:
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+
+    values = {}
+    for name, func in gauges.items():
+        try:
+            values[name] = func()
+        except Exception as e:
+            values[name] = {"error": str(e)}
+
+    return {
+        "uptime_sec": round(time.time() - _started_at, 1),
+        "counters": counters,
+        "gauges": values,
+    }
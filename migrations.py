@@ -0,0 +1,590 @@
+# migrations.py - Версионированные миграции схемы ProfitPal
+#
+# Единственное место, где меняется схема. Каждая миграция — (version, name,
+# steps); step — это SQL-строка или функция step(con). Применённые версии
+# пишутся в main.schema_migrations, runner вызывается один раз при старте
+# (storage.init_storage) и применяет только недостающие версии.
+#
+# Имена таблиц в DDL всегда квалифицированы схемой (main / journal / trials /
+# referral / crm), см. storage.ATTACHED_STORES.
+#
+# Ручной запуск: python migrations.py
+
+import hashlib
+import sqlite3
+from typing import Callable, List, Tuple, Union
+
+Step = Union[str, Callable[[sqlite3.Connection], None]]
+
+
+def _columns(con, schema: str, table: str) -> set:
+    return {r[1] for r in con.execute(f"PRAGMA {schema}.table_info({table})")}
+
+
+def _add_column(schema: str, table: str, column: str, decl: str) -> Callable:
+    """ALTER TABLE ADD COLUMN, если колонки ещё нет (старые файлы уже мигрированы вручную)."""
+    def step(con):
+        if column not in _columns(con, schema, table):
+            con.execute(f"ALTER TABLE {schema}.{table} ADD COLUMN {column} {decl}")
+    return step
+
+
+# ==========================================
+# 1. БАЗОВАЯ СХЕМА
+# ==========================================
+
+BASELINE = [
+    # ---- main: аутентификация ----
+    '''
+    CREATE TABLE IF NOT EXISTS main.users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        encrypted_email TEXT UNIQUE NOT NULL,
+        encrypted_full_name TEXT NOT NULL,
+        license_key TEXT UNIQUE NOT NULL,
+        stripe_customer_id TEXT,
+        payment_status TEXT DEFAULT 'completed',
+        card_last4 TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        last_login TIMESTAMP,
+        login_count INTEGER DEFAULT 0,
+        is_active BOOLEAN DEFAULT 1
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS main.user_sessions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        session_token TEXT UNIQUE NOT NULL,
+        expires_at TIMESTAMP NOT NULL,
+        ip_address TEXT,
+        user_agent TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS main.login_attempts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        email TEXT,
+        license_key TEXT,
+        success BOOLEAN,
+        ip_address TEXT,
+        user_agent TEXT,
+        attempt_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    # ---- journal: Trading Journal, Watchlist, донаты ----
+    '''
+    CREATE TABLE IF NOT EXISTS journal.transactions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT NOT NULL,
+        date DATE NOT NULL,
+        type TEXT NOT NULL,
+        symbol TEXT NOT NULL,
+        action TEXT NOT NULL,
+        quantity INTEGER NOT NULL,
+        price REAL NOT NULL,
+        commission REAL DEFAULT 0,
+        notes TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS journal.watchlist (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT NOT NULL,
+        symbol TEXT NOT NULL,
+        added_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(user_id, symbol)
+    )
+    ''',
+    # ---- trials: бесплатные анализы ----
+    '''
+    CREATE TABLE IF NOT EXISTS trials.free_trials (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        fingerprint TEXT NOT NULL,
+        analyses_used INTEGER DEFAULT 0,
+        max_analyses INTEGER DEFAULT 5,
+        last_used TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE(fingerprint)
+    )
+    ''',
+    # ---- referral: реферальная система ----
+    '''
+    CREATE TABLE IF NOT EXISTS referral.referrals (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_email TEXT NOT NULL UNIQUE,
+        referral_code TEXT NOT NULL UNIQUE,
+        referral_link TEXT NOT NULL,
+        free_months_balance INTEGER DEFAULT 0,
+        total_referrals INTEGER DEFAULT 0,
+        total_earned_months INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS referral.referral_uses (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        referral_code TEXT NOT NULL,
+        referrer_email TEXT NOT NULL,
+        new_user_email TEXT NOT NULL,
+        payment_amount REAL NOT NULL,
+        reward_months INTEGER DEFAULT 1,
+        used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (referral_code) REFERENCES referrals (referral_code)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS referral.free_months_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_email TEXT NOT NULL,
+        action_type TEXT NOT NULL, -- 'earned', 'used', 'expired'
+        months_change INTEGER NOT NULL, -- +1, -1, etc.
+        balance_after INTEGER NOT NULL,
+        description TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    # ---- crm: клиенты и рассылки ----
+    '''
+    CREATE TABLE IF NOT EXISTS crm.customers (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        encrypted_email TEXT UNIQUE NOT NULL,
+        encrypted_card_last4 TEXT,
+        stripe_customer_id TEXT,
+        signup_date TEXT,
+        plan_type TEXT,
+        original_setup_price REAL,
+        current_monthly_price REAL,
+        status TEXT DEFAULT 'active',
+        last_notification TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS crm.price_notifications (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        notification_date TEXT,
+        old_price REAL,
+        new_price REAL,
+        customers_notified INTEGER,
+        effective_date TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS crm.email_stats (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        email_type TEXT,
+        total_sent INTEGER,
+        successful INTEGER,
+        failed INTEGER,
+        sent_date TEXT
+    )
+    ''',
+]
+
+# ==========================================
+# 2. user_sessions (бывший migrate_security.py)
+# ==========================================
+
+SESSIONS = [
+    _add_column("main", "user_sessions", "is_active", "INTEGER NOT NULL DEFAULT 1"),
+    "CREATE INDEX IF NOT EXISTS main.idx_sessions_user ON user_sessions(user_id)",
+    "CREATE INDEX IF NOT EXISTS main.idx_sessions_active_exp ON user_sessions(is_active, expires_at)",
+]
+
+# ==========================================
+# 3. donations + Stripe-колонки users (бывший migrate_donations.py)
+# ==========================================
+
+DONATIONS = [
+    '''
+    CREATE TABLE IF NOT EXISTS journal.donations (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        amount_cents INTEGER NOT NULL,
+        currency TEXT NOT NULL,
+        donation_type TEXT,
+        stripe_payment_intent_id TEXT,
+        status TEXT NOT NULL,
+        created_at TEXT NOT NULL DEFAULT (datetime('now'))
+    )
+    ''',
+    _add_column("main", "users", "stripe_default_pm", "TEXT"),
+    "CREATE INDEX IF NOT EXISTS journal.idx_donations_userid ON donations(user_id)",
+    "CREATE INDEX IF NOT EXISTS journal.idx_donations_created ON donations(created_at)",
+]
+
+# ==========================================
+# 4. индексы под горячие запросы
+# ==========================================
+
+HOT_INDEXES = [
+    # get_transactions: WHERE user_id = ? ORDER BY date DESC
+    "CREATE INDEX IF NOT EXISTS journal.idx_transactions_user_date ON transactions(user_id, date)",
+    # get_referral_statistics / дашборд: WHERE referrer_email = ? ORDER BY used_at DESC
+    "CREATE INDEX IF NOT EXISTS referral.idx_referral_uses_referrer ON referral_uses(referrer_email, used_at)",
+    # история free months: WHERE user_email = ? ORDER BY created_at DESC LIMIT 10
+    "CREATE INDEX IF NOT EXISTS referral.idx_free_months_user ON free_months_history(user_email, created_at)",
+    # today_logins: WHERE attempt_time > ?
+    "CREATE INDEX IF NOT EXISTS main.idx_login_attempts_time ON login_attempts(attempt_time)",
+]
+
+# ==========================================
+# 5. blind index для поиска по зашифрованному email
+# ==========================================
+
+# HMAC(email) считает AuthManager (ключ в ENV); backfill существующих строк —
+# AuthManager.backfill_email_index() при старте, пачками
+EMAIL_BLIND_INDEX = [
+    _add_column("main", "users", "email_bidx", "TEXT"),
+    "CREATE UNIQUE INDEX IF NOT EXISTS main.idx_users_email_bidx ON users(email_bidx)",
+]
+
+# ==========================================
+# 6. счётчики для /admin/stats (O(1) вместо COUNT(*) по растущим таблицам)
+# ==========================================
+
+# Счётчики ведут триггеры — в той же транзакции, что и сама запись, поэтому
+# их видят все пути записи (AuthManager, security.create_session, auth_audit,
+# ensure_admin_user_id). Ключи:
+#   total_users / active_users
+#   sessions_expiring:YYYY-MM-DD  — сессии по дню истечения
+#   logins:YYYY-MM-DD             — успешные входы по дню
+STAT_COUNTERS = [
+    '''
+    CREATE TABLE IF NOT EXISTS main.stat_counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID
+    ''',
+    # активные сессии, истекающие сегодня, досчитываются точно по этому индексу
+    "CREATE INDEX IF NOT EXISTS main.idx_sessions_expires ON user_sessions(expires_at)",
+    '''
+    CREATE TRIGGER IF NOT EXISTS main.trg_users_counters_ins AFTER INSERT ON users
+    BEGIN
+        INSERT INTO stat_counters (name, value) VALUES ('total_users', 1)
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+        INSERT INTO stat_counters (name, value) VALUES ('active_users', COALESCE(NEW.is_active, 0) != 0)
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS main.trg_users_counters_del AFTER DELETE ON users
+    BEGIN
+        INSERT INTO stat_counters (name, value) VALUES ('total_users', -1)
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+        INSERT INTO stat_counters (name, value) VALUES ('active_users', -(COALESCE(OLD.is_active, 0) != 0))
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS main.trg_users_counters_active AFTER UPDATE OF is_active ON users
+    WHEN (COALESCE(NEW.is_active, 0) != 0) != (COALESCE(OLD.is_active, 0) != 0)
+    BEGIN
+        INSERT INTO stat_counters (name, value)
+            VALUES ('active_users', CASE WHEN COALESCE(NEW.is_active, 0) != 0 THEN 1 ELSE -1 END)
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS main.trg_sessions_counters_ins AFTER INSERT ON user_sessions
+    BEGIN
+        INSERT INTO stat_counters (name, value)
+            VALUES ('sessions_expiring:' || substr(NEW.expires_at, 1, 10), 1)
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS main.trg_sessions_counters_del AFTER DELETE ON user_sessions
+    BEGIN
+        INSERT INTO stat_counters (name, value)
+            VALUES ('sessions_expiring:' || substr(OLD.expires_at, 1, 10), -1)
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS main.trg_sessions_counters_exp AFTER UPDATE OF expires_at ON user_sessions
+    WHEN substr(NEW.expires_at, 1, 10) IS NOT substr(OLD.expires_at, 1, 10)
+    BEGIN
+        INSERT INTO stat_counters (name, value)
+            VALUES ('sessions_expiring:' || substr(OLD.expires_at, 1, 10), -1)
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+        INSERT INTO stat_counters (name, value)
+            VALUES ('sessions_expiring:' || substr(NEW.expires_at, 1, 10), 1)
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS main.trg_login_counters_ins AFTER INSERT ON login_attempts
+    WHEN NEW.success = 1
+    BEGIN
+        INSERT INTO stat_counters (name, value)
+            VALUES ('logins:' || substr(NEW.attempt_time, 1, 10), 1)
+            ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+    END
+    ''',
+]
+
+# Пересчёт счётчиков с нуля: начальное заполнение (ниже) и периодическая
+# сверка (storage.reconcile_counters). Сессии за прошедшие дни не нужны.
+COUNTER_RECONCILE = [
+    "DELETE FROM main.stat_counters",
+    "INSERT INTO main.stat_counters (name, value) SELECT 'total_users', COUNT(*) FROM main.users",
+    '''
+    INSERT INTO main.stat_counters (name, value)
+    SELECT 'active_users', COUNT(*) FROM main.users WHERE is_active = 1
+    ''',
+    '''
+    INSERT INTO main.stat_counters (name, value)
+    SELECT 'sessions_expiring:' || substr(expires_at, 1, 10), COUNT(*)
+    FROM main.user_sessions
+    WHERE expires_at >= date('now', 'localtime')
+    GROUP BY 1
+    ''',
+    '''
+    INSERT INTO main.stat_counters (name, value)
+    SELECT 'logins:' || substr(attempt_time, 1, 10), COUNT(*)
+    FROM main.login_attempts
+    WHERE success = 1
+    GROUP BY 1
+    ''',
+]
+
+# ==========================================
+# 7. free_trials: fingerprint -> 16-байтный BLAKE2b digest
+# ==========================================
+
+def fingerprint_digest(fingerprint: str) -> bytes:
+    """Ключ free_trials: BLAKE2b-128 от строки fingerprint клиента."""
+    return hashlib.blake2b((fingerprint or "").encode(), digest_size=16).digest()
+
+
+def _rebuild_free_trials(con):
+    # WITHOUT ROWID + BLOB PRIMARY KEY: таблица и есть индекс, отдельного
+    # UNIQUE-индекса по длинной строке больше нет. Дубликаты digest (одинаковый
+    # fingerprint) сливаем, сохраняя больший расход.
+    con.create_function("pp_fingerprint_digest", 1, fingerprint_digest, deterministic=True)
+    con.execute('''
+        CREATE TABLE trials.free_trials_v2 (
+            fingerprint BLOB PRIMARY KEY,
+            analyses_used INTEGER NOT NULL DEFAULT 0,
+            max_analyses INTEGER NOT NULL DEFAULT 5,
+            last_used TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        ) WITHOUT ROWID
+    ''')
+    con.execute('''
+        INSERT INTO trials.free_trials_v2
+            (fingerprint, analyses_used, max_analyses, last_used, created_at)
+        SELECT pp_fingerprint_digest(fingerprint), MAX(COALESCE(analyses_used, 0)),
+               MAX(COALESCE(max_analyses, 5)), MAX(last_used), MIN(created_at)
+        FROM trials.free_trials
+        GROUP BY 1
+    ''')
+    con.execute("DROP TABLE trials.free_trials")
+    con.execute("ALTER TABLE trials.free_trials_v2 RENAME TO free_trials")
+
+
+FREE_TRIAL_DIGESTS = [
+    _rebuild_free_trials,
+]
+
+# ==========================================
+# 8. keyset-пагинация журнала
+# ==========================================
+
+TRANSACTIONS_KEYSET = [
+    # get_transactions: WHERE user_id = ? AND (date, id) < (?, ?) ORDER BY date DESC, id DESC
+    "CREATE INDEX IF NOT EXISTS journal.idx_transactions_user_date_id ON transactions(user_id, date, id)",
+    # префикс нового индекса — старый больше не нужен
+    "DROP INDEX IF EXISTS journal.idx_transactions_user_date",
+]
+
+# ==========================================
+# 9. материализованные позиции (FIFO) по журналу
+# ==========================================
+# Только схема: заполнение — не часть версии схемы (логика лотов меняется
+# вместе с portfolio_engine), его делает portfolio_engine.ensure_positions
+# при старте (database.init_db), когда таблица пуста при непустом журнале.
+
+POSITIONS = [
+    # по строке на (user_id, type, symbol); lots — JSON-очередь [[qty, price], ...]
+    '''
+    CREATE TABLE IF NOT EXISTS journal.positions (
+        user_id TEXT NOT NULL,
+        type TEXT NOT NULL,
+        symbol TEXT NOT NULL,
+        quantity REAL NOT NULL DEFAULT 0,
+        avg_cost REAL,
+        cost_basis REAL NOT NULL DEFAULT 0,
+        realized_pnl REAL NOT NULL DEFAULT 0,
+        commissions REAL NOT NULL DEFAULT 0,
+        trades INTEGER NOT NULL DEFAULT 0,
+        winning_trades INTEGER NOT NULL DEFAULT 0,
+        losing_trades INTEGER NOT NULL DEFAULT 0,
+        win_total REAL NOT NULL DEFAULT 0,
+        side INTEGER NOT NULL DEFAULT 0,
+        lots TEXT NOT NULL DEFAULT '[]',
+        last_date DATE,
+        last_tx_id INTEGER,
+        PRIMARY KEY (user_id, type, symbol)
+    ) WITHOUT ROWID
+    ''',
+    # символ хранится в каноническом виде, чтобы пересчёт одной позиции шёл по индексу
+    "UPDATE journal.transactions SET symbol = UPPER(TRIM(symbol)) WHERE symbol <> UPPER(TRIM(symbol))",
+    "CREATE INDEX IF NOT EXISTS journal.idx_transactions_user_symbol ON transactions(user_id, symbol, date, id)",
+]
+
+# ==========================================
+# 10. правила алертов (alerts.py)
+# ==========================================
+
+ALERT_RULES = [
+    '''
+    CREATE TABLE IF NOT EXISTS journal.alert_rules (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id TEXT NOT NULL,
+        symbol TEXT NOT NULL,
+        kind TEXT NOT NULL,                -- price_below / price_above / undervalued
+        threshold REAL NOT NULL,
+        is_active INTEGER NOT NULL DEFAULT 1,
+        triggered_at TIMESTAMP,
+        triggered_value REAL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    "CREATE INDEX IF NOT EXISTS journal.idx_alert_rules_user ON alert_rules(user_id, is_active)",
+    # загрузка индекса правил: только активные, уже в порядке (kind, symbol, threshold)
+    "CREATE INDEX IF NOT EXISTS journal.idx_alert_rules_active ON alert_rules(kind, symbol, threshold) WHERE is_active = 1",
+]
+
+# ==========================================
+# 11. доставка уведомлений алертов (очередь в самой таблице правил)
+# ==========================================
+
+ALERT_DELIVERY = [
+    # notify_state: NULL — слать нечего; pending — ждёт письма; sending — письмо
+    # отправляет воркер (notified_at — время захвата); sent; failed — попытки исчерпаны
+    "ALTER TABLE journal.alert_rules ADD COLUMN notify_state TEXT",
+    "ALTER TABLE journal.alert_rules ADD COLUMN notify_attempts INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE journal.alert_rules ADD COLUMN notified_at TIMESTAMP",
+    "ALTER TABLE journal.alert_rules ADD COLUMN notify_error TEXT",
+    "CREATE INDEX IF NOT EXISTS journal.idx_alert_rules_notify ON alert_rules(notify_state, notified_at) "
+    "WHERE notify_state IN ('pending', 'sending')",
+]
+
+# ==========================================
+# 12. journal.positions: сторона опциона в ключе
+# ==========================================
+# Колл и пут на один тикер сливались в одну позицию. Таблица — производные
+# данные: пересоздаётся пустой, portfolio_engine.ensure_positions заполняет
+# её заново при старте.
+
+POSITIONS_OPTION_RIGHT = [
+    "DROP TABLE IF EXISTS journal.positions",
+    '''
+    CREATE TABLE journal.positions (
+        user_id TEXT NOT NULL,
+        type TEXT NOT NULL,
+        symbol TEXT NOT NULL,
+        option_right TEXT NOT NULL DEFAULT '',   -- call / put / '' (не опцион по стороне)
+        quantity REAL NOT NULL DEFAULT 0,
+        avg_cost REAL,
+        cost_basis REAL NOT NULL DEFAULT 0,
+        realized_pnl REAL NOT NULL DEFAULT 0,
+        commissions REAL NOT NULL DEFAULT 0,
+        trades INTEGER NOT NULL DEFAULT 0,
+        winning_trades INTEGER NOT NULL DEFAULT 0,
+        losing_trades INTEGER NOT NULL DEFAULT 0,
+        win_total REAL NOT NULL DEFAULT 0,
+        side INTEGER NOT NULL DEFAULT 0,
+        lots TEXT NOT NULL DEFAULT '[]',
+        last_date DATE,
+        last_tx_id INTEGER,
+        PRIMARY KEY (user_id, type, symbol, option_right)
+    ) WITHOUT ROWID
+    ''',
+]
+
+
+MIGRATIONS: List[Tuple[int, str, List[Step]]] = [
+    (1, "baseline schema", BASELINE),
+    (2, "user_sessions.is_active + session indexes", SESSIONS),
+    (3, "donations table + users.stripe_default_pm", DONATIONS),
+    (4, "hot query indexes", HOT_INDEXES),
+    (5, "users.email_bidx blind index", EMAIL_BLIND_INDEX),
+    (6, "stat_counters + triggers", STAT_COUNTERS + COUNTER_RECONCILE),
+    (7, "free_trials.fingerprint as BLAKE2b digest", FREE_TRIAL_DIGESTS),
+    (8, "transactions (user_id, date, id) index", TRANSACTIONS_KEYSET),
+    (9, "journal.positions materialized FIFO positions", POSITIONS),
+    (10, "journal.alert_rules", ALERT_RULES),
+    (11, "journal.alert_rules notification delivery state", ALERT_DELIVERY),
+    (12, "journal.positions keyed by option right", POSITIONS_OPTION_RIGHT),
+]
+
+
+# ==========================================
+# RUNNER
+# ==========================================
+
+def applied_versions(con) -> set:
+    con.execute('''
+        CREATE TABLE IF NOT EXISTS main.schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    return {r[0] for r in con.execute("SELECT version FROM main.schema_migrations")}
+
+
+def run_migrations(con) -> List[int]:
+    """Применить недостающие миграции по порядку. Возвращает применённые версии."""
+    applied = []
+    for version, name, steps in MIGRATIONS:
+        if version in applied_versions(con):
+            continue
+        # IMMEDIATE: второй воркер, стартующий параллельно, подождёт и
+        # увидит версию уже записанной (проверяем повторно внутри транзакции)
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            if version in applied_versions(con):
+                con.rollback()
+                continue
+            for step in steps:
+                if callable(step):
+                    step(con)
+                else:
+                    con.execute(step)
+            con.execute(
+                "INSERT INTO main.schema_migrations (version, name) VALUES (?, ?)",
+                (version, name),
+            )
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+        applied.append(version)
+        print(f"🧱 Migration {version} applied: {name}")
+    return applied
+
+
+def main():
+    from storage import get_connection
+    con = get_connection()
+    try:
+        rows = con.execute(
+            "SELECT version, name, applied_at FROM main.schema_migrations ORDER BY version"
+        ).fetchall()
+    finally:
+        con.close()
+    for version, name, applied_at in rows:
+        print(f"✅ {version:>3}  {name}  ({applied_at})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+# pii_cache.py - Кэш расшифрованных персональных полей
+#
+# validate_session / get_user_by_email расшифровывают email и имя на
+# каждый запрос (Fernet: AES + HMAC + base64). Здесь хранится уже
+# расшифрованное значение по ключу (user_id, поле); вместе с ним лежит
+# хэш шифротекста, так что если строка в БД перешифрована/изменена,
+# запись просто не совпадёт и будет расшифрована заново.
+#
+# Размер ограничен (LRU), каждая запись живёт не дольше TTL, чтобы
+# открытый текст не задерживался в памяти процесса дольше необходимого.
+
+import os
+import sys
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+PII_CACHE_SIZE = int(os.getenv("PII_CACHE_SIZE", "10000"))
+PII_CACHE_TTL_SEC = float(os.getenv("PII_CACHE_TTL", "300"))
+
+
+def _digest(ciphertext: str) -> bytes:
+    return hashlib.blake2b(ciphertext.encode(), digest_size=16).digest()
+
+
+class DecryptedFieldCache:
+    """LRU + TTL кэш расшифрованных полей, ключ — (user_id, field)."""
+
+    def __init__(self, max_entries: int = PII_CACHE_SIZE, ttl_sec: float = PII_CACHE_TTL_SEC):
+        self.max_entries = max_entries
+        self.ttl_sec = ttl_sec
+        # (user_id, field) -> (digest шифротекста, значение, expires_at)
+        self._entries: "OrderedDict[Tuple[int, str], tuple]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _entry_size(value: Optional[str]) -> int:
+        # ключ + кортеж + digest + строка — оценка, без учёта общих объектов
+        return 200 + (sys.getsizeof(value) if value is not None else 0)
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= self._entry_size(entry[1])
+
+    def get_or_decrypt(self, user_id: int, field: str, ciphertext: str,
+                       decrypt: Callable[[str], Optional[str]]) -> Optional[str]:
+        """Значение из кэша, если шифротекст тот же и TTL не истёк; иначе decrypt()."""
+        if not ciphertext:
+            return None
+        key = (user_id, field)
+        digest = _digest(ciphertext)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == digest and entry[2] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        value = decrypt(ciphertext)
+        if value is None:
+            return None
+
+        with self._lock:
+            self._drop(key)
+            self._entries[key] = (digest, value, now + self.ttl_sec)
+            self._bytes += self._entry_size(value)
+            while len(self._entries) > self.max_entries:
+                old_key, old = self._entries.popitem(last=False)
+                self._bytes -= self._entry_size(old[1])
+                self.evictions += 1
+        return value
+
+    def invalidate_user(self, user_id: int):
+        """Забыть все поля пользователя (изменение профиля, деактивация)."""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == user_id]:
+                self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def get_stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "approx_bytes": self._bytes,
+            "ttl_sec": self.ttl_sec,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 4) if total else None,
+        }
@@ -0,0 +1,173 @@
+# portfolio_analysis.py - Фундаментальный анализ портфеля целиком
+#
+# Анализатор (run_stock_analysis в main.py) работает с одним тикером. Здесь
+# берутся текущие позиции пользователя из journal.positions, анализ по
+# каждому тикеру подтягивается из market_data.analysis_cache, а промахи
+# считаются параллельно в пуле потоков (PORTFOLIO_ANALYSIS_WORKERS — FMP
+# не любит десятки одновременных запросов).
+#
+# Агрегаты считаются векторно по массивам позиций (NumPy):
+#   weighted_pe             - P/E портфеля = стоимость / сумма "заработков"
+#                             позиций (гармоническое среднее по весам, P/E > 0)
+#   weighted_debt_ratio     - средневзвешенный долг, %
+#   weighted_valuation_gap  - средневзвешенный разрыв intrinsic value / цена, %
+#   verdict_distribution    - число позиций и доля стоимости по вердиктам
+#
+# Веса — рыночная стоимость длинных позиций; шорты перечисляются, но в
+# оценку "дёшево/дорого" не входят. Цена — живая котировка из
+# market_data.quote_cache (одна пачка на весь портфель), цена из анализа
+# (до ANALYSIS_CACHE_TTL давности) — только если котировки нет; разрыв с
+# intrinsic value пересчитывается от этой цены.
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+
+import metrics
+from market_data import QuoteFetcher, analysis_cache, quote_cache
+from portfolio_engine import CONTRACT_MULTIPLIER, get_holdings
+
+PORTFOLIO_ANALYSIS_WORKERS = int(os.getenv("PORTFOLIO_ANALYSIS_WORKERS", "6"))
+
+# типы позиций, для которых есть фундаментальный анализ
+ANALYZABLE_TYPES = ("stock",)
+
+Analyzer = Callable[[str], Dict[str, Any]]
+
+
+def _analyze_all(tickers: List[str], analyze: Analyzer) -> Dict[str, Any]:
+    """ticker -> dict анализа или Exception; кэш сначала, промахи — параллельно."""
+    results: Dict[str, Any] = {}
+    missing = []
+    for ticker in tickers:
+        cached = analysis_cache.get(ticker)
+        if cached is not None:
+            results[ticker] = cached
+        else:
+            missing.append(ticker)
+
+    def run(ticker):
+        try:
+            result = analyze(ticker)
+            # run_stock_analysis кладёт результат в кэш (с analyzed_at)
+            return analysis_cache.get(ticker) or result
+        except Exception as e:
+            return e
+
+    if missing:
+        workers = max(1, min(PORTFOLIO_ANALYSIS_WORKERS, len(missing)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="portfolio-analysis") as pool:
+            results.update(zip(missing, pool.map(run, missing)))
+        metrics.inc("portfolio_analysis.upstream_analyses", len(missing))
+    return results
+
+
+def _weighted(values: np.ndarray, weights: np.ndarray) -> Optional[float]:
+    mask = ~np.isnan(values)
+    total = weights[mask].sum()
+    if total <= 0:
+        return None
+    return float(np.dot(values[mask], weights[mask]) / total)
+
+
+def aggregate(rows: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Векторные агрегаты по позициям (поля market_value, pe_ratio, debt_ratio, valuation_gap, verdict)."""
+    if not rows:
+        return {"market_value": 0.0, "weighted_pe": None, "weighted_debt_ratio": None,
+                "weighted_valuation_gap": None, "coverage": None,
+                "verdict": None, "verdict_distribution": {}}
+
+    as_array = lambda key: np.array([r[key] if r[key] is not None else np.nan for r in rows], dtype=float)
+    value = as_array("market_value")
+    pe = as_array("pe_ratio")
+    debt = as_array("debt_ratio")
+    gap = as_array("valuation_gap")
+    total = value.sum()
+
+    # P/E портфеля: стоимость / сумма прибыли позиций (value / pe), только P/E > 0
+    earning = pe > 0
+    earnings = (value[earning] / pe[earning]).sum()
+    weighted_pe = float(value[earning].sum() / earnings) if earnings > 0 else None
+
+    weighted_debt = _weighted(debt, value)
+    weighted_gap = _weighted(gap, value)
+    if weighted_gap is None:
+        verdict = None
+    elif weighted_gap > 20:
+        verdict = "💎 UNDERVALUED"
+    elif weighted_gap < -20:
+        verdict = "⚠️ OVERVALUED"
+    else:
+        verdict = "📊 FAIRLY VALUED"
+
+    labels, inverse = np.unique([r["verdict"] or "—" for r in rows], return_inverse=True)
+    counts = np.bincount(inverse, minlength=len(labels))
+    weights = np.bincount(inverse, weights=value, minlength=len(labels))
+
+    return {
+        "market_value": round(float(total), 2),
+        "weighted_pe": round(weighted_pe, 2) if weighted_pe is not None else None,
+        "weighted_debt_ratio": round(weighted_debt, 2) if weighted_debt is not None else None,
+        "weighted_valuation_gap": round(weighted_gap, 2) if weighted_gap is not None else None,
+        # доля стоимости, по которой есть intrinsic value
+        "coverage": round(float(value[~np.isnan(gap)].sum() / total), 4) if total > 0 else None,
+        "verdict": verdict,
+        "verdict_distribution": {
+            str(label): {"count": int(count), "weight": round(float(weight / total), 4) if total > 0 else None}
+            for label, count, weight in zip(labels, counts, weights)
+        },
+    }
+
+
+def analyze_portfolio(user_id, analyze: Analyzer, fetch_quotes: Optional[QuoteFetcher] = None) -> Dict[str, Any]:
+    """
+    Анализ по всем открытым позициям пользователя.
+    analyze(ticker) -> dict AnalysisResponse (main.run_stock_analysis),
+    fetch_quotes(symbols) -> {symbol: quote} (analyzer.get_batch_quotes).
+    """
+    holdings = get_holdings(user_id)
+    longs, skipped = [], []
+    for h in holdings:
+        if h["type"] in ANALYZABLE_TYPES and h["quantity"] > 0:
+            longs.append(h)
+        else:
+            skipped.append({"symbol": h["symbol"], "reason": "short position" if h["quantity"] < 0
+                            else f"{h['type']} positions are not analyzed"})
+
+    tickers = sorted({h["symbol"] for h in longs})
+    analyses = _analyze_all(tickers, analyze)
+    quotes = quote_cache.get_quotes(tickers, fetch_quotes) if fetch_quotes and tickers else {}
+
+    rows = []
+    for holding in longs:
+        analysis = analyses.get(holding["symbol"])
+        if not isinstance(analysis, dict) or not analysis.get("current_price"):
+            skipped.append({"symbol": holding["symbol"], "reason": "no market data"})
+            continue
+        quote_price = (quotes.get(holding["symbol"]) or {}).get("price")
+        price = quote_price or analysis["current_price"]
+        intrinsic_value = analysis.get("intrinsic_value")
+        rows.append({
+            "symbol": holding["symbol"],
+            "quantity": holding["quantity"],
+            "avg_cost": holding["avg_cost"],
+            "price": price,
+            "market_value": holding["quantity"] * price * CONTRACT_MULTIPLIER.get(holding["type"], 1),
+            "pe_ratio": analysis.get("pe_ratio"),
+            "debt_ratio": analysis.get("debt_ratio"),
+            "price_source": "quote" if quote_price else "analysis",
+            "intrinsic_value": intrinsic_value,
+            "valuation_gap": (intrinsic_value - price) / price * 100 if intrinsic_value else None,
+            "verdict": analysis.get("final_verdict"),
+            "analyzed_at": analysis.get("analyzed_at"),
+        })
+
+    summary = aggregate(rows)
+    total = summary["market_value"]
+    for row in rows:
+        row["market_value"] = round(row["market_value"], 2)
+        row["weight"] = round(row["market_value"] / total, 4) if total else None
+    rows.sort(key=lambda r: -r["market_value"])
+    return {"summary": summary, "positions": rows, "skipped": skipped}
@@ -0,0 +1,436 @@
+# portfolio_engine.py - Позиции и P&L по журналу сделок
+#
+# Проигрывает transactions пользователя в хронологическом порядке (date, id)
+# и сопоставляет лоты одним из методов:
+#
+#   fifo    - закрываются самые старые лоты
+#   lifo    - закрываются самые новые лоты
+#   average - один "пул" со средней ценой (average cost)
+#
+# Лоты каждой позиции — компактная очередь (deque) пар [quantity, price]:
+# закрытие лота — O(1) с нужного конца, так что журнал на 50k сделок
+# проходится за миллисекунды, без пересчёта в браузере.
+#
+# Позиция со знаком: продажа без открытых лонгов открывает шорт.
+# Опционы считаются с множителем 100 (как в portfolio.html). Колл и пут на
+# один базовый актив — разные инструменты: позиция ключуется ещё и по
+# option_right (call / put из action, '' — без стороны опциона), иначе
+# buy_call + sell_put "закрыли" бы друг друга.
+#
+# FIFO-состояние материализовано в journal.positions (по строке на
+# user_id + type + symbol + option_right, вместе с очередью лотов): database.add_transaction
+# и delete_transaction обновляют его в той же транзакции, что и сам журнал,
+# поэтому чтение позиций — одно индексное чтение. Сверка/пересборка:
+#   python portfolio_engine.py rebuild [user_id]
+# Пустая таблица при непустом журнале (новая схема) заполняется при старте
+# (ensure_positions из database.init_db).
+
+import sys
+import json
+import sqlite3
+from collections import deque
+from typing import Dict, Any, Iterable, List, Tuple
+
+from storage import get_connection
+
+METHODS = ("fifo", "lifo", "average")
+
+CONTRACT_MULTIPLIER = {"option": 100}
+
+# action -> направление сделки (+1 покупка / -1 продажа)
+ACTION_SIDE = {
+    "buy": 1, "sell": -1,
+    "buy_call": 1, "sell_call": -1,
+    "buy_put": 1, "sell_put": -1,
+    "long": 1, "short": -1,
+}
+
+# action -> сторона опциона (часть ключа позиции)
+OPTION_RIGHT = {
+    "buy_call": "call", "sell_call": "call",
+    "buy_put": "put", "sell_put": "put",
+}
+
+_EPS = 1e-9
+
+
+def normalize_symbol(symbol: str) -> str:
+    return (symbol or "").strip().upper()
+
+
+def option_right(action: str) -> str:
+    return OPTION_RIGHT.get((action or "").lower(), "")
+
+
+class Position:
+    """Открытые лоты и реализованный результат по одному инструменту."""
+
+    __slots__ = ("symbol", "type", "option_right", "multiplier", "side", "lots",
+                 "realized", "commissions", "trades", "wins", "losses", "win_total")
+
+    def __init__(self, symbol: str, tx_type: str, right: str = ""):
+        self.symbol = symbol
+        self.type = tx_type
+        self.option_right = right
+        self.multiplier = CONTRACT_MULTIPLIER.get(tx_type, 1)
+        self.side = 0            # +1 лонг, -1 шорт, 0 — позиции нет
+        self.lots = deque()      # [quantity > 0, price]
+        self.realized = 0.0
+        self.commissions = 0.0
+        self.trades = 0
+        self.wins = 0
+        self.losses = 0
+        self.win_total = 0.0
+
+    def apply(self, side: int, quantity: float, price: float, commission: float, method: str):
+        self.trades += 1
+        self.commissions += commission
+        remaining = quantity
+        pnl = 0.0
+        closed = False
+
+        # закрываем противоположные лоты
+        if self.side and side != self.side:
+            take_left = method != "lifo"
+            while remaining > _EPS and self.lots:
+                lot = self.lots[0] if take_left else self.lots[-1]
+                matched = min(lot[0], remaining)
+                pnl += (price - lot[1]) * matched * self.side * self.multiplier
+                lot[0] -= matched
+                remaining -= matched
+                closed = True
+                if lot[0] <= _EPS:
+                    if take_left:
+                        self.lots.popleft()
+                    else:
+                        self.lots.pop()
+            if not self.lots:
+                self.side = 0
+
+        # остаток открывает/наращивает позицию
+        if remaining > _EPS:
+            self.side = side
+            if method == "average" and self.lots:
+                lot = self.lots[0]
+                total = lot[0] + remaining
+                lot[1] = (lot[0] * lot[1] + remaining * price) / total
+                lot[0] = total
+            else:
+                self.lots.append([remaining, price])
+
+        if closed:
+            self.realized += pnl
+            if pnl > 0:
+                self.wins += 1
+                self.win_total += pnl
+            elif pnl < 0:
+                self.losses += 1
+
+    # ---------- materialized state (journal.positions) ----------
+
+    def to_row(self, user_id, last_date, last_tx_id) -> Dict[str, Any]:
+        data = self.to_dict()
+        return {
+            "user_id": user_id,
+            "type": self.type,
+            "symbol": self.symbol,
+            "option_right": self.option_right,
+            "quantity": data["quantity"],
+            "avg_cost": data["avg_cost"],
+            "cost_basis": data["cost_basis"],
+            "realized_pnl": self.realized,
+            "commissions": self.commissions,
+            "trades": self.trades,
+            "winning_trades": self.wins,
+            "losing_trades": self.losses,
+            "win_total": self.win_total,
+            "side": self.side,
+            "lots": json.dumps(list(self.lots)),
+            "last_date": last_date,
+            "last_tx_id": last_tx_id,
+        }
+
+    @classmethod
+    def from_row(cls, row) -> "Position":
+        position = cls(row["symbol"], row["type"], row["option_right"])
+        position.side = row["side"]
+        position.lots = deque(json.loads(row["lots"]))
+        position.realized = row["realized_pnl"]
+        position.commissions = row["commissions"]
+        position.trades = row["trades"]
+        position.wins = row["winning_trades"]
+        position.losses = row["losing_trades"]
+        position.win_total = row["win_total"]
+        return position
+
+    def to_dict(self) -> Dict[str, Any]:
+        open_qty = sum(lot[0] for lot in self.lots)
+        cost = sum(lot[0] * lot[1] for lot in self.lots)
+        return {
+            "symbol": self.symbol,
+            "type": self.type,
+            "option_right": self.option_right or None,
+            "quantity": self.side * open_qty,
+            "avg_cost": round(cost / open_qty, 4) if open_qty > _EPS else None,
+            "cost_basis": round(self.side * cost * self.multiplier, 2),
+            "open_lots": len(self.lots),
+            "realized_pnl": round(self.realized, 2),
+            "commissions": round(self.commissions, 2),
+            "net_realized_pnl": round(self.realized - self.commissions, 2),
+            "trades": self.trades,
+            "winning_trades": self.wins,
+            "losing_trades": self.losses,
+        }
+
+
+def compute_portfolio(rows: Iterable[Tuple], method: str = "fifo") -> Dict[str, Any]:
+    """
+    rows — (type, symbol, action, quantity, price, commission) в порядке (date, id).
+    Возвращает {"method", "positions": [...], "totals": {...}}.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown lot matching method: {method}")
+
+    positions, skipped = _replay(rows, method)
+    return _summarize(method, list(positions.values()), skipped)
+
+
+def _replay(rows: Iterable[Tuple], method: str) -> Tuple[Dict[Tuple[str, str, str], Position], int]:
+    positions: Dict[Tuple[str, str, str], Position] = {}
+    skipped = 0
+    for tx_type, symbol, action, quantity, price, commission in rows:
+        side = ACTION_SIDE.get((action or "").lower())
+        if side is None or not quantity:
+            skipped += 1
+            continue
+        symbol = normalize_symbol(symbol)
+        key = (tx_type, symbol, option_right(action))
+        position = positions.get(key)
+        if position is None:
+            position = positions[key] = Position(symbol, tx_type, key[2])
+        position.apply(side, abs(quantity), price or 0.0, commission or 0.0, method)
+    return positions, skipped
+
+
+def _summarize(method: str, positions: List[Position], skipped: int = 0) -> Dict[str, Any]:
+    items: List[Dict[str, Any]] = [p.to_dict() for p in positions]
+    items.sort(key=lambda p: (p["quantity"] == 0, p["symbol"]))
+
+    wins = sum(p.wins for p in positions)
+    win_total = sum(p.win_total for p in positions)
+    realized = sum(p.realized for p in positions)
+    commissions = sum(p.commissions for p in positions)
+    return {
+        "method": method,
+        "positions": items,
+        "totals": {
+            "open_positions": sum(1 for p in items if p["quantity"]),
+            "total_trades": sum(p.trades for p in positions),
+            "winning_trades": wins,
+            "losing_trades": sum(p.losses for p in positions),
+            "realized_pnl": round(realized, 2),
+            "commissions": round(commissions, 2),
+            "net_realized_pnl": round(realized - commissions, 2),
+            "avg_win": round(win_total / wins, 2) if wins else 0.0,
+            "skipped_rows": skipped,
+        },
+    }
+
+
+# ==========================================
+# MATERIALIZED POSITIONS (journal.positions, FIFO)
+# ==========================================
+
+_POSITION_COLUMNS = ("user_id", "type", "symbol", "option_right", "quantity", "avg_cost", "cost_basis",
+                     "realized_pnl", "commissions", "trades", "winning_trades",
+                     "losing_trades", "win_total", "side", "lots", "last_date", "last_tx_id")
+
+_UPSERT_POSITION = (
+    f"INSERT OR REPLACE INTO journal.positions ({', '.join(_POSITION_COLUMNS)}) "
+    f"VALUES ({', '.join(':' + c for c in _POSITION_COLUMNS)})"
+)
+
+
+def _load_position(con, user_id, tx_type: str, symbol: str, right: str):
+    con.row_factory = sqlite3.Row
+    try:
+        return con.execute(
+            "SELECT * FROM journal.positions "
+            "WHERE user_id = ? AND type = ? AND symbol = ? AND option_right = ?",
+            (user_id, tx_type, symbol, right),
+        ).fetchone()
+    finally:
+        con.row_factory = None
+
+
+def refresh_position(con, user_id, tx_type: str, symbol: str):
+    """
+    Пересчитать позиции по инструменту (индекс user_id + symbol): все стороны
+    опциона разом — сделки по ним лежат в одном срезе журнала.
+    """
+    symbol = normalize_symbol(symbol)
+    rows = con.execute(
+        "SELECT type, symbol, action, quantity, price, commission, date, id "
+        "FROM journal.transactions WHERE user_id = ? AND symbol = ? AND type = ? "
+        "ORDER BY date, id",
+        (user_id, symbol, tx_type),
+    ).fetchall()
+    positions, _ = _replay((r[:6] for r in rows), "fifo")
+    last = {(r[0], symbol, option_right(r[2])): (r[6], r[7]) for r in rows}
+    con.execute(
+        "DELETE FROM journal.positions WHERE user_id = ? AND type = ? AND symbol = ?",
+        (user_id, tx_type, symbol),
+    )
+    for key, position in positions.items():
+        con.execute(_UPSERT_POSITION, position.to_row(user_id, *last[key]))
+
+
+def apply_transaction(con, user_id, tx_id: int, data: Dict[str, Any]):
+    """
+    Учесть новую сделку в journal.positions (вызывается внутри транзакции
+    add_transaction). Сделка "в конец" применяется к сохранённой очереди
+    лотов за O(1); задним числом — позиция пересчитывается по своим сделкам.
+    """
+    tx_type = data["type"]
+    symbol = normalize_symbol(data["symbol"])
+    side = ACTION_SIDE.get((data.get("action") or "").lower())
+    right = option_right(data.get("action"))
+    row = _load_position(con, user_id, tx_type, symbol, right)
+
+    if row is not None and str(data["date"]) < str(row["last_date"]):
+        refresh_position(con, user_id, tx_type, symbol)
+        return
+    if side is None or not data.get("quantity"):
+        return
+
+    position = Position.from_row(row) if row is not None else Position(symbol, tx_type, right)
+    position.apply(side, abs(data["quantity"]), data["price"] or 0.0,
+                   data.get("commission") or 0.0, "fifo")
+    con.execute(_UPSERT_POSITION, position.to_row(user_id, data["date"], tx_id))
+
+
+def rebuild_positions(con, user_id=None) -> Dict[str, Any]:
+    """
+    Пересобрать journal.positions из журнала (всех пользователей или одного)
+    и сравнить с тем, что было. Возвращает {"positions": n, "mismatches": [...]}.
+    """
+    where, params = ("WHERE user_id = ?", (user_id,)) if user_id is not None else ("", ())
+    con.row_factory = sqlite3.Row
+    try:
+        before = {(r["user_id"], r["type"], r["symbol"], r["option_right"]): dict(r) for r in con.execute(
+            f"SELECT * FROM journal.positions {where}", params)}
+    finally:
+        con.row_factory = None
+
+    rows = con.execute(
+        "SELECT user_id, type, symbol, action, quantity, price, commission, date, id "
+        f"FROM journal.transactions {where} ORDER BY user_id, date, id",
+        params,
+    ).fetchall()
+
+    con.execute(f"DELETE FROM journal.positions {where}", params)
+    after = {}
+    i = 0
+    while i < len(rows):
+        j = i
+        while j < len(rows) and rows[j][0] == rows[i][0]:
+            j += 1
+        uid = rows[i][0]
+        user_rows = rows[i:j]
+        last = {}
+        for r in user_rows:
+            last[(r[1], normalize_symbol(r[2]), option_right(r[3]))] = (r[7], r[8])
+        positions, _ = _replay((r[1:7] for r in user_rows), "fifo")
+        for key, position in positions.items():
+            row = position.to_row(uid, *last[key])
+            con.execute(_UPSERT_POSITION, row)
+            after[(uid, *key)] = row
+        i = j
+
+    mismatches = []
+    for key in set(before) | set(after):
+        old, new = before.get(key), after.get(key)
+        if old is None or new is None or any(
+                abs((old[c] or 0) - (new[c] or 0)) > 1e-6
+                for c in ("quantity", "realized_pnl", "commissions", "trades")):
+            mismatches.append({"key": list(key),
+                               "stored": old and {c: old[c] for c in ("quantity", "realized_pnl")},
+                               "journal": new and {c: new[c] for c in ("quantity", "realized_pnl")}})
+    return {"positions": len(after), "mismatches": mismatches}
+
+
+def ensure_positions() -> bool:
+    """Заполнить journal.positions, если она пуста, а журнал — нет. True — была пересборка."""
+    def empty(con):
+        return not con.execute(
+            "SELECT EXISTS (SELECT 1 FROM journal.transactions) "
+            "AND NOT EXISTS (SELECT 1 FROM journal.positions)"
+        ).fetchone()[0]
+
+    with get_connection() as con:
+        if empty(con):
+            return False
+        # пустая запись берёт блокировку записи только на journal (не на все
+        # хранилища, как BEGIN IMMEDIATE); под ней проверяем ещё раз — второй
+        # воркер мог заполнить таблицу раньше
+        con.execute("BEGIN")
+        con.execute("DELETE FROM journal.positions WHERE 0")
+        if empty(con):
+            return False
+        result = rebuild_positions(con)
+    print(f"📦 journal.positions backfilled: {result['positions']} positions")
+    return True
+
+
+def _load_positions(user_id) -> List[Position]:
+    conn = get_connection()
+    conn.row_factory = sqlite3.Row
+    try:
+        rows = conn.execute(
+            "SELECT * FROM journal.positions WHERE user_id = ?", (user_id,)
+        ).fetchall()
+    finally:
+        conn.close()
+    return [Position.from_row(row) for row in rows]
+
+
+def get_holdings(user_id) -> List[Dict[str, Any]]:
+    """Открытые FIFO-позиции пользователя из journal.positions (одно чтение по PK)."""
+    holdings = [p.to_dict() for p in _load_positions(user_id) if p.lots]
+    holdings.sort(key=lambda p: p["symbol"])
+    return holdings
+
+
+def get_portfolio(user_id, method: str = "fifo") -> Dict[str, Any]:
+    """Позиции и P&L пользователя: FIFO — из journal.positions, иначе проигрыш журнала."""
+    if method == "fifo":
+        return _summarize(method, _load_positions(user_id))
+
+    conn = get_connection()
+    try:
+        rows = conn.execute(
+            "SELECT type, symbol, action, quantity, price, commission FROM transactions "
+            "WHERE user_id = ? ORDER BY date, id",
+            (user_id,),
+        ).fetchall()
+    finally:
+        conn.close()
+    return compute_portfolio(rows, method)
+
+
+def main(argv: List[str]):
+    if len(argv) < 2 or argv[1] != "rebuild":
+        print("Usage: python portfolio_engine.py rebuild [user_id]")
+        return
+    user_id = argv[2] if len(argv) > 2 else None
+    with get_connection() as con:
+        con.execute("BEGIN IMMEDIATE")
+        result = rebuild_positions(con, user_id)
+    for m in result["mismatches"]:
+        print(f"⚠️ {m['key']}: stored={m['stored']} journal={m['journal']}")
+    print(f"✅ Positions rebuilt: {result['positions']} "
+          f"({len(result['mismatches'])} mismatches fixed)")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,136 @@
+# price_history.py - Кэш дневной истории цен (OHLCV)
+#
+# Риск-метрики (risk.py) и дальше индикаторы работают по дневным барам.
+# История по тикеру загружается из FMP (historical-price-full) один раз за
+# PRICE_HISTORY_YEARS лет, дальше догружаются только новые бары начиная с
+# даты последнего известного — не чаще раза в день на тикер.
+#
+# Ряды хранятся в price_store (memory-mapped файл на тикер, только
+# дописывание): колонки date (datetime64[D]) + open/high/low/close/volume
+# (float64) по возрастанию даты отдаются как представления над memmap, без
+# копирования. История общая для всех воркеров uvicorn и переживает рестарт,
+# если PRICE_STORE_DIR на постоянном диске (на Cloud Run — смонтированный
+# том, см. price_store.py): тогда догружаются только дни после последнего
+# сохранённого бара.
+# Недостающие тикеры догружаются параллельно (HISTORY_FETCH_WORKERS).
+#
+# Сам HTTP-запрос делает FMPStockAnalyzer.get_price_history (main.py):
+# fetch(symbol, date_from) -> [{"date", "open", "high", "low", "close", "volume"}, ...].
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+
+import metrics
+from market_data import normalize_tickers
+from price_store import FIELDS, PriceStore, Series, as_series, price_store
+
+PRICE_HISTORY_YEARS = int(os.getenv("PRICE_HISTORY_YEARS", "5"))
+HISTORY_FETCH_WORKERS = int(os.getenv("HISTORY_FETCH_WORKERS", "8"))
+
+HistoryFetcher = Callable[[str, Optional[str]], List[Dict[str, Any]]]
+
+
+def bars_to_columns(bars: Iterable[Dict[str, Any]], after: Optional[np.datetime64] = None) -> Series:
+    """Бары FMP (любой порядок) -> колонки по возрастанию даты, только позже after."""
+    rows = sorted((b for b in bars if b.get("date") and b.get("close") is not None),
+                  key=lambda b: b["date"])
+    dates = np.array([b["date"][:10] for b in rows], dtype="datetime64[D]")
+    columns = {"date": dates}
+    for field in FIELDS:
+        columns[field] = np.array([b.get(field) if b.get(field) is not None else np.nan
+                                   for b in rows], dtype=np.float64)
+    if after is not None:
+        keep = dates > after
+        columns = {k: v[keep] for k, v in columns.items()}
+    # дубликаты дат (FMP иногда отдаёт повторы) — оставляем последний
+    if len(columns["date"]) > 1:
+        _, last = np.unique(columns["date"][::-1], return_index=True)
+        idx = len(columns["date"]) - 1 - last
+        columns = {k: v[np.sort(idx)] for k, v in columns.items()}
+    return columns
+
+
+class PriceHistoryCache:
+    """Дневные бары по тикерам: загрузка один раз, дальше — только новые дни."""
+
+    def __init__(self, store: PriceStore = price_store, years: int = PRICE_HISTORY_YEARS):
+        self.store = store
+        self.years = years
+        self.fetch: Optional[HistoryFetcher] = None
+        self._checked: Dict[str, date] = {}
+        self._lock = threading.Lock()
+
+        self.full_loads = 0
+        self.incremental_loads = 0
+        self.bars_appended = 0
+
+    def set_fetcher(self, fetch: HistoryFetcher):
+        self.fetch = fetch
+
+    def _refresh(self, symbol: str):
+        last = self.store.last_date(symbol)
+        if last is None:
+            date_from = (date.today() - timedelta(days=365 * self.years)).isoformat()
+        else:
+            date_from = str(last + np.timedelta64(1, "D"))
+
+        bars = self.fetch(symbol, date_from) if self.fetch else []
+        appended = self.store.append(symbol, bars_to_columns(bars, after=last))
+        with self._lock:
+            if last is None:
+                self.full_loads += 1
+            elif appended:
+                self.incremental_loads += 1
+            self._checked[symbol] = date.today()
+            self.bars_appended += appended
+        metrics.inc("price_history.fetches")
+
+    def get_many(self, symbols: Iterable[str]) -> Dict[str, Series]:
+        """{symbol: колонки} — устаревшие (не проверенные сегодня) догружаются параллельно."""
+        symbols = normalize_tickers(symbols)
+        today = date.today()
+        stale = [s for s in symbols if self._checked.get(s) != today]
+        if stale:
+            workers = max(1, min(HISTORY_FETCH_WORKERS, len(stale)))
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="price-history") as pool:
+                for symbol, error in zip(stale, pool.map(self._safe_refresh, stale)):
+                    if error:
+                        print(f"❌ Price history for {symbol} failed: {error}")
+        result = {}
+        for symbol in symbols:
+            bars = self.store.bars(symbol)
+            if bars is not None and len(bars):
+                result[symbol] = as_series(bars)
+        return result
+
+    def _safe_refresh(self, symbol: str) -> Optional[str]:
+        try:
+            self._refresh(symbol)
+            return None
+        except Exception as e:
+            return str(e)
+
+    def get(self, symbol: str, start: Optional[str] = None, end: Optional[str] = None) -> Optional[Series]:
+        """Колонки тикера, опционально за [start, end] — срез без копирования."""
+        symbol = symbol.strip().upper()
+        if symbol not in self.get_many([symbol]):
+            return None
+        return self.store.read(symbol, start, end)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "checked_today": sum(1 for d in self._checked.values() if d == date.today()),
+            "full_loads": self.full_loads,
+            "incremental_loads": self.incremental_loads,
+            "bars_appended": self.bars_appended,
+        }
+
+
+# Глобальный экземпляр (fetcher подключает main.py: analyzer.get_price_history)
+price_history = PriceHistoryCache()
+metrics.register_gauge("price_history", price_history.get_stats)
@@ -0,0 +1,205 @@
+# price_store.py - Колоночное хранилище дневных баров (OHLCV) на memory-mapped файлах
+#
+# Один файл на тикер: PRICE_STORE_DIR/<SYMBOL>.ohlcv
+#
+#   [заголовок HEADER_SIZE байт: MAGIC + размер записи]
+#   [запись 0][запись 1]...           по возрастанию даты, только дописывание
+#
+# Запись фиксированной ширины (BAR_DTYPE, 48 байт):
+#   date (datetime64[D]) + open/high/low/close/volume (float64).
+#
+# Чтение — np.memmap только для чтения: колонки (bars["close"]) и срезы по
+# датам (searchsorted по колонке date) — представления над страницами файла,
+# без копирования. Несколько процессов uvicorn открывают одни и те же файлы:
+# страницы лежат в общем page cache ОС, а не копируются в каждый воркер.
+#
+# Дописывание — под fcntl.flock(LOCK_EX) на файле: под блокировкой ещё раз
+# читается последняя дата, в файл уходят только бары строго позже неё, так что
+# два воркера, догрузившие один и тот же день, не создадут дубликатов.
+# Читатель видит только целые записи (длина = (размер - заголовок) // 48);
+# отображение пересоздаётся, когда файл вырос. Отображения кэшируются в
+# процессе LRU на PRICE_STORE_MAX_MAPS тикеров: каждое держит дескриптор
+# файла и адресное пространство, без предела долгоживущий воркер копил бы
+# их по всем тикерам, которые когда-либо читал.
+#
+# Где лежат файлы: PRICE_STORE_DIR (по умолчанию относительный price_data).
+# История переживает рестарт, только если каталог на постоянном диске. На
+# Cloud Run локальная файловая система — in-memory и своя у каждого
+# инстанса: файлы съедают память инстанса и пропадают вместе с ним, поэтому
+# там PRICE_STORE_DIR нужно направить на смонтированный том (Cloud Storage
+# FUSE / Filestore) — иначе это просто кэш на время жизни инстанса.
+
+import os
+import fcntl
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+import metrics
+from market_data import is_valid_ticker
+
+PRICE_STORE_DIR = os.getenv("PRICE_STORE_DIR", "price_data")
+PRICE_STORE_MAX_MAPS = int(os.getenv("PRICE_STORE_MAX_MAPS", "512"))
+
+if os.getenv("K_SERVICE") and not os.getenv("PRICE_STORE_DIR"):
+    print("⚠️ PRICE_STORE_DIR is not set: price history lives in the instance's in-memory filesystem")
+
+FIELDS = ("open", "high", "low", "close", "volume")
+BAR_DTYPE = np.dtype([("date", "datetime64[D]")] + [(f, "<f8") for f in FIELDS])
+
+MAGIC = b"PPOHLCV1"
+HEADER_SIZE = 64
+SUFFIX = ".ohlcv"
+
+Series = Dict[str, np.ndarray]
+
+
+def _header() -> bytes:
+    return (MAGIC + BAR_DTYPE.itemsize.to_bytes(4, "little")).ljust(HEADER_SIZE, b"\0")
+
+
+def as_series(bars: np.ndarray) -> Series:
+    """Структурный массив баров -> {колонка: представление} (без копирования)."""
+    return {name: bars[name] for name in BAR_DTYPE.names}
+
+
+class PriceStore:
+    """Append-only файлы баров по тикерам + кэш отображений в процессе."""
+
+    def __init__(self, root: str = PRICE_STORE_DIR, max_maps: int = PRICE_STORE_MAX_MAPS):
+        self.root = root
+        self.max_maps = max_maps
+        # symbol -> (размер файла, memmap), LRU; пересоздаётся, когда файл вырос.
+        # Вытесненное отображение закрывается, когда его отпустят все читатели.
+        self._maps: "OrderedDict[str, Tuple[int, np.ndarray]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.remaps = 0
+        self.evictions = 0
+        self.appends = 0
+        self.bars_written = 0
+
+    def path(self, symbol: str) -> str:
+        # тикер становится именем файла: ничего, кроме TICKER_RE (никаких "../")
+        if not is_valid_ticker(symbol):
+            raise ValueError(f"Invalid ticker: {symbol!r}")
+        return os.path.join(self.root, f"{symbol}{SUFFIX}")
+
+    # ---------- чтение ----------
+
+    def bars(self, symbol: str) -> Optional[np.ndarray]:
+        """Все бары тикера (memmap, только чтение) или None, если файла нет."""
+        path = self.path(symbol)
+        try:
+            size = os.stat(path).st_size
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            cached = self._maps.get(symbol)
+            if cached is not None and cached[0] == size:
+                self._maps.move_to_end(symbol)
+                return cached[1]
+
+        count = max(size - HEADER_SIZE, 0) // BAR_DTYPE.itemsize
+        if count == 0:
+            mapped = np.empty(0, dtype=BAR_DTYPE)
+        else:
+            with open(path, "rb") as f:
+                if f.read(len(MAGIC)) != MAGIC:
+                    raise ValueError(f"{path}: not a price store file")
+            mapped = np.memmap(path, dtype=BAR_DTYPE, mode="r", offset=HEADER_SIZE, shape=(count,))
+        with self._lock:
+            self._maps[symbol] = (size, mapped)
+            self._maps.move_to_end(symbol)
+            while len(self._maps) > self.max_maps:
+                self._maps.popitem(last=False)
+                self.evictions += 1
+        self.remaps += 1
+        return mapped
+
+    def last_date(self, symbol: str) -> Optional[np.datetime64]:
+        bars = self.bars(symbol)
+        return bars["date"][-1] if bars is not None and len(bars) else None
+
+    def read(self, symbol: str, start: Optional[str] = None, end: Optional[str] = None) -> Optional[Series]:
+        """Колонки за [start, end] (даты 'YYYY-MM-DD', включительно) — срез memmap без копирования."""
+        bars = self.bars(symbol)
+        if bars is None:
+            return None
+        dates = bars["date"]
+        lo = int(np.searchsorted(dates, np.datetime64(start, "D"), side="left")) if start else 0
+        hi = int(np.searchsorted(dates, np.datetime64(end, "D"), side="right")) if end else len(bars)
+        return as_series(bars[lo:hi])
+
+    # ---------- запись ----------
+
+    def append(self, symbol: str, columns: Series) -> int:
+        """
+        Дописать бары (колонки по возрастанию даты). Бары не позже последнего
+        уже сохранённого отбрасываются. Возвращает число записанных баров.
+        """
+        if not len(columns["date"]):
+            return 0
+        os.makedirs(self.root, exist_ok=True)
+        with open(self.path(symbol), "a+b") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                size = os.fstat(f.fileno()).st_size
+                if size < HEADER_SIZE:
+                    f.truncate(0)
+                    f.write(_header())
+                    size = HEADER_SIZE
+                # хвост от оборванной записи (процесс упал посреди write) отрезаем
+                count = (size - HEADER_SIZE) // BAR_DTYPE.itemsize
+                end = HEADER_SIZE + count * BAR_DTYPE.itemsize
+                if end != size:
+                    f.truncate(end)
+
+                dates = np.asarray(columns["date"], dtype="datetime64[D]")
+                keep = slice(None)
+                if count:
+                    f.seek(end - BAR_DTYPE.itemsize)
+                    last = np.frombuffer(f.read(BAR_DTYPE.itemsize), dtype=BAR_DTYPE)["date"][0]
+                    keep = dates > last
+                records = np.empty(len(dates), dtype=BAR_DTYPE)
+                records["date"] = dates
+                for field in FIELDS:
+                    records[field] = columns[field]
+                records = records[keep]
+                if len(records):
+                    f.seek(0, os.SEEK_END)
+                    f.write(records.tobytes())
+                    f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+        if len(records):
+            self.appends += 1
+            self.bars_written += len(records)
+            metrics.inc("price_store.bars_written", len(records))
+        return len(records)
+
+    def symbols(self) -> List[str]:
+        try:
+            return sorted(name[:-len(SUFFIX)] for name in os.listdir(self.root) if name.endswith(SUFFIX))
+        except FileNotFoundError:
+            return []
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "root": self.root,
+            "mapped_symbols": len(self._maps),
+            "max_maps": self.max_maps,
+            "mapped_bytes": sum(size for size, _ in list(self._maps.values())),
+            "remaps": self.remaps,
+            "evictions": self.evictions,
+            "appends": self.appends,
+            "bars_written": self.bars_written,
+        }
+
+
+# Глобальный экземпляр (используется price_history)
+price_store = PriceStore()
+metrics.register_gauge("price_store", price_store.get_stats)
@@ -0,0 +1,250 @@
+# price_stream.py - WebSocket-рассылка цен с общим опросом FMP
+#
+# Каждая открытая вкладка portfolio/dashboard иначе опрашивала бы цены сама:
+# нагрузка на FMP росла бы с числом пользователей. Здесь клиенты
+# подписываются на наборы тикеров по /ws/prices, а сервер держит ОДИН цикл
+# опроса на процесс: раз в PRICE_POLL_INTERVAL берёт все различные тикеры,
+# у которых есть подписчики, и получает их пакетными запросами quote
+# (market_data.quote_cache, до QUOTE_BATCH_SIZE тикеров в запросе).
+# Изменившиеся цены расходятся всем подписчикам символа.
+#
+# Нагрузка на FMP зависит от числа различных тикеров, а не от числа вкладок.
+#
+# Медленные клиенты: у каждого подписчика не очередь сообщений, а словарь
+# "последнее обновление по символу" — пока идёт отправка, новые цены
+# перезаписывают старые (coalescing), память на клиента ограничена числом
+# его тикеров. Отправка дольше SEND_TIMEOUT — клиент отключается.
+#
+# Доступ — только с действующей сессией (cookie pp_session), проверка до
+# accept(): без неё рукопожатие отклоняется (403). Общее число различных
+# тикеров в опросе ограничено MAX_HUB_SYMBOLS — подписка сверх лимита
+# получает ошибку, опрос FMP не растёт без границ.
+#
+# Протокол (JSON):
+#   -> {"action": "subscribe" | "unsubscribe", "symbols": ["AAPL", ...]}
+#   <- {"type": "prices", "quotes": {"AAPL": {"price", "change", "change_pct"}}}
+#   <- {"type": "subscribed", "symbols": [...]} / {"type": "error", "error": "..."}
+
+import os
+import json
+import asyncio
+from typing import Any, Dict, List, Optional, Set
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+import metrics
+from market_data import QuoteFetcher, normalize_tickers, quote_cache
+from security import SESSION_COOKIE, _fetch_user_by_session
+
+PRICE_POLL_INTERVAL_SEC = float(os.getenv("PRICE_POLL_INTERVAL", "5"))
+SEND_TIMEOUT_SEC = float(os.getenv("PRICE_SEND_TIMEOUT", "10"))
+MAX_SYMBOLS_PER_CLIENT = int(os.getenv("PRICE_MAX_SYMBOLS", "200"))
+MAX_HUB_SYMBOLS = int(os.getenv("PRICE_MAX_HUB_SYMBOLS", "2000"))
+
+
+def _compact(quote: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "price": quote.get("price"),
+        "change": quote.get("change"),
+        "change_pct": quote.get("changesPercentage"),
+    }
+
+
+class _Subscriber:
+    """Одно WebSocket-соединение: подписки и ещё не отправленные обновления."""
+
+    __slots__ = ("websocket", "symbols", "pending", "control", "wake")
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.symbols: Set[str] = set()
+        self.pending: Dict[str, Dict[str, Any]] = {}   # symbol -> последнее обновление
+        self.control: List[Dict[str, Any]] = []        # служебные ответы
+        self.wake = asyncio.Event()
+
+    def push(self, symbol: str, update: Dict[str, Any]) -> bool:
+        """Поставить обновление; True — предыдущее ещё не ушло и перезаписано."""
+        coalesced = symbol in self.pending
+        self.pending[symbol] = update
+        self.wake.set()
+        return coalesced
+
+    def reply(self, message: Dict[str, Any]):
+        self.control.append(message)
+        self.wake.set()
+
+
+class PriceHub:
+    """Подписки по тикерам + единый цикл опроса на процесс."""
+
+    def __init__(self, interval: float = PRICE_POLL_INTERVAL_SEC):
+        self.interval = interval
+        self.fetch: Optional[QuoteFetcher] = None
+        self._subscribers: Dict[str, Set[_Subscriber]] = {}
+        self._last: Dict[str, Dict[str, Any]] = {}
+        self._clients = 0
+        self._task: Optional[asyncio.Task] = None
+
+        self.polls = 0
+        self.messages_sent = 0
+        self.coalesced = 0
+        self.dropped_clients = 0
+        self.rejected_clients = 0
+
+    def set_fetcher(self, fetch: QuoteFetcher):
+        self.fetch = fetch
+
+    # ---------- соединение ----------
+
+    async def serve(self, websocket: WebSocket):
+        token = websocket.cookies.get(SESSION_COOKIE)
+        user = await asyncio.to_thread(_fetch_user_by_session, token) if token else None
+        if not user or not user.get("is_active"):
+            # close до accept -> рукопожатие отклоняется с 403
+            self.rejected_clients += 1
+            await websocket.close(code=1008)
+            return
+
+        await websocket.accept()
+        subscriber = _Subscriber(websocket)
+        self._clients += 1
+        sender = asyncio.create_task(self._send_loop(subscriber))
+        try:
+            while True:
+                text = await websocket.receive_text()
+                try:
+                    message = json.loads(text)
+                    action = message.get("action")
+                    symbols = normalize_tickers(message.get("symbols") or [])
+                except (ValueError, AttributeError, TypeError):
+                    subscriber.reply({"type": "error", "error": "Invalid message"})
+                    continue
+
+                if action == "subscribe":
+                    self._subscribe(subscriber, symbols)
+                elif action == "unsubscribe":
+                    self._unsubscribe(subscriber, symbols)
+                else:
+                    subscriber.reply({"type": "error", "error": f"Unknown action: {action}"})
+        except (WebSocketDisconnect, RuntimeError):
+            pass  # RuntimeError — сокет уже закрыт нами (медленный клиент)
+        finally:
+            sender.cancel()
+            self._unsubscribe(subscriber, list(subscriber.symbols))
+            self._clients -= 1
+
+    def _subscribe(self, subscriber: _Subscriber, symbols: List[str]):
+        room = MAX_SYMBOLS_PER_CLIENT - len(subscriber.symbols)
+        new = [s for s in symbols if s not in subscriber.symbols]
+        added = []
+        hub_full = False
+        for symbol in new[:max(room, 0)]:
+            # тикер, который уже опрашивается, лимит хаба не расходует
+            if symbol not in self._subscribers and len(self._subscribers) >= MAX_HUB_SYMBOLS:
+                hub_full = True
+                continue
+            added.append(symbol)
+            subscriber.symbols.add(symbol)
+            self._subscribers.setdefault(symbol, set()).add(subscriber)
+            # уже известная цена — сразу, не дожидаясь следующего опроса
+            if symbol in self._last:
+                subscriber.push(symbol, self._last[symbol])
+        subscriber.reply({"type": "subscribed", "symbols": sorted(subscriber.symbols)})
+        if hub_full:
+            subscriber.reply({"type": "error",
+                              "error": "Server price stream is at capacity, some symbols were not subscribed"})
+        elif len(added) < len(new):
+            subscriber.reply({"type": "error",
+                              "error": f"Subscription limit is {MAX_SYMBOLS_PER_CLIENT} symbols"})
+        self._ensure_polling()
+
+    def _unsubscribe(self, subscriber: _Subscriber, symbols: List[str]):
+        for symbol in symbols:
+            subscriber.symbols.discard(symbol)
+            subscriber.pending.pop(symbol, None)
+            listeners = self._subscribers.get(symbol)
+            if listeners is None:
+                continue
+            listeners.discard(subscriber)
+            if not listeners:
+                del self._subscribers[symbol]
+                self._last.pop(symbol, None)
+
+    async def _send_loop(self, subscriber: _Subscriber):
+        websocket = subscriber.websocket
+        while True:
+            await subscriber.wake.wait()
+            subscriber.wake.clear()
+            messages, subscriber.control = subscriber.control, []
+            if subscriber.pending:
+                quotes, subscriber.pending = subscriber.pending, {}
+                messages.append({"type": "prices", "quotes": quotes})
+            try:
+                for message in messages:
+                    await asyncio.wait_for(websocket.send_json(message), SEND_TIMEOUT_SEC)
+                    self.messages_sent += 1
+            except asyncio.TimeoutError:
+                self.dropped_clients += 1
+                print(f"🐢 Price stream: slow client dropped ({len(subscriber.symbols)} symbols)")
+                await websocket.close(code=1008)
+                return
+            except Exception:
+                return  # соединение уже закрыто — serve() уберёт подписки
+
+    # ---------- опрос FMP ----------
+
+    def _ensure_polling(self):
+        if self._subscribers and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._poll_loop())
+
+    async def _poll_loop(self):
+        while self._subscribers:
+            symbols = list(self._subscribers)
+            try:
+                # max_age = интервал: свежие котировки из общего кэша
+                # (например, от /api/watchlist/enriched) повторно не запрашиваются
+                quotes = await asyncio.to_thread(
+                    quote_cache.get_quotes, symbols, self.fetch, self.interval)
+            except Exception as e:
+                print(f"❌ Price stream poll failed ({len(symbols)} symbols): {e}")
+                quotes = {}
+            self.polls += 1
+            self._publish(quotes)
+            await asyncio.sleep(self.interval)
+
+    def _publish(self, quotes: Dict[str, Dict[str, Any]]):
+        for symbol, quote in quotes.items():
+            listeners = self._subscribers.get(symbol)
+            if not listeners:
+                continue
+            update = _compact(quote)
+            if self._last.get(symbol) == update:
+                continue
+            self._last[symbol] = update
+            for subscriber in listeners:
+                if subscriber.push(symbol, update):
+                    self.coalesced += 1
+        metrics.inc("price_stream.polls")
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "clients": self._clients,
+            "symbols": len(self._subscribers),
+            "poll_interval_sec": self.interval,
+            "polls": self.polls,
+            "messages_sent": self.messages_sent,
+            "coalesced": self.coalesced,
+            "dropped_clients": self.dropped_clients,
+            "rejected_clients": self.rejected_clients,
+            "max_symbols": MAX_HUB_SYMBOLS,
+        }
+
+
+# Глобальный экземпляр (fetcher подключает main.py: analyzer.get_batch_quotes)
+price_hub = PriceHub()
+metrics.register_gauge("price_stream", price_hub.get_stats)
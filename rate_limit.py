@@ -0,0 +1,125 @@
+# rate_limit.py - Скользящее окно для попыток входа
+#
+# Проверка выполняется ДО любого обращения к SQLite и Fernet, поэтому
+# всплеск credential stuffing упирается в память процесса, а не в БД.
+#
+# На каждый ключ (IP или email) хранится кольцевой буфер из `limit`
+# временных меток: попытка разрешена, если самая старая метка в буфере
+# уже вышла за окно. Число ключей ограничено (LRU), так что память
+# ограничена сверху: max_keys * limit * 8 байт.
+#
+# IP клиента — client_ip(). Граница доверия: приложение развёрнуто за
+# прокси Cloud Run, поэтому request.client.host — адрес прокси, общий для
+# всех пользователей. Прокси ДОПИСЫВАЕТ адрес клиента в конец
+# X-Forwarded-For; всё левее пришло от клиента и может быть подделано.
+# Поэтому берётся адрес на TRUSTED_PROXY_HOPS позиций от правого края
+# (1 = один наш прокси). Без прокси (локальный запуск) TRUSTED_PROXY_HOPS=0
+# и заголовок игнорируется — иначе любой обошёл бы лимит подменой XFF.
+# По умолчанию 1 в Cloud Run (там задан K_SERVICE), иначе 0.
+
+import os
+import time
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Dict, Any, Optional
+
+import metrics
+
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "1" if os.getenv("K_SERVICE") else "0"))
+
+
+def client_ip(request) -> str:
+    """IP клиента с учётом доверенных прокси (см. заголовок модуля)."""
+    peer = request.client.host if request.client else "unknown"
+    if TRUSTED_PROXY_HOPS <= 0:
+        return peer
+    hops = [h.strip() for h in request.headers.get("x-forwarded-for", "").split(",") if h.strip()]
+    if len(hops) < TRUSTED_PROXY_HOPS:
+        return peer
+    return hops[-TRUSTED_PROXY_HOPS]
+
+
+class SlidingWindowLimiter:
+    """Не больше `limit` событий за `window_sec` секунд на ключ."""
+
+    def __init__(self, limit: int, window_sec: float, max_keys: int = 50000):
+        self.limit = limit
+        self.window_sec = window_sec
+        self.max_keys = max_keys
+        # key -> [ring buffer of timestamps, write position]
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit(self, key: str, now: float = None) -> float:
+        """
+        Зарегистрировать попытку. Возвращает 0.0, если она разрешена,
+        иначе — сколько секунд подождать (Retry-After).
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.max_keys:
+                    self._buckets.popitem(last=False)
+                bucket = [array("d", [float("-inf")] * self.limit), 0]
+                self._buckets[key] = bucket
+            else:
+                self._buckets.move_to_end(key)
+
+            ring, pos = bucket
+            oldest = ring[pos]
+            if now - oldest < self.window_sec:
+                return self.window_sec - (now - oldest)
+
+            ring[pos] = now
+            bucket[1] = (pos + 1) % self.limit
+            return 0.0
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class LoginThrottle:
+    """Лимиты попыток входа по IP и по нормализованному email."""
+
+    def __init__(self):
+        self.by_ip = SlidingWindowLimiter(
+            limit=int(os.getenv("LOGIN_IP_LIMIT", "20")),
+            window_sec=float(os.getenv("LOGIN_IP_WINDOW", "60")),
+        )
+        self.by_email = SlidingWindowLimiter(
+            limit=int(os.getenv("LOGIN_EMAIL_LIMIT", "10")),
+            window_sec=float(os.getenv("LOGIN_EMAIL_WINDOW", "300")),
+        )
+
+    def check(self, ip: str, email: str) -> Optional[int]:
+        """None — пропускаем; иначе число секунд для Retry-After."""
+        metrics.inc("login.attempts")
+
+        wait = self.by_ip.hit(ip or "unknown")
+        if wait:
+            metrics.inc("login.throttled_ip")
+            return max(1, int(wait + 0.999))
+
+        email = (email or "").strip().lower()
+        if email:
+            wait = self.by_email.hit(email)
+            if wait:
+                metrics.inc("login.throttled_email")
+                return max(1, int(wait + 0.999))
+
+        return None
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "tracked_ips": len(self.by_ip),
+            "tracked_emails": len(self.by_email),
+            "ip_limit": f"{self.by_ip.limit}/{self.by_ip.window_sec:g}s",
+            "email_limit": f"{self.by_email.limit}/{self.by_email.window_sec:g}s",
+        }
+
+
+# Глобальный экземпляр
+login_throttle = LoginThrottle()
+metrics.register_gauge("login_throttle", login_throttle.get_stats)
@@ -1,6 +1,5 @@
 # referral_manager.py - Система реферальных кодов ProfitPal
 
-import sqlite3
 import random
 import string
 import hashlib
@@ -9,13 +8,13 @@ from typing import Dict, Any, List, Optional, Tuple
 import os
 from cryptography.fernet import Fernet
 import base64
+from storage import get_connection, init_storage
 
 class ReferralManager:
-    def __init__(self, db_path: str = "referrals.db"):
-        self.db_path = db_path
+    def __init__(self):
         self.encryption_key = self._get_or_create_encryption_key()
         self.fernet = Fernet(self.encryption_key)
-        self.init_database()
+        init_storage()
         print("💎 Referral Manager initialized!")
 
     def _get_or_create_encryption_key(self) -> bytes:
@@ -30,57 +29,6 @@ class ReferralManager:
                 f.write(key)
             return key
 
-    def init_database(self):
-        """Инициализация базы данных referrals"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-
-        # Таблица реферальных кодов
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS referrals (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_email TEXT NOT NULL UNIQUE,
-                referral_code TEXT NOT NULL UNIQUE,
-                referral_link TEXT NOT NULL,
-                free_months_balance INTEGER DEFAULT 0,
-                total_referrals INTEGER DEFAULT 0,
-                total_earned_months INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-        # Таблица использованных реферальных ссылок
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS referral_uses (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                referral_code TEXT NOT NULL,
-                referrer_email TEXT NOT NULL,
-                new_user_email TEXT NOT NULL,
-                payment_amount REAL NOT NULL,
-                reward_months INTEGER DEFAULT 1,
-                used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (referral_code) REFERENCES referrals (referral_code)
-            )
-        ''')
-
-        # Таблица истории free months
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS free_months_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_email TEXT NOT NULL,
-                action_type TEXT NOT NULL, -- 'earned', 'used', 'expired'
-                months_change INTEGER NOT NULL, -- +1, -1, etc.
-                balance_after INTEGER NOT NULL,
-                description TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-
-        conn.commit()
-        conn.close()
-        print("✅ Referral database initialized!")
-
     def generate_unique_referral_code(self) -> str:
         """
         Генерирует уникальный referral код:
@@ -135,7 +83,7 @@ class ReferralManager:
 
     def referral_code_exists(self, referral_code: str) -> bool:
         """Проверить существует ли referral код"""
-        conn = sqlite3.connect(self.db_path)
+        conn = get_connection()
         cursor = conn.cursor()
 
         cursor.execute('SELECT COUNT(*) FROM referrals WHERE referral_code = ?', (referral_code,))
@@ -165,7 +113,7 @@ class ReferralManager:
             referral_link = f"{domain}?ref={referral_code}"
 
             # Сохраняем в базу
-            conn = sqlite3.connect(self.db_path)
+            conn = get_connection()
             cursor = conn.cursor()
 
             cursor.execute('''
@@ -200,7 +148,7 @@ class ReferralManager:
         Дать +1 бесплатный месяц рефереру
         """
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = get_connection()
             cursor = conn.cursor()
 
             # Найти реферера по коду
@@ -284,7 +232,7 @@ class ReferralManager:
         Возвращает нужно ли списывать $7.99
         """
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = get_connection()
             cursor = conn.cursor()
 
             # Получить текущий баланс
@@ -353,7 +301,7 @@ class ReferralManager:
     def get_user_referral_info(self, user_email: str) -> Optional[Dict[str, Any]]:
         """Получить информацию о referral пользователя"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = get_connection()
             cursor = conn.cursor()
 
             cursor.execute('''
@@ -383,7 +331,7 @@ class ReferralManager:
     def get_referral_statistics(self, user_email: str) -> Dict[str, Any]:
         """Получить статистику по referrals пользователя"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = get_connection()
             cursor = conn.cursor()
 
             # Основная информация
@@ -471,7 +419,7 @@ class ReferralManager:
     def get_all_referral_stats(self) -> Dict[str, Any]:
         """Получить общую статистику referral системы (для админа)"""
         try:
-            conn = sqlite3.connect(self.db_path)
+            conn = get_connection()
             cursor = conn.cursor()
 
             # Общее количество referral кодов
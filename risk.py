@@ -0,0 +1,190 @@
+# risk.py - Риск-метрики по дневной истории цен
+#
+# Для списка тикеров (позиции или watchlist) все метрики считаются одним
+# проходом NumPy по матрице доходностей T x N (дни x тикеры), выровненной
+# по торговому календарю бенчмарка (SPY):
+#
+#   volatility      - годовая волатильность (std дневных доходностей * sqrt(252))
+#   vol_21d         - текущая месячная волатильность (скользящее окно 21 день)
+#   max_drawdown    - максимальная просадка от пика за окно
+#   beta            - cov(r, r_SPY) / var(r_SPY)
+#   sharpe          - (годовая доходность - RISK_FREE_RATE) / волатильность
+#   var_95          - исторический однодневный VaR 95% (доля, положительное число)
+#
+# Пропуски (тикер начал торговаться позже, нет бара в день SPY) — NaN;
+# все суммы по маске, так что у каждого тикера своё число наблюдений.
+# Для портфеля добавляется ещё один столбец — доходность по весам позиций.
+#
+# Результат мемоизируется по (набор тикеров, веса, окно, последняя дата).
+
+import os
+import warnings
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+import metrics
+from market_data import normalize_tickers
+from price_history import price_history
+
+BENCHMARK = os.getenv("RISK_BENCHMARK", "SPY")
+RISK_FREE_RATE = float(os.getenv("RISK_FREE_RATE", "0.04"))
+TRADING_DAYS = 252
+DEFAULT_WINDOW = 252
+ROLLING_WINDOW = 21
+MAX_SYMBOLS = 500
+# /api/risk и /api/watchlist/risk: каждый новый тикер — загрузка истории из FMP
+MAX_QUERY_SYMBOLS = int(os.getenv("RISK_MAX_QUERY_SYMBOLS", "50"))
+MEMO_SIZE = 256
+
+_memo: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
+_memo_lock = threading.Lock()
+
+
+def _aligned_closes(series: Dict[str, Dict[str, np.ndarray]], symbols: List[str],
+                    calendar: np.ndarray) -> np.ndarray:
+    """Матрица цен закрытия (len(calendar) x N), NaN где бара нет."""
+    closes = np.full((len(calendar), len(symbols)), np.nan)
+    for j, symbol in enumerate(symbols):
+        data = series.get(symbol)
+        if data is None:
+            continue
+        dates = data["date"]
+        idx = np.searchsorted(dates, calendar)
+        idx_clipped = np.minimum(idx, len(dates) - 1)
+        hit = dates[idx_clipped] == calendar
+        closes[hit, j] = data["close"][idx_clipped[hit]]
+    return closes
+
+
+def _masked_stats(returns: np.ndarray, bench: np.ndarray) -> Dict[str, np.ndarray]:
+    """Среднее/std/beta по столбцам с учётом NaN (векторно по всем тикерам сразу)."""
+    mask = ~np.isnan(returns) & ~np.isnan(bench)[:, None]
+    n = mask.sum(axis=0)
+    r = np.where(mask, returns, 0.0)
+    b = np.where(mask, bench[:, None], 0.0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_r = r.sum(axis=0) / n
+        mean_b = b.sum(axis=0) / n
+        dr = np.where(mask, r - mean_r, 0.0)
+        db = np.where(mask, b - mean_b, 0.0)
+        var_r = (dr * dr).sum(axis=0) / (n - 1)
+        var_b = (db * db).sum(axis=0) / (n - 1)
+        cov = (dr * db).sum(axis=0) / (n - 1)
+        beta = cov / var_b
+    enough = n > 1
+    return {"n": n, "mean": np.where(enough, mean_r, np.nan),
+            "std": np.where(enough, np.sqrt(np.abs(var_r)), np.nan),
+            "beta": np.where(enough, beta, np.nan)}
+
+
+def compute_matrix_metrics(closes: np.ndarray, bench_closes: np.ndarray,
+                           risk_free: float = RISK_FREE_RATE) -> Dict[str, np.ndarray]:
+    """Все метрики по столбцам матрицы цен (T x N) против цен бенчмарка (T)."""
+    with np.errstate(invalid="ignore", divide="ignore"):
+        returns = closes[1:] / closes[:-1] - 1.0
+        bench = bench_closes[1:] / bench_closes[:-1] - 1.0
+
+        stats = _masked_stats(returns, bench)
+        volatility = stats["std"] * np.sqrt(TRADING_DAYS)
+        annual_return = stats["mean"] * TRADING_DAYS
+        sharpe = (annual_return - risk_free) / volatility
+
+        # просадка: пропуски протягиваем вперёд (индекс последнего известного
+        # дня — накопленный максимум), пик — накопленный максимум цены
+        rows = np.where(np.isnan(closes), 0, np.arange(len(closes))[:, None])
+        filled = closes[np.maximum.accumulate(rows, axis=0), np.arange(closes.shape[1])]
+        peaks = np.fmax.accumulate(filled, axis=0)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)  # столбцы целиком из NaN
+            max_drawdown = np.nanmin(filled / peaks - 1.0, axis=0)
+            var_95 = -np.nanpercentile(returns, 5, axis=0)
+            if len(returns) >= ROLLING_WINDOW:
+                windows = sliding_window_view(returns, ROLLING_WINDOW, axis=0)  # (T-20) x N x 21
+                vol_21d = np.nanstd(windows[-1], axis=-1, ddof=1) * np.sqrt(TRADING_DAYS)
+            else:
+                vol_21d = np.full(returns.shape[1], np.nan)
+
+    return {
+        "observations": stats["n"],
+        "annual_return": annual_return,
+        "volatility": volatility,
+        "vol_21d": vol_21d,
+        "max_drawdown": max_drawdown,
+        "beta": stats["beta"],
+        "sharpe": sharpe,
+        "var_95": var_95,
+    }
+
+
+def _round(value, digits=4) -> Optional[float]:
+    return None if value is None or not np.isfinite(value) else round(float(value), digits)
+
+
+def compute_risk(symbols: Sequence[str], quantities: Optional[Dict[str, float]] = None,
+                 window: int = DEFAULT_WINDOW) -> Dict[str, Any]:
+    """
+    Риск по тикерам за последние window торговых дней.
+    quantities — {symbol: количество}: добавляет строку "portfolio"
+    (веса — текущая стоимость позиций по последнему закрытию).
+    """
+    symbols = normalize_tickers(symbols)[:MAX_SYMBOLS]
+    window = max(ROLLING_WINDOW + 1, min(int(window), TRADING_DAYS * 5))
+    series = price_history.get_many(symbols + [BENCHMARK])
+    bench = series.get(BENCHMARK)
+    if bench is None or len(bench["date"]) < 2:
+        raise ValueError(f"No price history for benchmark {BENCHMARK}")
+
+    calendar = bench["date"][-(window + 1):]
+    key = (tuple(symbols), tuple(sorted((quantities or {}).items())), window, str(calendar[-1]))
+    with _memo_lock:
+        if key in _memo:
+            _memo.move_to_end(key)
+            metrics.inc("risk.memo_hit")
+            return _memo[key]
+
+    closes = _aligned_closes(series, symbols, calendar)
+    bench_closes = bench["close"][-(window + 1):]
+    columns = list(symbols)
+
+    if quantities:
+        # портфель: дневная доходность = сумма доходностей по весам стоимости
+        qty = np.array([max(quantities.get(s, 0.0), 0.0) for s in symbols])
+        valid = ~np.isnan(closes)
+        last_row = len(closes) - 1 - np.argmax(valid[::-1], axis=0)
+        last_close = np.nan_to_num(closes[last_row, np.arange(len(symbols))])
+        w = qty * last_close
+        if w.sum() > 0:
+            with np.errstate(invalid="ignore", divide="ignore"):
+                returns = np.nan_to_num(closes[1:] / closes[:-1] - 1.0)
+            portfolio = np.concatenate([[1.0], np.cumprod(1.0 + returns @ (w / w.sum()))])
+            closes = np.column_stack([closes, portfolio])
+            columns.append("portfolio")
+
+    result_metrics = compute_matrix_metrics(closes, bench_closes)
+    missing = set(symbols) - set(series)
+    rows = []
+    for j, symbol in enumerate(columns):
+        row = {"symbol": symbol}
+        for name, values in result_metrics.items():
+            row[name] = int(values[j]) if name == "observations" else _round(values[j])
+        if symbol in missing:
+            row["error"] = "no price history"
+        rows.append(row)
+
+    result = {
+        "benchmark": BENCHMARK,
+        "window": window,
+        "as_of": str(calendar[-1]),
+        "risk_free_rate": RISK_FREE_RATE,
+        "metrics": rows,
+    }
+    with _memo_lock:
+        _memo[key] = result
+        while len(_memo) > MEMO_SIZE:
+            _memo.popitem(last=False)
+    return result
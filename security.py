@@ -6,13 +6,14 @@ import secrets
 import os
 import re
 from typing import Optional, Dict
+from storage import get_connection, PRIMARY_DB
 
 # ---- cookie names ----
 SESSION_COOKIE = "pp_session"
 CSRF_COOKIE    = "pp_csrf"
 
 # ---- single DB path (совпадает с auth_manager) ----
-DB_PATH = "profitpal_auth.db"
+DB_PATH = PRIMARY_DB
 
 # ---- admin bypass via ENV ----
 ADMIN_EMAIL        = (os.getenv("ADMIN_EMAIL") or "").strip().lower()
@@ -20,7 +21,7 @@ ADMIN_LICENSE_KEY  = (os.getenv("ADMIN_LICENSE_KEY") or "").strip()
 ADMIN_FULL_NAME    = (os.getenv("ADMIN_FULL_NAME") or "System Administrator").strip()
 
 def _db():
-    con = sqlite3.connect(DB_PATH)
+    con = get_connection()
     con.row_factory = sqlite3.Row
     return con
 
@@ -214,6 +215,15 @@ def require_plan(required: Optional[str] = None):
         raise HTTPException(status_code=402, detail="Payment required")
 
     return _inner
+
+
+async def require_admin(request: Request):
+    """Валидная сессия администратора (license_key == ADMIN_LICENSE_KEY): 401 / 403."""
+    user = await require_user(request)
+    # без ADMIN_LICENSE_KEY пустой ключ пользователя "совпал" бы с пустым
+    if not ADMIN_LICENSE_KEY or not is_admin_user(user):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return user
     
 
 def verify_csrf(request: Request):
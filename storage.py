@@ -0,0 +1,365 @@
+# storage.py - Единый слой хранения ProfitPal
+#
+# Все данные живут в нескольких SQLite-файлах, но открываются через ОДНО
+# соединение: основной файл (auth: users / user_sessions / login_attempts)
+# + ATTACH остальных хранилищ под постоянными именами схем:
+#
+#   main      -> profitpal_auth.db      (users, user_sessions, login_attempts)
+#   journal   -> profitpal.db           (transactions, watchlist, donations, payments)
+#   trials    -> profitpal_database.db  (free_trials)
+#   referral  -> referrals.db           (referrals, referral_uses, free_months_history)
+#   crm       -> customers.db           (customers, price_notifications, email_stats)
+#
+# Неквалифицированные имена таблиц SQLite ищет сначала в main, затем в
+# прикреплённых базах по порядку, поэтому старые запросы вида
+# "SELECT ... FROM referrals" продолжают работать, а новые могут делать
+# кросс-джойны (users -> referrals -> donations -> sessions) одним запросом.
+
+import os
+import json
+import queue
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Optional
+
+import metrics
+from migrations import run_migrations, COUNTER_RECONCILE
+
+# ---- пути к хранилищам (ENV переопределяет) ----
+PRIMARY_DB = os.getenv("AUTH_DB", "profitpal_auth.db")
+
+ATTACHED_STORES = {
+    "journal": os.getenv("JOURNAL_DB", "profitpal.db"),
+    "trials": os.getenv("FREE_TRIALS_DB", "profitpal_database.db"),
+    "referral": os.getenv("REFERRALS_DB", "referrals.db"),
+    "crm": os.getenv("CUSTOMERS_DB", "customers.db"),
+}
+
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+BUSY_TIMEOUT_SEC = float(os.getenv("DB_BUSY_TIMEOUT", "15"))
+
+# ==========================================
+# ПУЛ СОЕДИНЕНИЙ
+# ==========================================
+
+class PooledConnection(sqlite3.Connection):
+    """
+    Обычное sqlite3-соединение, но close() и выход из `with` возвращают
+    его в пул (с откатом незакоммиченного), а не закрывают файл.
+    Поэтому старый код `conn = ...; ...; conn.commit(); conn.close()`
+    и `with _db() as con:` работает без изменений.
+    """
+    _pool: Optional["ConnectionPool"] = None
+    _checked_out: bool = False
+    _functions_version: int = 0
+
+    def close(self):
+        if self._pool is not None and self._pool.release(self):
+            return
+        super().close()
+
+    def __exit__(self, exc_type, exc, tb):
+        result = super().__exit__(exc_type, exc, tb)
+        self.close()
+        return result
+
+
+class ConnectionPool:
+    """LIFO-пул соединений с уже прикреплёнными (ATTACH) хранилищами."""
+
+    def __init__(self, size: int = POOL_SIZE):
+        self.size = size
+        self._idle: "queue.LifoQueue[PooledConnection]" = queue.LifoQueue(maxsize=size)
+        self._functions: Dict[str, tuple] = {}
+        self._functions_version = 0
+        self._lock = threading.Lock()
+
+    def _open(self) -> PooledConnection:
+        con = sqlite3.connect(
+            PRIMARY_DB,
+            timeout=BUSY_TIMEOUT_SEC,
+            check_same_thread=False,
+            factory=PooledConnection,
+        )
+        for schema, path in ATTACHED_STORES.items():
+            con.execute(f"ATTACH DATABASE ? AS {schema}", (path,))
+        con.execute("PRAGMA synchronous = NORMAL")
+        con._pool = self
+        return con
+
+    def acquire(self) -> PooledConnection:
+        try:
+            con = self._idle.get_nowait()
+        except queue.Empty:
+            con = self._open()
+        if con._functions_version != self._functions_version:
+            with self._lock:
+                for name, (nargs, func) in self._functions.items():
+                    con.create_function(name, nargs, func)
+                con._functions_version = self._functions_version
+        con.row_factory = None
+        con._checked_out = True
+        return con
+
+    def release(self, con: PooledConnection) -> bool:
+        """True — соединение принято пулом (или уже было возвращено)."""
+        if not con._checked_out:
+            return True
+        con._checked_out = False
+        try:
+            if con.in_transaction:
+                con.rollback()
+            self._idle.put_nowait(con)
+            return True
+        except (queue.Full, sqlite3.Error):
+            return False
+
+    def register_function(self, name: str, nargs: int, func: Callable):
+        with self._lock:
+            self._functions[name] = (nargs, func)
+            self._functions_version += 1
+
+
+_pool = ConnectionPool()
+
+
+def get_connection() -> PooledConnection:
+    """Соединение из общего пула: main + journal/trials/referral/crm."""
+    init_storage()
+    return _pool.acquire()
+
+
+def register_function(name: str, nargs: int, func: Callable):
+    """Зарегистрировать SQL-функцию на всех соединениях пула (в т.ч. будущих)."""
+    _pool.register_function(name, nargs, func)
+
+
+# ==========================================
+# ИНИЦИАЛИЗАЦИЯ (схемы — в migrations.py)
+# ==========================================
+
+_init_lock = threading.Lock()
+_initialized = False
+
+
+def init_storage():
+    """Включить WAL и прогнать миграции (один раз на процесс)."""
+    global _initialized
+    if _initialized:
+        return
+    with _init_lock:
+        if _initialized:
+            return
+        con = _pool.acquire()
+        try:
+            for schema in ["main", *ATTACHED_STORES]:
+                con.execute(f"PRAGMA {schema}.journal_mode = WAL")
+            run_migrations(con)
+        finally:
+            con.close()
+        _initialized = True
+        print("✅ Storage initialized: main + " + ", ".join(ATTACHED_STORES))
+
+
+# ==========================================
+# КРОСС-ХРАНИЛИЩНЫЕ ПРЕДСТАВЛЕНИЯ (один запрос на экран)
+# ==========================================
+
+# pp_user_email(encrypted_email) регистрирует AuthManager (он знает ключ)
+DASHBOARD_SQL = '''
+WITH me AS MATERIALIZED (
+    SELECT u.id, u.license_key, pp_user_email(u.encrypted_email) AS email
+    FROM main.users u
+    WHERE u.id = :user_id
+)
+SELECT
+    me.id, me.email, me.license_key,
+    r.referral_code, r.referral_link, r.free_months_balance,
+    r.total_referrals, r.total_earned_months, r.created_at AS referral_created_at,
+    (SELECT json_group_array(json_object(
+                'new_user_email', x.new_user_email,
+                'payment_amount', x.payment_amount,
+                'used_at', x.used_at))
+       FROM (SELECT new_user_email, payment_amount, used_at
+               FROM referral.referral_uses
+              WHERE referrer_email = me.email
+              ORDER BY used_at DESC
+              LIMIT 10) x) AS recent_referrals,
+    (SELECT COUNT(*) FROM journal.donations d
+      WHERE d.user_id = me.id) AS donations_count,
+    (SELECT COALESCE(SUM(d.amount_cents), 0) FROM journal.donations d
+      WHERE d.user_id = me.id AND d.status = 'succeeded') AS donated_cents,
+    (SELECT COUNT(*) FROM main.user_sessions s
+      WHERE s.user_id = me.id AND s.is_active = 1
+        AND s.expires_at > datetime('now')) AS active_sessions
+FROM me
+LEFT JOIN referral.referrals r ON r.user_email = me.email
+'''
+
+
+def fetch_dashboard_summary(user_id: int) -> Optional[Dict[str, Any]]:
+    """Всё для дашборда пользователя: referral-инфо, история, донаты, сессии."""
+    with get_connection() as con:
+        con.row_factory = sqlite3.Row
+        row = con.execute(DASHBOARD_SQL, {"user_id": user_id}).fetchone()
+    if not row:
+        return None
+
+    referral_info = None
+    if row["referral_code"]:
+        referral_info = {
+            "referral_code": row["referral_code"],
+            "referral_link": row["referral_link"],
+            "free_months_balance": row["free_months_balance"],
+            "total_referrals": row["total_referrals"],
+            "total_earned_months": row["total_earned_months"],
+            "created_at": row["referral_created_at"],
+        }
+    return {
+        "user_id": row["id"],
+        "email": row["email"],
+        "referral_info": referral_info,
+        "recent_referrals": json.loads(row["recent_referrals"] or "[]"),
+        "donations": {
+            "count": row["donations_count"],
+            "total_cents": row["donated_cents"],
+        },
+        "active_sessions": row["active_sessions"],
+    }
+
+
+# Счётчики ведут триггеры main.stat_counters (migrations.py, версия 6):
+# всё читается по первичному ключу, кроме сессий, истекающих сегодня, —
+# их точно досчитываем по idx_sessions_expires (диапазон в пределах дня)
+AUTH_STATS_SQL = '''
+SELECT
+    (SELECT COALESCE(MAX(value), 0) FROM main.stat_counters
+      WHERE name = 'active_users') AS active_users,
+    (SELECT COALESCE(MAX(value), 0) FROM main.stat_counters
+      WHERE name = 'total_users') AS total_users,
+    (SELECT COALESCE(SUM(value), 0) FROM main.stat_counters
+      WHERE name > 'sessions_expiring:' || :today_date
+        AND name < 'sessions_expiring;')
+    + (SELECT COUNT(*) FROM main.user_sessions
+        WHERE expires_at > :now AND expires_at < :tomorrow_date) AS active_sessions,
+    (SELECT COALESCE(MAX(value), 0) FROM main.stat_counters
+      WHERE name = 'logins:' || :today_date) AS today_logins
+'''
+
+
+def fetch_auth_stats() -> Dict[str, Any]:
+    """Статистика пользователей/сессий/входов за O(1) от размера таблиц."""
+    now = datetime.now()
+    params = {
+        "now": now.isoformat(),
+        "today_date": now.date().isoformat(),
+        "tomorrow_date": (now.date() + timedelta(days=1)).isoformat(),
+    }
+    with get_connection() as con:
+        con.row_factory = sqlite3.Row
+        row = con.execute(AUTH_STATS_SQL, params).fetchone()
+
+    return {
+        "active_users": row["active_users"],
+        "total_users": row["total_users"],
+        "active_sessions": row["active_sessions"],
+        "today_logins": row["today_logins"],
+        "generated_at": now.isoformat(),
+    }
+
+
+def reconcile_counters() -> Dict[str, Any]:
+    """Пересчитать stat_counters с нуля (сверка с таблицами). Возвращает расхождения."""
+    with get_connection() as con:
+        con.execute("BEGIN IMMEDIATE")
+        before = dict(con.execute("SELECT name, value FROM main.stat_counters"))
+        for sql in COUNTER_RECONCILE:
+            con.execute(sql)
+        after = dict(con.execute("SELECT name, value FROM main.stat_counters"))
+
+    drift = {name: after.get(name, 0) - before.get(name, 0)
+             for name in set(before) | set(after)
+             if after.get(name, 0) != before.get(name, 0)}
+    if drift:
+        print(f"🧮 Stat counters reconciled, drift: {drift}")
+    return drift
+
+
+class CounterReconciler:
+    """Фоновая периодическая сверка stat_counters (daemon-поток)."""
+
+    def __init__(self, interval_sec: float = float(os.getenv("STATS_RECONCILE_INTERVAL", "21600"))):
+        self.interval_sec = interval_sec
+        self._stopped = threading.Event()
+        self._thread = None
+        self.runs = 0
+        self.last_run_at = None
+        self.last_drift: Dict[str, Any] = {}
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="stats-reconciler", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval_sec):
+            try:
+                self.last_drift = reconcile_counters()
+                self.runs += 1
+                self.last_run_at = datetime.now().isoformat()
+            except Exception as e:
+                print(f"❌ Stat counters reconcile failed: {e}")
+
+    def stop(self):
+        self._stopped.set()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "interval_sec": self.interval_sec,
+            "runs": self.runs,
+            "last_run_at": self.last_run_at,
+            "last_drift": self.last_drift,
+        }
+
+
+counter_reconciler = CounterReconciler()
+metrics.register_gauge("stat_counters", counter_reconciler.get_stats)
+
+
+ADMIN_OVERVIEW_SQL = '''
+SELECT
+    (SELECT COUNT(*) FROM referral.referrals) AS total_referral_codes,
+    (SELECT COUNT(*) FROM referral.referral_uses) AS total_successful_uses,
+    (SELECT COALESCE(SUM(total_earned_months), 0) FROM referral.referrals) AS total_earned_months,
+    (SELECT COALESCE(SUM(free_months_balance), 0) FROM referral.referrals) AS current_free_months,
+    (SELECT json_group_array(json_object(
+                'email', t.user_email,
+                'total_referrals', t.total_referrals,
+                'total_earned_months', t.total_earned_months,
+                'free_months_balance', t.free_months_balance))
+       FROM (SELECT user_email, total_referrals, total_earned_months, free_months_balance
+               FROM referral.referrals
+              ORDER BY total_referrals DESC
+              LIMIT 10) t) AS top_referrers
+'''
+
+
+def fetch_admin_overview() -> Dict[str, Any]:
+    """Статистика auth (счётчики) + referrals для /admin/stats."""
+    auth = fetch_auth_stats()
+    with get_connection() as con:
+        con.row_factory = sqlite3.Row
+        row = con.execute(ADMIN_OVERVIEW_SQL).fetchone()
+
+    return {
+        "auth": auth,
+        "referrals": {
+            "total_referral_codes": row["total_referral_codes"],
+            "total_successful_uses": row["total_successful_uses"],
+            "total_earned_months": row["total_earned_months"],
+            "current_free_months_balance": row["current_free_months"],
+            "top_referrers": json.loads(row["top_referrers"] or "[]"),
+        },
+    }